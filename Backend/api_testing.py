@@ -1,9 +1,15 @@
-import base64
-import time
-from functools import lru_cache
+import os
+import sqlite3
+from urllib.parse import urlsplit
 
-import requests
-from requests import RequestException
+from cover_store import cover_store
+from covers import Cover
+from http_client import HttpClient, RetryPolicy, UpstreamError
+from local_index import open_index
+from releases import project_release
+from singleflight import singleflight
+from suggestions import keystroke_bursts, normalise, suggestion_cache, words
+from ttl_cache import ttl_cache
 
 
 '''
@@ -27,46 +33,103 @@ https://musicbrainz.org/ws/2/release?query=release:"OK Computer"&fmt=json
 '''
 
 USER_AGENT = {'User-Agent': 'Resleeve/1.0 ( morganbennett100@gmail.com )'}
+# upstream roots, overridable to point at a local stand-in ( see benchmarks/fake_upstream.py )
+MUSICBRAINZ_URL = os.environ.get("RESLEEVE_MUSICBRAINZ_URL", "https://musicbrainz.org").rstrip("/")
+COVER_ART_URL = os.environ.get("RESLEEVE_COVER_ART_URL", "https://coverartarchive.org").rstrip("/")
+MUSICBRAINZ_HOST = urlsplit(MUSICBRAINZ_URL).netloc
 COVER_TIMEOUT = 5
 TRACKLIST_TIMEOUT = 10
 SUGGEST_TIMEOUT = 5
 SUGGEST_LIMIT = 6
+MAX_COVER_WORKERS = 10
+# upstream requests out at once per host, and the keep-alive connections pooled for them
+UPSTREAM_CONCURRENCY = int(os.environ.get("RESLEEVE_UPSTREAM_CONCURRENCY", 16))
+
+SEARCH_POLICY = RetryPolicy(attempts=3, backoff=0.5, timeout=TRACKLIST_TIMEOUT)
+TRACKLIST_POLICY = RetryPolicy(attempts=3, backoff=0.5, timeout=TRACKLIST_TIMEOUT)
+SUGGEST_POLICY = RetryPolicy(attempts=3, backoff=0.25, timeout=SUGGEST_TIMEOUT)
+COVER_POLICY = RetryPolicy(attempts=1, backoff=0, timeout=COVER_TIMEOUT)
+
+# how long fetched lookups are trusted, then served stale for a while longer as they refresh in the background
+FETCH_TTL = int(os.environ.get("RESLEEVE_FETCH_TTL", 6 * 60 * 60))
+STALE_TTL = int(os.environ.get("RESLEEVE_STALE_TTL", 24 * 60 * 60))
+# failures are cached too: answers of "not there" for a while, anything else just long enough to stop a stampede
+MISSING_TTL = int(os.environ.get("RESLEEVE_MISSING_TTL", 30 * 60))
+FAILURE_TTL = int(os.environ.get("RESLEEVE_FAILURE_TTL", 30))
+MISSING_STATUSES = {400, 404}
+
+# MusicBrainz requests a second the app tries to stay under, every request spends it and prefetches only borrow
+# what is spare, keeping PREFETCH_RESERVE requests in hand for visitors
+MUSICBRAINZ_BUDGET = float(os.environ.get("RESLEEVE_MUSICBRAINZ_BUDGET", 1.0))
+MUSICBRAINZ_BURST = 5
+PREFETCH_RESERVE = 2
+
+# shared keep-alive client, pooled so every request it lets out at once can hold a connection
+client = HttpClient(headers=USER_AGENT, pool_maxsize=max(UPSTREAM_CONCURRENCY, MAX_COVER_WORKERS))
+client.set_budget(MUSICBRAINZ_HOST, MUSICBRAINZ_BUDGET, MUSICBRAINZ_BURST)
+
+# concurrent identical lookups share one upstream request, covers also across workers through the cover store
+search_flight = singleflight("search")
+suggest_flight = singleflight("suggest")
+tracklist_flight = singleflight("tracklist")
+cover_flight = singleflight("cover", across_workers=True)
+
+# optional offline index ( RESLEEVE_LOCAL_INDEX ), asked first for search and suggestions
+local_index = open_index()
 
 
 class CoverFetchError(Exception):
     """Raised when the cover art API cannot provide an image."""
 
 
+class CoverMissingError(CoverFetchError):
+    """Raised when the release has no front cover at all."""
+
+
 class TracklistFetchError(Exception):
     """Raised when the tracklist API cannot provide data."""
 
 
+class TracklistMissingError(TracklistFetchError):
+    """Raised when MusicBrainz has no release with the MBID."""
+
+
 class SearchAlbumsError(Exception):
     """Raised when album search fails entirely."""
 
 
+def _ask_local_index(method, *args):
+    # None on a miss or when the index is unavailable, the caller then goes to the network
+    if local_index is None:
+        return None
+    try:
+        return getattr(local_index, method)(*args) or None
+    except sqlite3.Error:
+        return None
+
+
 def search_albums(artist, album):
-    url = 'https://musicbrainz.org/ws/2/release'
-    for attempt in range(3):
-        try:
-            response = requests.get(
-                url,
-                headers=USER_AGENT,
-                params={
-                    "query": f"release:'{album}' AND artist:'{artist}'",
-                    "fmt": "json"
-                },
-                timeout=TRACKLIST_TIMEOUT,
-            )
-            if response.status_code == 200:
-                return response.json()
-            if 400 <= response.status_code < 500:
-                raise SearchAlbumsError
-        except RequestException as exc:
-            if attempt == 2:
-                raise SearchAlbumsError from exc
-        time.sleep(0.5 * (attempt + 1))
-    raise SearchAlbumsError
+    local = _ask_local_index("search_releases", artist, album)
+    if local is not None:
+        return local
+    return _search_albums_remote(artist, album)
+
+
+@search_flight
+def _search_albums_remote(artist, album):
+    url = f'{MUSICBRAINZ_URL}/ws/2/release'
+    try:
+        response = client.get(
+            url,
+            SEARCH_POLICY,
+            params={
+                "query": f"release:'{album}' AND artist:'{artist}'",
+                "fmt": "json"
+            },
+        )
+    except UpstreamError as exc:
+        raise SearchAlbumsError from exc
+    return response.json()
 
 
 def _unique_first(items):
@@ -82,128 +145,214 @@ def _unique_first(items):
     return results
 
 
-@lru_cache(maxsize=512)
+def _prefix_terms(query):
+    # "radio he" -> radio* AND he*, so a complete answer for a query also holds everything a longer one could match
+    return " AND ".join(f"{word}*" for word in words(query))
+
+
+def _suggest_query(field, query):
+    # wildcard matches all score the same, so the typed words as a phrase are boosted to rank an exact name first;
+    # a phrase match also matches every prefix term, so the set of names is still just the prefix matches
+    phrase = " ".join(words(query))
+    return f'({field}:"{phrase}"^2 OR {field}:({_prefix_terms(query)}))'
+
+
+def _suggestion_page(body, key):
+    # the names on one page of results, and whether that page was everything MusicBrainz matched
+    items = body.get(key, [])
+    return items, body.get("count", len(items)) <= len(items)
+
+
+@suggest_flight
 def _fetch_artist_suggestions(query):
-    url = 'https://musicbrainz.org/ws/2/artist'
-    for attempt in range(3):
-        try:
-            response = requests.get(
-                url,
-                headers=USER_AGENT,
-                params={
-                    "query": f'artist:"{query}"',
-                    "fmt": "json",
-                    "limit": SUGGEST_LIMIT,
-                },
-                timeout=SUGGEST_TIMEOUT,
-            )
-            if response.status_code == 200:
-                artists = response.json().get("artists", [])
-                names = [artist.get("name") for artist in artists]
-                return _unique_first(names)[:SUGGEST_LIMIT]
-            if 400 <= response.status_code < 500:
-                return []
-        except RequestException:
-            if attempt == 2:
-                return []
-        time.sleep(0.25 * (attempt + 1))
-    return []
-
-
-@lru_cache(maxsize=512)
+    url = f'{MUSICBRAINZ_URL}/ws/2/artist'
+    try:
+        response = client.get(
+            url,
+            SUGGEST_POLICY,
+            params={
+                "query": _suggest_query("artist", query),
+                "fmt": "json",
+                "limit": SUGGEST_LIMIT,
+            },
+        )
+    except UpstreamError:
+        return None
+    artists, complete = _suggestion_page(response.json(), "artists")
+    return _unique_first(artist.get("name") for artist in artists), complete
+
+
+@suggest_flight
 def _fetch_album_suggestions(artist, query):
-    url = 'https://musicbrainz.org/ws/2/release'
-    for attempt in range(3):
-        try:
-            response = requests.get(
-                url,
-                headers=USER_AGENT,
-                params={
-                    "query": f'release:"{query}" AND artist:"{artist}"',
-                    "fmt": "json",
-                    "limit": SUGGEST_LIMIT,
-                },
-                timeout=SUGGEST_TIMEOUT,
-            )
-            if response.status_code == 200:
-                releases = response.json().get("releases", [])
-                titles = [release.get("title") for release in releases]
-                return _unique_first(titles)[:SUGGEST_LIMIT]
-            if 400 <= response.status_code < 500:
-                return []
-        except RequestException:
-            if attempt == 2:
-                return []
-        time.sleep(0.25 * (attempt + 1))
-    return []
-
-
-def get_artist_suggestions(query):
-    if not query:
+    url = f'{MUSICBRAINZ_URL}/ws/2/release'
+    try:
+        response = client.get(
+            url,
+            SUGGEST_POLICY,
+            params={
+                "query": f'{_suggest_query("release", query)} AND artist:"{artist}"',
+                "fmt": "json",
+                "limit": SUGGEST_LIMIT,
+            },
+        )
+    except UpstreamError:
+        return None
+    releases, complete = _suggestion_page(response.json(), "releases")
+    return _unique_first(release.get("title") for release in releases), complete
+
+
+def _store_suggestions(scope, query, fetched):
+    if fetched is None:
+        # upstream failed, nothing worth caching
+        return []
+    names, complete = fetched
+    suggestion_cache.store(scope, query, names, complete)
+    return names[:SUGGEST_LIMIT]
+
+
+def _suggest(scope, query, fetch, *args, client_id=None):
+    # prefix cache first, then upstream once the client's previous request is back, unless a newer one overtook it
+    cached = suggestion_cache.lookup(scope, query)
+    if cached is not None:
+        return cached[:SUGGEST_LIMIT]
+    if client_id is None:
+        return _store_suggestions(scope, query, fetch(*args))
+    with keystroke_bursts.hold((client_id, scope[0])) as waited:
+        if waited is None:
+            return None
+        if waited:
+            # the request this one waited on may have cached a set that answers it
+            cached = suggestion_cache.lookup(scope, query)
+            if cached is not None:
+                return cached[:SUGGEST_LIMIT]
+        return _store_suggestions(scope, query, fetch(*args))
+
+
+def _local_suggestions(method, *args):
+    local = _ask_local_index(method, *args, SUGGEST_LIMIT)
+    if local is None:
+        return None
+    return _unique_first(local)[:SUGGEST_LIMIT]
+
+
+# These return None when a newer request from the same client made the answer moot
+def get_artist_suggestions(query, client_id=None):
+    if not words(query):
         return []
-    return _fetch_artist_suggestions(query)
+    local = _local_suggestions("artist_suggestions", query)
+    if local is not None:
+        return local
+    return _suggest(("artist",), query, _fetch_artist_suggestions, query, client_id=client_id)
 
 
-def get_album_suggestions(artist, query):
-    if not artist or not query:
+def get_album_suggestions(artist, query, client_id=None):
+    if not artist or not words(query):
         return []
-    return _fetch_album_suggestions(artist, query)
+    local = _local_suggestions("album_suggestions", artist, query)
+    if local is not None:
+        return local
+    scope = ("album", normalise(artist))
+    return _suggest(scope, query, _fetch_album_suggestions, artist, query, client_id=client_id)
 
 # Get detailed tracklist and album info using MBID
-@lru_cache(maxsize=256)
-def _fetch_tracklist_json(mbid):
-    url = f'https://musicbrainz.org/ws/2/release/{mbid}'
-    for attempt in range(3):
-        try:
-            response = requests.get(
-                url,
-                headers=USER_AGENT,
-                params={
-                    "fmt": "json",
-                    "inc": "recordings"
-                },
-                timeout=TRACKLIST_TIMEOUT
-            )
-            if response.status_code == 200:
-                return response.json()
-            if 400 <= response.status_code < 500:
-                raise TracklistFetchError
-        except RequestException as exc:
-            if attempt == 2:
-                raise TracklistFetchError from exc
-        time.sleep(0.5 * (attempt + 1))
-    raise TracklistFetchError
-
-
-def get_tracklist(mbid):
+def _lookup_release(mbid):
+    url = f'{MUSICBRAINZ_URL}/ws/2/release/{mbid}'
+    try:
+        response = client.get(
+            url,
+            TRACKLIST_POLICY,
+            params={
+                "fmt": "json",
+                # artist credits and the release group let a lookup stand in for the search result too
+                "inc": "artist-credits recordings release-groups"
+            },
+        )
+    except UpstreamError as exc:
+        if exc.status in MISSING_STATUSES:
+            raise TracklistMissingError from exc
+        raise TracklistFetchError from exc
+    return response.json()
+
+
+# cached as a compact Release ( see releases.py ) rather than the whole lookup
+@ttl_cache(
+    maxsize=256,
+    ttl=FETCH_TTL,
+    stale_ttl=STALE_TTL,
+    negative={TracklistMissingError: MISSING_TTL, TracklistFetchError: FAILURE_TTL},
+)
+@tracklist_flight
+def _fetch_tracklist(mbid):
+    return project_release(_lookup_release(mbid))
+
+
+# None when MusicBrainz has no such release, and when the lookup failed unless strict, which raises TracklistFetchError then
+def get_tracklist(mbid, strict=False):
     if not mbid:
         return None
     try:
-        return _fetch_tracklist_json(mbid)
+        return _fetch_tracklist(mbid)
+    except TracklistMissingError:
+        return None
     except TracklistFetchError:
+        if strict:
+            raise
         return None
 
-# Get album cover art as base64 encoded string
-@lru_cache(maxsize=256)
-def _fetch_cover_data(mbid):
-    cover_url = f"https://coverartarchive.org/release/{mbid}/front"
+
+# warms the tracklist cache, False when it would have meant a MusicBrainz request the budget had no room for
+def prefetch_tracklist(mbid):
+    if _fetch_tracklist.cached(mbid):
+        return True
+    if not client.has_spare(MUSICBRAINZ_HOST, PREFETCH_RESERVE):
+        return False
+    get_tracklist(mbid)
+    return True
+
+# Get the album cover as raw bytes and content type
+@ttl_cache(
+    maxsize=256,
+    ttl=FETCH_TTL,
+    stale_ttl=STALE_TTL,
+    negative={CoverMissingError: MISSING_TTL, CoverFetchError: FAILURE_TTL},
+)
+@cover_flight
+def _fetch_cover(mbid):
+    # the shared on-disk store is checked before going upstream
+    stored = cover_store.get(mbid)
+    if stored is not None:
+        return Cover(*stored)
+    cover_url = f"{COVER_ART_URL}/release/{mbid}/front"
     try:
-        response = requests.get(cover_url, headers=USER_AGENT, timeout=COVER_TIMEOUT)
-    except RequestException as exc:
+        response = client.get(cover_url, COVER_POLICY)
+    except UpstreamError as exc:
+        if exc.status in MISSING_STATUSES:
+            raise CoverMissingError from exc
         raise CoverFetchError from exc
-    if response.status_code == 200:
-        b64_image = base64.b64encode(response.content).decode('utf-8')
-        content_type = response.headers.get('content-type', 'image/jpeg')
-        return f"data:{content_type};base64,{b64_image}"
-    raise CoverFetchError
+    image_bytes = response.content
+    content_type = response.headers.get('content-type', 'image/jpeg')
+    cover_store.put(mbid, image_bytes, content_type)
+    return Cover(image_bytes, content_type)
+
 
+def flight_stats():
+    return {
+        flight.name: flight.stats()
+        for flight in (search_flight, suggest_flight, tracklist_flight, cover_flight)
+    }
 
-def get_album_cover(mbid):
+
+# None when the release has no cover, and when fetching it failed unless strict, which raises CoverFetchError then
+def get_album_cover(mbid, strict=False):
     if not mbid:
         return None
     try:
-        return _fetch_cover_data(mbid)
+        return _fetch_cover(mbid)
+    except CoverMissingError:
+        return None
     except CoverFetchError:
+        if strict:
+            raise
         return None
 
 # print(search_albums("Bring me the horizon","Post Human: Survival Horror").json())
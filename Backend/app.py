@@ -1,30 +1,80 @@
-from flask import Flask, render_template, request, jsonify
+from flask import (
+    Flask,
+    Response,
+    abort,
+    g,
+    render_template,
+    request,
+    jsonify,
+    redirect,
+    stream_with_context,
+    url_for,
+)
 from api_testing import (
     search_albums,
     get_tracklist,
     get_album_cover,
+    CoverFetchError,
+    TracklistFetchError,
+    FAILURE_TTL,
     SearchAlbumsError,
     get_artist_suggestions,
     get_album_suggestions,
+    MAX_COVER_WORKERS,
+    client as upstream_client,
+    flight_stats,
+    local_index,
+    prefetch_tracklist,
+)
+from palette_cache import palette_cache
+from prefetch import PREFETCH_TOP_N, prefetcher
+from context_store import album_contexts
+from page_cache import page_cache, page_key
+from suggestions import keystroke_bursts, suggestion_cache
+from ttl_cache import fetch_cache_stats
+from metrics import registry, stage_seconds
+from offload import offloaded
+from compression import init_compression, send_precompressed
+from covers import Cover
+from releases import parse_release
+from fonts import (
+    FONT_DIR,
+    FONT_FILES,
+    FONT_MAX_AGE,
+    FONT_MIMETYPES,
+    export_font_css,
+    font_paths,
+    font_version,
+    subset_store,
 )
+from thumbnails import COVER_FORMATS, COVER_SIZES, get_cover_variant
+from cover_store import CACHE_DIR, CoverStore, cover_store
+from wallpaper_renderer import RENDERER_VERSION, WallpaperRenderError, render_wallpaper
 
 # from pprintpp import pprint
-import io
+import re
 import base64
+import gzip
+import hashlib
+import json
+import struct
+import zlib
 from barcode import UPCA, EAN13
-from barcode.writer import ImageWriter
 import numpy as np
-import ast
-from matplotlib.colors import rgb_to_hsv
-from collections import Counter
-from functools import wraps
-import time
-from PIL import Image
-from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from PIL import Image, ImageColor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import os
 import concurrent.futures
+import threading
+import uuid
+from collections import namedtuple
 from pathlib import Path
 
 app = Flask(__name__, template_folder="../templates", static_folder="../static")
+# compresses responses on the way out and serves static files from precompressed siblings
+init_compression(app)
 app.secret_key = "Testing123!"
 
 DEFAULT_COLOURS = ["#ffffff", "#d4d4d4", "#a0a0a0", "#6c6c6c", "#2c2c2c"]
@@ -35,43 +85,61 @@ DEFAULT_DARK_CONTAINER_COLOUR = "#00010A"
 DEFAULT_DARK_PHONE_BODY_COLOUR = "#080914"
 DEFAULT_DARK_PHONE_CONTAINER_COLOUR = "#080914"
 TRANSPARENT_PIXEL = "data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR42mP8Xw8AAn8B9SClSxIAAAAASUVORK5CYII="
-MAX_COVER_WORKERS = 10
 MAX_RELEASE_RESULTS = 18
-FONT_REGULAR_TTF = None
-FONT_REGULAR_WOFF = None
-FONT_REGULAR_WOFF2 = None
-FONT_BOLD_TTF = None
-FONT_BOLD_WOFF = None
-FONT_BOLD_WOFF2 = None
+# barcode geometry in mm, matching the python-barcode options the templates were designed around
+BARCODE_DPI = 300
+BARCODE_MODULE_WIDTH = 0.26
+BARCODE_MODULE_HEIGHT = 7.0
+BARCODE_MARGIN = 1.0
+BARCODE_CACHE_SIZE = 256
+# UPC-A takes 12 digits and EAN-13 12 or 13 ( the check digit is worked out again ), nothing else can be drawn
+BARCODE_PATTERN = re.compile(r"^[0-9]{12,13}$")
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+SEARCH_ERROR_MESSAGE = "Could not reach MusicBrainz. Please try again in a moment."
+MBID_PATTERN = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$")
+COVER_MAX_AGE = 60 * 60 * 24 * 365
+# server side wallpaper rendering
+RENDER_WORKERS = int(os.environ.get("RESLEEVE_RENDER_WORKERS", 2))
+RENDER_TIMEOUT = 60
+WALLPAPER_MAX_AGE = 60 * 60 * 24
+WALLPAPER_STORE_MAX_BYTES = int(os.environ.get("RESLEEVE_WALLPAPER_STORE_BYTES", 256 * 1024 * 1024))
+
+wallpaper_store = CoverStore(CACHE_DIR / "wallpapers", WALLPAPER_STORE_MAX_BYTES)
+_render_pool = None
+_render_pool_lock = threading.Lock()
+# one deadline, in seconds, for everything a picked album needs before the page is rendered without it
+ALBUM_CONTEXT_DEADLINE = float(os.environ.get("RESLEEVE_ALBUM_CONTEXT_DEADLINE", 8))
+ALBUM_CONTEXT_WORKERS = 12
+
+# everything the album pages need, filled with defaults for any part that missed the deadline or failed
+AlbumContext = namedtuple(
+    "AlbumContext", ["cover", "colours", "tracklist", "release_length", "barcode_src", "missed", "failed"]
+)
+album_context_fallbacks = registry.counter(
+    "resleeve_album_context_fallbacks_total",
+    "Album context parts replaced by defaults, because they timed out, raised or were invalid.",
+    ["part", "reason"],
+)
+album_context_executor = ThreadPoolExecutor(max_workers=ALBUM_CONTEXT_WORKERS, thread_name_prefix="album-context")
 
 
-def _encode_font(name):
-    font_path = Path(app.static_folder or "").joinpath("fonts", name)
-    try:
-        with open(font_path, "rb") as font_file:
-            return base64.b64encode(font_file.read()).decode("ascii")
-    except OSError:
-        return None
+# One visit, from the id its forms and scripts send back: its keystrokes coalesce and its prefetches replace each other,
+# never anyone else's behind the same address. None when the request carried no id
+def sent_page_id():
+    sent = request.headers.get("X-Resleeve-Page") or request.values.get("page_id") or ""
+    return sent[:64] or None
 
 
-def load_font_data():
-    global FONT_REGULAR_TTF, FONT_REGULAR_WOFF, FONT_REGULAR_WOFF2
-    global FONT_BOLD_TTF, FONT_BOLD_WOFF, FONT_BOLD_WOFF2
-    if FONT_REGULAR_TTF is None:
-        FONT_REGULAR_TTF = _encode_font("DejaVuSans.ttf")
-    if FONT_REGULAR_WOFF is None:
-        FONT_REGULAR_WOFF = _encode_font("DejaVuSans.woff")
-    if FONT_REGULAR_WOFF2 is None:
-        FONT_REGULAR_WOFF2 = _encode_font("DejaVuSans.woff2")
-    if FONT_BOLD_TTF is None:
-        FONT_BOLD_TTF = _encode_font("DejaVuSans-Bold.ttf")
-    if FONT_BOLD_WOFF is None:
-        FONT_BOLD_WOFF = _encode_font("DejaVuSans-Bold.woff")
-    if FONT_BOLD_WOFF2 is None:
-        FONT_BOLD_WOFF2 = _encode_font("DejaVuSans-Bold.woff2")
+# the id sent with the request, or a new one for a first visit, which the rendered page passes on
+def page_id():
+    if "page_id" not in g:
+        g.page_id = sent_page_id() or uuid.uuid4().hex
+    return g.page_id
 
 
-load_font_data()
+@app.context_processor
+def page_id_context():
+    return {"page_id": page_id()}
 
 
 @app.route("/api/suggest/artist")
@@ -79,7 +147,8 @@ def suggest_artist():
     query = request.args.get("query", "").strip()
     if len(query) < 2:
         return jsonify([])
-    return jsonify(get_artist_suggestions(query))
+    names = get_artist_suggestions(query, client_id=sent_page_id())
+    return jsonify(names) if names is not None else ("", 204)
 
 
 @app.route("/api/suggest/album")
@@ -88,31 +157,277 @@ def suggest_album():
     query = request.args.get("query", "").strip()
     if len(artist) < 2 or len(query) < 1:
         return jsonify([])
-    return jsonify(get_album_suggestions(artist, query))
+    names = get_album_suggestions(artist, query, client_id=sent_page_id())
+    return jsonify(names) if names is not None else ("", 204)
+
+
+# Hit and miss counts of every cache, read from their own counters when /metrics is scraped
+def cache_counts():
+    counts = {
+        "cover_store": cover_store.stats(),
+        "wallpaper_store": wallpaper_store.stats(),
+        "font_subset_store": subset_store.stats(),
+        "palette": palette_cache.stats(),
+        "album_contexts": album_contexts.stats(),
+        "pages": page_cache.stats(),
+    }
+    for name, fetch_cache in fetch_cache_stats().items():
+        counts[name.lstrip("_")] = {
+            "hits": fetch_cache["hits"] + fetch_cache["stale_hits"] + fetch_cache["negative_hits"],
+            "misses": fetch_cache["misses"],
+        }
+    suggestions = suggestion_cache.stats()
+    counts["suggestions"] = {"hits": suggestions["hits"] + suggestions["prefix_hits"], "misses": suggestions["misses"]}
+    return counts
 
 
-def timeProgram(func):
-    @wraps(func)
-    def timeProgramWrapper(*args, **kwargs):
-        startTime = time.perf_counter()
-        result = func(*args, **kwargs)
-        endTime = time.perf_counter()
-        totalTime = endTime - startTime
-        print(f"Function {func.__name__} Took {totalTime:.4f} seconds.")
-        return result
+registry.collect(
+    "resleeve_cache_hits_total", "Cache lookups answered from the cache.", "counter", ["cache"],
+    lambda: {(name,): counts["hits"] for name, counts in cache_counts().items()},
+)
+registry.collect(
+    "resleeve_cache_misses_total", "Cache lookups that had to build or fetch the entry.", "counter", ["cache"],
+    lambda: {(name,): counts["misses"] for name, counts in cache_counts().items()},
+)
+
+
+# Prometheus scrape endpoint, nothing is formatted until it is asked for
+@app.route("/metrics")
+def metrics():
+    return Response(registry.render(), mimetype="text/plain; version=0.0.4")
+
+
+# Cache and upstream connection counters for this worker
+@app.route("/api/stats")
+def stats():
+    return jsonify(
+        {
+            "upstream": upstream_client.stats(),
+            "single_flight": flight_stats(),
+            "fetch_caches": fetch_cache_stats(),
+            "local_index": local_index.stats() if local_index is not None else None,
+            "cover_store": cover_store.stats(),
+            "palette_cache": palette_cache.stats(),
+            "album_contexts": album_contexts.stats(),
+            "page_cache": page_cache.stats(),
+            "suggestions": {**suggestion_cache.stats(), **keystroke_bursts.stats()},
+            "prefetch": prefetcher.stats(),
+        }
+    )
+
+
+# Serves a sized cover variant, generated once and then cached on disk and in the browser
+@app.route("/cover/<mbid>/<size>")
+def cover(mbid, size):
+    if size not in COVER_SIZES or not MBID_PATTERN.match(mbid):
+        abort(404)
+    cover_format = request.args.get("format")
+    if cover_format not in COVER_FORMATS:
+        accepted = [value for value, _quality in request.accept_mimetypes]
+        cover_format = "webp" if "image/webp" in accepted else "jpeg"
+    variant = get_cover_variant(mbid, size, cover_format, get_album_cover)
+    if variant is None:
+        abort(404)
+    image_bytes, content_type = variant
+    response = Response(image_bytes, mimetype=content_type)
+    response.set_etag(hashlib.sha1(image_bytes).hexdigest())
+    response.cache_control.public = True
+    response.cache_control.max_age = COVER_MAX_AGE
+    response.cache_control.immutable = True
+    response.vary.add("Accept")
+    return response.make_conditional(request)
+
+
+# Streams a search as newline delimited JSON: the release metadata as soon as MusicBrainz answers, then one line per
+# cover as it arrives ( null when the release has none ), then a final count
+@app.route("/api/search/stream")
+def search_stream():
+    artist = request.args.get("artist", "").strip()
+    album = request.args.get("album", "").strip()
+    if not artist or not album:
+        abort(400)
+
+    def lines():
+        try:
+            album_list = search_albums(artist, album)
+        except SearchAlbumsError:
+            yield json.dumps({"type": "error", "message": SEARCH_ERROR_MESSAGE}) + "\n"
+            return
+        releases_data = parse_releases(album_list)
+        yield json.dumps({"type": "releases", "releases": releases_data}) + "\n"
+        with_cover = set()
+        for mbid, cover_image in iter_covers(releases_data):
+            cover_url = None
+            if cover_image:
+                cover_url = url_for("cover", mbid=mbid, size="thumb")
+                with_cover.add(mbid)
+            yield json.dumps({"type": "cover", "mbid": mbid, "cover": cover_url}) + "\n"
+        yield json.dumps({"type": "done", "found": len(with_cover)}) + "\n"
+        # the page only shows releases with a cover
+        schedule_prefetch([release["MBID"] for release in releases_data if release["MBID"] in with_cover])
+
+    response = Response(stream_with_context(lines()), mimetype="application/x-ndjson")
+    response.cache_control.no_store = True
+    # keeps reverse proxies from buffering the stream into one response
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
+# Serves a wallpaper font, the version in the URL changes with the file so it can be cached forever
+@app.route("/fonts/<version>/<filename>")
+def font_file(version, filename):
+    if filename not in FONT_FILES.values():
+        abort(404)
+    current = font_version(filename)
+    if current is None:
+        abort(404)
+    if version != current:
+        # a page from before the font changed, or a made up version: point at the current file, which may be kept
+        return redirect(url_for("font_file", version=current, filename=filename))
+    response = send_precompressed(
+        FONT_DIR,
+        filename,
+        mimetype=FONT_MIMETYPES[Path(filename).suffix],
+        max_age=FONT_MAX_AGE,
+    )
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+def font_urls():
+    return {
+        key: url_for("font_file", version=version, filename=filename)
+        for key, filename, version in font_paths()
+    }
 
-    return timeProgramWrapper
+
+def render_pool(broken=None):
+    # rendering is CPU bound, so it runs in its own processes; a pool that lost a worker is replaced
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is None or _render_pool is broken:
+            _render_pool = ProcessPoolExecutor(max_workers=RENDER_WORKERS)
+        return _render_pool
+
+
+def wallpaper_key(mbid, device, template_type, backgrounds):
+    return f"wallpaper/v{RENDERER_VERSION}/{mbid}/{device}-{template_type}-{'-'.join(backgrounds['fill'])}"
+
+
+# gathers everything render_wallpaper() needs for one album, None when MusicBrainz has no such release
+def wallpaper_spec(mbid, device, template_type, backgrounds):
+    # a MusicBrainz failure raises TracklistFetchError, only a release it does not have comes back as None
+    release_data = get_tracklist(mbid, strict=True)
+    if release_data is None:
+        return None
+    release = release_data.details()
+    # parts drawn from a default because fetching them failed for now, the render is not kept when there are any
+    fallbacks = []
+    try:
+        cover = get_album_cover(mbid, strict=True)
+    except CoverFetchError:
+        cover = None
+        fallbacks.append("cover")
+    tracklist, release_length = createTracklist(release_data.tracks)
+    barcode_src = release_barcode_src(
+        release["Barcode"] or "794558113229", template_type, backgrounds["barcode_background"]
+    )
+    container = backgrounds["container_background"]
+    return {
+        "device": device,
+        "template": template_type,
+        "cover": cover.data if cover is not None else None,
+        "artist": release["Artist"],
+        "album": release["Title"],
+        "date": release["Date"],
+        "country": release["Country"],
+        "track_count": release["Track Count"],
+        "format": release["Format"],
+        "type": release["Release Type"],
+        "run_time": ms_to_min_sec(release_length),
+        "tracklist": tracklist,
+        "colours": album_palette(mbid, cover),
+        "barcode": base64.b64decode(barcode_src.split(",", 1)[1]),
+        "fill": backgrounds["fill"],
+        "container": None if container == "transparent" else container,
+        "fallbacks": tuple(fallbacks),
+    }
+
+
+# Renders the finished wallpaper as a PNG on the server, same layouts as the templates' download button
+@app.route("/api/wallpaper/<mbid>.png")
+def wallpaper_png(mbid):
+    if not MBID_PATTERN.match(mbid):
+        abort(404)
+    device = request.args.get("device", "desktop")
+    template_type = request.args.get("template", "white")
+    if device not in {"desktop", "phone"} or template_type not in {"white", "dark"}:
+        abort(400)
+    background_choice = request.args.get("background", "default")
+    custom_background_raw = request.args.get("custom", "")
+    # a colour can also be passed straight in as the background
+    if background_choice not in {"default", "custom", "gradient"} and sanitize_hex_color(background_choice):
+        background_choice, custom_background_raw = "custom", background_choice
+    backgrounds = wallpaper_background(
+        device,
+        template_type,
+        background_choice,
+        custom_background_raw,
+        request.args.get("gradient_start", ""),
+        request.args.get("gradient_end", ""),
+    )
+
+    store_key = wallpaper_key(mbid, device, template_type, backgrounds)
+    stored = wallpaper_store.get(store_key)
+    fallbacks = ()
+    if stored is not None:
+        image_bytes = stored[0]
+    else:
+        try:
+            spec = wallpaper_spec(mbid, device, template_type, backgrounds)
+        except TracklistFetchError:
+            # MusicBrainz is failing for now, worth asking again once the cached failure has expired
+            unavailable = Response(status=503)
+            unavailable.headers["Retry-After"] = str(FAILURE_TTL)
+            abort(unavailable)
+        if spec is None:
+            abort(404)
+        pool = render_pool()
+        try:
+            with stage_seconds.time("wallpaper"):
+                image_bytes = pool.submit(render_wallpaper, spec).result(timeout=RENDER_TIMEOUT)
+        except BrokenProcessPool:
+            render_pool(broken=pool)
+            abort(503)
+        except (WallpaperRenderError, concurrent.futures.TimeoutError):
+            abort(503)
+        fallbacks = spec["fallbacks"]
+        if not fallbacks:
+            wallpaper_store.put(store_key, image_bytes, "image/png")
+
+    response = Response(image_bytes, mimetype="image/png")
+    response.set_etag(hashlib.sha1(image_bytes).hexdigest())
+    if fallbacks:
+        # drawn around a default for a part that failed, the next request should try again
+        response.cache_control.no_store = True
+    else:
+        response.cache_control.public = True
+        response.cache_control.max_age = WALLPAPER_MAX_AGE
+    return response.make_conditional(request)
 
 
-@timeProgram
 def fetch_single_cover(mbid):
     # Fetches a single album cover as opposed to multiple like the usual function
     try:
-        return mbid, get_album_cover(mbid)
+        cover = get_album_cover(mbid)
     except Exception:
         return mbid, None
+    if cover is not None:
+        # start on the palette now so selecting this release does not pay for it
+        palette_cache.warm(palette_key(mbid), lambda: colourExtractor(cover))
+    return mbid, cover
 
-@timeProgram
 def hex_to_rgb(hex_color: str):
     if hex_color != "default":
         hex_color = hex_color.lstrip("#")  # remove '#' if present
@@ -129,73 +444,130 @@ def hex_to_rgb(hex_color: str):
 
         return (r, g, b)
     return None
-# Creates a List of the Album Options based on the users search query.
-@timeProgram
-def createList(album_list):
-    # First pass: collect all release data without cover art
-    releases_data = []
-    releases = album_list.get("releases", [])[:MAX_RELEASE_RESULTS]
 
-    for release in releases:
-        # Set the variables based on the information in the JSON
-        artist = release["artist-credit"][0]["name"]
-        # Country can be found in two places
-        country = release.get("country")
-        # If not found above, then look for it in the other place
-        if not country and "release-events" in release:
-            for event in release["release-events"]:
-                # Check release events
-                if "area" in event and "iso-3166-1-codes" in event["area"]:
-                    country = event["area"]["iso-3166-1-codes"][0]
-                    break
-        # Get other variables
-        mbid = release["id"]
-        track_count = release["track-count"]
-        title = release["title"]
-        # Some entries don't have these variables - make sure they do not raise a ValueError if they do not exist
-        try:
-            barcode = release["barcode"]
-        except Exception:
-            barcode = "794558113229"
-        try:
-            format = release["media"][0]["format"]
-        except Exception:
-            format = None
-        release_type = release.get("release-group", {}).get("primary-type")
-        # The date variable can be found in two different places - so check both
-        date = release.get("date")
-        if date is None:
-            date = release.get("release-events", [{}])[0].get("date")
-
-        # Create the dictionary of all of the album data
-        releases_data.append(
-            {
-                "Artist": artist,
-                "Title": title,
-                "Country": country,
-                "Track Count": track_count,
-                "MBID": mbid,
-                "Format": format,
-                "Release Type": release_type,
-                "Date": date,
-                "Barcode": barcode,
-            }
+
+# normalises user input to a lowercase #rrggbb colour, None if it is not a valid hex colour
+def sanitize_hex_color(value):
+    if not value:
+        return None
+    value = value.strip()
+    if not value:
+        return None
+    if not value.startswith("#"):
+        value = f"#{value}"
+    hex_part = value[1:]
+    if len(hex_part) == 3:
+        if not all(c in "0123456789abcdefABCDEF" for c in hex_part):
+            return None
+        hex_part = "".join(c * 2 for c in hex_part.lower())
+    elif len(hex_part) == 6:
+        if not all(c in "0123456789abcdefABCDEF" for c in hex_part):
+            return None
+        hex_part = hex_part.lower()
+    else:
+        return None
+    return f"#{hex_part}"
+
+
+# works out the page, container and barcode backgrounds for a wallpaper
+# "fill" is what the exported image is painted with: one colour, or the two ends of the gradient
+def wallpaper_background(device, template, choice, custom_raw="", gradient_start_raw="", gradient_end_raw=""):
+    if device == "phone":
+        if template == "dark":
+            default_body_background = DEFAULT_DARK_PHONE_BODY_COLOUR
+            default_container_background = DEFAULT_DARK_PHONE_CONTAINER_COLOUR
+        else:
+            default_body_background = DEFAULT_LIGHT_BODY_COLOUR
+            default_container_background = DEFAULT_LIGHT_CONTAINER_COLOUR
+    else:
+        if template == "dark":
+            default_body_background = DEFAULT_DARK_BODY_COLOUR
+            default_container_background = DEFAULT_DARK_CONTAINER_COLOUR
+        else:
+            default_body_background = DEFAULT_LIGHT_BODY_COLOUR
+            default_container_background = DEFAULT_LIGHT_CONTAINER_COLOUR
+
+    backgrounds = {
+        "background": "default",
+        "body_background": default_body_background,
+        "container_background": default_container_background,
+        "barcode_background": None,
+        "fill": (default_body_background,),
+    }
+
+    if choice == "gradient":
+        start_color = sanitize_hex_color(gradient_start_raw) or "#FFFAEC"
+        end_color = sanitize_hex_color(gradient_end_raw) or "#FF11AA"
+        backgrounds.update(
+            background="gradient",
+            body_background=f"linear-gradient(45deg, {start_color}, {end_color})",
+            container_background="transparent",
+            barcode_background="transparent",
+            fill=(start_color, end_color),
         )
+    elif choice == "custom":
+        custom_color = sanitize_hex_color(custom_raw)
+        if custom_color:
+            backgrounds.update(
+                background=custom_color,
+                body_background=custom_color,
+                container_background=custom_color,
+                barcode_background=hex_to_rgb(custom_color),
+                fill=(custom_color,),
+            )
+    return backgrounds
 
-    # Second pass: fetch all covers concurrently
-    cover_results = {}
-    with ThreadPoolExecutor(max_workers=MAX_COVER_WORKERS) as executor:
-        # Submit all cover art requests
-        future_to_mbid = {
-            executor.submit(fetch_single_cover, release["MBID"]): release
-            for release in releases_data
-        }
 
+# First pass: collect all release data without cover art
+def parse_releases(album_list):
+    releases = album_list.get("releases", [])[:MAX_RELEASE_RESULTS]
+    return [parse_release(release) for release in releases]
+
+
+# Second pass: fetch all covers concurrently, yielding ( mbid, cover ) as each one arrives
+def iter_covers(releases_data):
+    executor = ThreadPoolExecutor(max_workers=MAX_COVER_WORKERS)
+    try:
+        # Submit all cover art requests
+        futures = [executor.submit(fetch_single_cover, release["MBID"]) for release in releases_data]
         # Collect results as they complete
-        for future in concurrent.futures.as_completed(future_to_mbid):
-            mbid, cover_image = future.result()
-            cover_results[mbid] = cover_image
+        for future in concurrent.futures.as_completed(futures):
+            yield future.result()
+    finally:
+        # a closed stream stops waiting, covers already being fetched still finish into the caches
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+# warms what picking a release needs, False when its tracklist had to wait for room in the MusicBrainz budget
+def prefetch_release(mbid):
+    if not prefetch_tracklist(mbid):
+        return False
+    # the search fetched the cover already, so this is a cache hit
+    cover = get_album_cover(mbid)
+    if cover is not None:
+        palette_cache.warm(palette_key(mbid), lambda: colourExtractor(cover))
+    return True
+
+
+# once results are on screen the first few are warmed in the background, in case the visitor picks one of them
+def schedule_prefetch(mbids):
+    prefetcher.schedule(
+        page_id(), [lambda mbid=mbid: prefetch_release(mbid) for mbid in mbids[:PREFETCH_TOP_N]]
+    )
+
+
+def release_mbids(parsed_releases):
+    return [release["MBID"] for _position, release in sorted(parsed_releases.items())]
+
 
+# Creates a List of the Album Options based on the users search query.
+@stage_seconds.timed("release_list")
+def createList(album_list):
+    releases_data = parse_releases(album_list)
+    return release_tiles(releases_data, dict(iter_covers(releases_data)))
+
+
+def release_tiles(releases_data, cover_results):
     # Third pass: build final dictionary with covers, only including releases with cover art
     parsed_releases = {}
     count = 1
@@ -206,66 +578,117 @@ def createList(album_list):
         # get the cover image
         cover_image = cover_results.get(mbid)
 
-        # if the cover image exists
+        # if the cover image exists, link the small variant rather than inlining the image
         if cover_image:
-            release["Cover Image"] = cover_image
+            release["Cover Image"] = url_for("cover", mbid=mbid, size="thumb")
             parsed_releases[count] = release
             count += 1
 
     return parsed_releases
 
 
+def _mm2px(mm):
+    return (mm * BARCODE_DPI) / 25.4
+
+
+def _ink(colour, mode):
+    if isinstance(colour, str):
+        return ImageColor.getcolor(colour, mode)
+    if mode == "RGBA" and len(colour) == 3:
+        return (*colour, 255)
+    return tuple(colour)
+
+
+def _png_chunk(kind, data):
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+
+# rasterises the bars at exactly the pixels python-barcode's ImageWriter would paint, written straight out as a
+# two colour ( 1 bit, indexed ) PNG: index 0 is the background, index 1 the bars
+def _barcode_png(modules, foreground, background, mode):
+    width = int(_mm2px(len(modules) * BARCODE_MODULE_WIDTH))
+    height = int(_mm2px(2 * BARCODE_MARGIN + BARCODE_MODULE_HEIGHT))
+    top = int(_mm2px(BARCODE_MARGIN))
+    bottom = int(_mm2px(BARCODE_MARGIN + BARCODE_MODULE_HEIGHT))
+
+    bars = np.zeros(width, dtype=bool)
+    xpos = 0.0
+    for run in re.finditer(r"1+|0+", modules):
+        run_width = BARCODE_MODULE_WIDTH * len(run.group())
+        if run.group()[0] == "1":
+            bars[int(_mm2px(xpos)) : int(_mm2px(xpos + run_width) - 1) + 1] = True
+        xpos += run_width
+
+    # every scanline starts with filter type 0, and only two distinct scanlines exist
+    blank_row = b"\x00" + bytes((width + 7) // 8)
+    bar_row = b"\x00" + np.packbits(bars).tobytes()
+    bar_rows = bottom + 1 - top
+    scanlines = blank_row * top + bar_row * bar_rows + blank_row * (height - top - bar_rows)
+
+    background = _ink(background, mode)
+    foreground = _ink(foreground, mode)
+    chunks = [
+        _png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 1, 3, 0, 0, 0)),
+        _png_chunk(b"PLTE", bytes(background[:3] + foreground[:3])),
+    ]
+    if mode == "RGBA":
+        chunks.append(_png_chunk(b"tRNS", bytes((background[3], foreground[3]))))
+    chunks.append(_png_chunk(b"IDAT", zlib.compress(scanlines)))
+    chunks.append(_png_chunk(b"IEND", b""))
+    return PNG_SIGNATURE + b"".join(chunks)
+
+
 # change the barcode string into an actual barcode
-@timeProgram
+@lru_cache(maxsize=BARCODE_CACHE_SIZE)
+@offloaded
+@stage_seconds.timed("barcode")
 def barcode_data_uri(code: str, type, background) -> str:
-    # format it correctly ( adds a leading 0 )
+    # format it correctly ( adds a leading 0 ), building also validates the code
     fmt = UPCA if len(code) == 12 else EAN13
+    modules = fmt(code).build()[0]
     transparent_requested = background == "transparent"
-    writer_mode = "RGBA" if transparent_requested else "RGB"
-    writer = ImageWriter(mode=writer_mode)
-    # customisation options for the final output image
-    opts = {
-        "write_text": False,  # ← bars only, no numbers
-        "quiet_zone": 0.0,  # minimal side margins
-        "module_width": 0.26,  # tweak thickness if needed
-        "module_height": 7.0,  # tall; we'll fit it with CSS
-        "dpi": 300,
-    }
+    mode = "RGBA" if transparent_requested else "RGB"
     if type == "white":
         default_background = (255, 250, 236)
+        foreground = "black"
     else:
         default_background = (0, 1, 10)
-        opts["foreground"] = (255, 255, 255)
+        foreground = (255, 255, 255)
 
     if transparent_requested:
-        opts["background"] = (0, 0, 0, 0)
-    elif background is not None:
-        opts["background"] = background
-    else:
-        opts["background"] = default_background
+        background = (0, 0, 0, 0)
+    elif background is None:
+        background = default_background
 
     # encodes the image to a base64 string
-    buf = io.BytesIO()
-    fmt(code, writer=writer).write(buf, opts)
-    b64 = base64.b64encode(buf.getvalue()).decode("ascii")
+    b64 = base64.b64encode(_barcode_png(modules, foreground, background, mode)).decode("ascii")
     return f"data:image/png;base64,{b64}"
 
 
+# whether barcode_data_uri can draw the code at all
+def barcode_encodable(code):
+    return bool(code) and BARCODE_PATTERN.match(code) is not None
+
+
+# the barcode image, or the transparent pixel for a code that cannot be drawn ( which will never change )
+def release_barcode_src(code, type, background):
+    if not barcode_encodable(code):
+        return TRANSPARENT_PIXEL
+    return barcode_data_uri(code, type, background)
+
+
 # extracts the 5 most prominent colours from the album cover
-@timeProgram
-def colourExtractor(data_uri, k_out=5, k_quant=48, max_side=300):
-    if not data_uri or "," not in data_uri:
+@offloaded
+@stage_seconds.timed("palette")
+def colourExtractor(cover, k_out=5, k_quant=48, max_side=300):
+    if cover is None:
         return DEFAULT_COLOURS[:k_out]
 
     try:
-        b64 = data_uri.split(",", 1)[1]
-        img = Image.open(io.BytesIO(base64.b64decode(b64))).convert("RGB")
+        img = cover.image(max_side)
     except Exception:
         return DEFAULT_COLOURS[:k_out]
 
-    if max(img.size) > max_side:
-        img.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
-
     # quantize to reduce unique colours (stable & fast)
     q = img.quantize(colors=k_quant, method=Image.Quantize.MEDIANCUT)
 
@@ -275,74 +698,106 @@ def colourExtractor(data_uri, k_out=5, k_quant=48, max_side=300):
         return DEFAULT_COLOURS[:k_out]
 
     pal = pal[: k_quant * 3]  # take first k_quant colours (RGB triplets)
-    palette = [tuple(pal[i : i + 3]) for i in range(0, len(pal), 3)]
-
-    idxs = np.array(q.getdata(), dtype=np.int32)
-    counts = Counter(idxs.tolist())
-
-    # (count, rgb) list, dropping invalid indices
-    colors = [(n, palette[i]) for i, n in counts.items() if 0 <= i < len(palette)]
-    if not colors:
+    palette = np.array(pal[: len(pal) - len(pal) % 3], dtype=np.int32).reshape(-1, 3)
+
+    # pixel counts per palette index, straight from the index buffer
+    idxs = np.frombuffer(q.tobytes(), dtype=np.uint8)
+    counts = np.bincount(idxs, minlength=256)
+    # colours are kept in order of first appearance, which keeps ties resolving the same way
+    present, first_seen = np.unique(idxs, return_index=True)
+    present = present[np.argsort(first_seen, kind="stable")]
+    present = present[present < len(palette)]  # drop invalid indices
+    if not len(present):
         return ["#000000"] * k_out
 
-    def luminance(rgb):
-        r, g, b = [c / 255.0 for c in rgb]
-        return 0.2126 * r + 0.7152 * g + 0.0722 * b
+    rgb_ints = palette[present]
+    freqs = counts[present].astype(np.float32)
 
-    rgbs = np.array([c for _, c in colors], dtype=np.float32) / 255.0
-    sats = rgb_to_hsv(rgbs.reshape(-1, 1, 3)).reshape(-1, 3)[:, 1]  # S channel
-    lums = np.array([luminance(c) for _, c in colors], dtype=np.float32)
-    freqs = np.array([n for n, _ in colors], dtype=np.float32)
+    # saturation and luminance for every colour at once
+    rgbs = rgb_ints.astype(np.float32) / 255.0
+    maxs = rgbs.max(axis=1)
+    sats = np.zeros_like(maxs)
+    np.divide(maxs - rgbs.min(axis=1), maxs, out=sats, where=maxs > 0)
+    channels = rgb_ints.astype(np.float64) / 255.0
+    lum_values = 0.2126 * channels[:, 0] + 0.7152 * channels[:, 1] + 0.0722 * channels[:, 2]
+    lums = lum_values.astype(np.float32)
 
     # prominence score: frequency * (saturation boosted)
     score = freqs * (0.25 + sats) ** 2.0
 
-    def too_close(c, picked, thr=20):
-        cr = np.array(c, dtype=np.int16)
-        return any(
-            np.linalg.norm(cr - np.array(p, dtype=np.int16)) < thr for p in picked
-        )
+    # pairwise squared distances, two colours are too close when they are under 20 apart
+    diffs = rgb_ints[:, None, :] - rgb_ints[None, :, :]
+    close = np.einsum("ijk,ijk->ij", diffs, diffs) < 20 * 20
 
-    rgb_list = [c for _, c in colors]
-    darkest = rgb_list[int(np.argmin(lums))]
-    lightest = rgb_list[int(np.argmax(lums))]
+    darkest = int(np.argmin(lums))
+    lightest = int(np.argmax(lums))
+    wanted = max(0, k_out - 2)
 
-    order = np.argsort(-score)
+    blocked = close[darkest] | close[lightest]
     picked = []
-    for idx in order:
-        c = colors[idx][1]
-        if c == darkest or c == lightest:
+    for idx in np.argsort(-score):
+        if blocked[idx]:
             continue
-        if too_close(c, picked + [darkest, lightest]):
-            continue
-        picked.append(c)
-        if len(picked) >= max(0, k_out - 2):
+        picked.append(int(idx))
+        blocked = blocked | close[idx]
+        if len(picked) >= wanted:
             break
 
-    if len(picked) < max(0, k_out - 2):
-        by_freq = np.argsort(-freqs)
-        for idx in by_freq:
-            c = colors[idx][1]
-            if c in (darkest, lightest) or too_close(c, picked + [darkest, lightest]):
+    if len(picked) < wanted:
+        for idx in np.argsort(-freqs):
+            if blocked[idx]:
                 continue
-            picked.append(c)
-            if len(picked) >= max(0, k_out - 2):
+            picked.append(int(idx))
+            blocked = blocked | close[idx]
+            if len(picked) >= wanted:
                 break
 
-    mids = sorted(picked[: max(0, k_out - 2)], key=lambda c: luminance(c))
+    mids = sorted(picked[:wanted], key=lambda idx: lum_values[idx])
     final = [lightest, *mids, darkest]
-    return [_hex(c) for c in final]
+    return [_hex(rgb_ints[idx]) for idx in final]
+
+
+def palette_key(mbid, k_out=5, k_quant=48):
+    return mbid, k_out, k_quant
+
+
+# returns the album palette from the cache, computing it only on a miss
+def album_palette(mbid, cover, k_out=5, k_quant=48):
+    if cover is None:
+        return DEFAULT_COLOURS[:k_out]
+    return palette_cache.get_or_compute(
+        palette_key(mbid, k_out, k_quant),
+        lambda: colourExtractor(cover, k_out=k_out, k_quant=k_quant),
+    )
+
+
+def _colour_extract_bytes(job):
+    image_bytes, k_out, k_quant, max_side = job
+    cover = Cover(image_bytes) if image_bytes else None
+    return colourExtractor(cover, k_out=k_out, k_quant=k_quant, max_side=max_side)
+
+
+# extracts palettes for many covers ( Cover objects or raw image bytes ), in order, across a process pool
+def colour_extract_batch(images, k_out=5, k_quant=48, max_side=300, processes=None):
+    jobs = [
+        (image.data if isinstance(image, Cover) else image, k_out, k_quant, max_side)
+        for image in images
+    ]
+    workers = processes or os.cpu_count() or 1
+    if workers == 1 or len(jobs) < 2:
+        return [_colour_extract_bytes(job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        chunksize = max(1, len(jobs) // (workers * 4))
+        return list(executor.map(_colour_extract_bytes, jobs, chunksize=chunksize))
 
 
 # converts an rgb value to a hex value
-@timeProgram
 def _hex(rgb):
     r, g, b = map(int, rgb)
     return f"#{r:02x}{g:02x}{b:02x}"
 
 
 # converts ms to formatted minutes and seconds
-@timeProgram
 def ms_to_min_sec(ms):
     total_seconds = ms // 1000
     minutes = total_seconds // 60
@@ -350,17 +805,16 @@ def ms_to_min_sec(ms):
     return f"{minutes}:{seconds:02d}"
 
 
-# creates the formatted tracklist
-@timeProgram
-def createTracklist(json_tracklist):
+# creates the formatted tracklist from a release's Tracks
+def createTracklist(tracks):
     tracklist = {}
     release_length = 0
     max_sec = 1  # avoid divide-by-zero
 
     # first pass — collect seconds & find the max
-    for item in json_tracklist:
-        pos = int(item["position"])  # numeric sort later
-        rec_len = item["recording"].get("length")  # ms or None
+    for track in tracks:
+        pos = track.position  # numeric sort later
+        rec_len = track.length  # ms or None
 
         # setting the length of the recording
         if rec_len is None:
@@ -374,7 +828,7 @@ def createTracklist(json_tracklist):
                 max_sec = seconds
 
         tracklist[pos] = {
-            "title": item["title"],
+            "title": track.title,
             "length": length_str,
             "seconds": seconds,
         }
@@ -386,6 +840,267 @@ def createTracklist(json_tracklist):
     return tracklist, release_length
 
 
+def _cover_and_palette(mbid):
+    # a failed fetch raises, so the leg counts as failed rather than as a release without a cover
+    cover = get_album_cover(mbid, strict=True)
+    return cover, album_palette(mbid, cover)
+
+
+def _tracklist_from(release_data):
+    if release_data is not None:
+        return createTracklist(release_data.tracks)
+    return {}, 0
+
+
+def _tracklist_and_length(mbid):
+    return _tracklist_from(get_tracklist(mbid))
+
+
+# fetches the cover ( and its palette ), the tracklist and the barcode side by side under one deadline
+# parts still running when it passes are left to finish in the background, so they land in the caches for next time
+def load_album_context(mbid, barcode=None, template="white", barcode_background=None, deadline=ALBUM_CONTEXT_DEADLINE):
+    legs = {
+        "cover": album_context_executor.submit(_cover_and_palette, mbid),
+        "tracklist": album_context_executor.submit(_tracklist_and_length, mbid),
+    }
+    if barcode is not None:
+        if barcode_encodable(barcode):
+            legs["barcode"] = album_context_executor.submit(barcode_data_uri, barcode, template, barcode_background)
+        else:
+            # drawn without a barcode every time, so the page is as good as it gets
+            album_context_fallbacks.inc("barcode", "invalid")
+    concurrent.futures.wait(legs.values(), timeout=deadline)
+
+    results, missed, failed = {}, [], []
+    for name, future in legs.items():
+        if not future.done():
+            missed.append(name)
+            album_context_fallbacks.inc(name, "timeout")
+        elif future.exception() is not None:
+            failed.append(name)
+            album_context_fallbacks.inc(name, "error")
+        else:
+            results[name] = future.result()
+    return _album_context(results, missed, failed, barcode)
+
+
+# the AlbumContext from the legs that finished, defaults standing in for the ones that missed the deadline or raised
+def _album_context(results, missed, failed, barcode):
+    cover, colours = results.get("cover", (None, DEFAULT_COLOURS))
+    tracklist, release_length = results.get("tracklist", ({}, 0))
+    return AlbumContext(
+        cover=cover,
+        colours=colours,
+        tracklist=tracklist,
+        release_length=release_length,
+        barcode_src=results.get("barcode", TRANSPARENT_PIXEL if barcode is not None else None),
+        missed=tuple(missed),
+        failed=tuple(failed),
+    )
+
+
+# the release details posted back with the wallpaper form, a JSON list in the order the selection step builds it
+def parse_selected_details(raw):
+    try:
+        details = json.loads(raw)
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(details, list) or len(details) != 9:
+        return None
+    if not all(value is None or isinstance(value, (str, int)) for value in details):
+        return None
+    if not isinstance(details[5], str) or not MBID_PATTERN.match(details[5]):
+        return None
+    if not details[8]:
+        details[8] = "794558113229"
+    return [None if value is None else str(value) for value in details]
+
+
+# Sends a cached page gzipped when the client takes that, with an ETag so a revalidation gets a 304
+def cached_page_response(page):
+    if "gzip" in request.accept_encodings:
+        response = Response(page.gzipped, mimetype="text/html")
+        response.content_encoding = "gzip"
+        response.set_etag(f"{page.etag}-gzip")
+    else:
+        response = Response(gzip.decompress(page.gzipped), mimetype="text/html")
+        response.set_etag(page.etag)
+    response.vary.add("Accept-Encoding")
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+# The finished wallpaper page for the options form, from the page cache when the same inputs were rendered before
+def wallpaper_page_response(form):
+    # set variables
+    template_type = form.get("templateSelector", "white")
+    wallpaper_device = form.get("wallpaperDevice", "desktop")
+
+    stored_context = album_contexts.get(form.get("context_token"))
+    if stored_context is not None:
+        details = stored_context["details"]
+    else:
+        details = parse_selected_details(form["selected_details"])
+        if details is None:
+            abort(400)
+    background_choice = form.get("backgroundSelector", "default")
+    if template_type not in {"white", "dark"}:
+        template_type = "white"
+
+    if wallpaper_device not in {"desktop", "phone"}:
+        wallpaper_device = "desktop"
+
+    backgrounds = wallpaper_background(
+        wallpaper_device,
+        template_type,
+        background_choice,
+        form.get("custom", ""),
+        form.get("gradient_start", ""),
+        form.get("gradient_end", ""),
+    )
+    # the same normalised inputs always make the same page
+    key = page_key(details, wallpaper_device, template_type, sorted(backgrounds.items()))
+    page = page_cache.get(key)
+    if page is not None:
+        return cached_page_response(page)
+
+    background = backgrounds["background"]
+    body_background = backgrounds["body_background"]
+    container_background = backgrounds["container_background"]
+    barcode_background = backgrounds["barcode_background"]
+    cacheable = True
+    if stored_context is not None:
+        # only the template and background choices are left to apply
+        try:
+            cover = get_album_cover(details[5], strict=True)
+        except CoverFetchError:
+            cover = None
+            cacheable = False
+            album_context_fallbacks.inc("cover", "error")
+        tracklist = stored_context["tracklist"]
+        release_length = stored_context["release_length"]
+        colours = stored_context["colours"]
+        if not barcode_encodable(details[8]):
+            album_context_fallbacks.inc("barcode", "invalid")
+        barcode_src = release_barcode_src(details[8], template_type, barcode_background)
+    else:
+        context = load_album_context(details[5], details[8], template_type, barcode_background)
+        cover = context.cover
+        tracklist = context.tracklist
+        release_length = context.release_length
+        colours = context.colours
+        barcode_src = context.barcode_src
+        # a page built around defaults for a part that missed its deadline or failed is not worth keeping
+        cacheable = not context.missed and not context.failed
+
+    # return the template with the completed variables
+    template_prefix = "phone" if wallpaper_device == "phone" else "desktop"
+    # only the phone layouts use the custom font, the desktop ones stick to Helvetica
+    if wallpaper_device == "phone":
+        fonts = font_urls()
+        export_fonts = export_font_css(
+            [details[0], details[1], *(track["title"] for track in tracklist.values())]
+        )
+    else:
+        fonts, export_fonts = None, None
+
+    html = render_page(
+        f"{template_prefix}-{template_type}.html",
+        artist=details[0],
+        album=details[1],
+        date=details[2],
+        country=details[3],
+        track_count=details[4],
+        format=details[6],
+        type=details[7],
+        barcode_src=barcode_src,
+        cover_image=cover.data_uri() if cover is not None else None,
+        run_time=ms_to_min_sec(release_length),
+        tracklist=tracklist,
+        colours=colours,
+        background=background,
+        body_background=body_background,
+        container_background=container_background,
+        wallpaper_device=wallpaper_device,
+        font_urls=fonts,
+        export_font_css=export_fonts,
+    )
+    if not cacheable:
+        return html
+    return cached_page_response(page_cache.put(key, html))
+
+
+# The options form submits here, a GET so browsers can revalidate the page rather than post it again
+@app.route("/wallpaper")
+def wallpaper_page():
+    if "selected_details" not in request.args:
+        abort(400)
+    return wallpaper_page_response(request.args)
+
+
+# Renders a page, timed as the template stage
+def render_page(template_name, **context):
+    with stage_seconds.time("template"):
+        return render_template(template_name, **context)
+
+
+# the picked release's details, in the order the wallpaper form posts them back
+def selected_album_details(form):
+    # Set variables that will be passed through
+    return [
+        form["selected_artist"],
+        form["selected_album"],
+        form["selected_date"],
+        form["selected_country"],
+        form["selected_track_count"],
+        form["selected_MBID"],
+        form["selected_format"],
+        form["selected_type"],
+        form.get("selected_barcode") or "794558113229",
+    ]
+
+
+# the index page with the picked album on the right of the screen
+def selection_page(selected_album_information, context):
+    selected_mbid = selected_album_information[5]
+    # keep what was just assembled so the wallpaper render does not fetch it all again
+    context_token = None
+    if not context.missed and not context.failed:
+        context_token = album_contexts.put(
+            {
+                "details": selected_album_information,
+                "tracklist": context.tracklist,
+                "release_length": context.release_length,
+                "colours": context.colours,
+            }
+        )
+    # return the index.html template but with the selected album on the right of the screen
+    return render_page(
+        "index.html",
+        selected_cover_image=url_for("cover", mbid=selected_mbid, size="full") if context.cover else None,
+        selected_artist=selected_album_information[0],
+        selected_album=selected_album_information[1],
+        selected_country=selected_album_information[3],
+        selected_track_count=selected_album_information[4],
+        selected_mbid=selected_mbid,
+        tracklist=context.tracklist,
+        selected_details=selected_album_information,
+        context_token=context_token,
+        gradient_colours=context.colours,
+        error_message=None,
+    )
+
+
+def search_error_page():
+    return render_page(
+        "index.html",
+        releases=None,
+        gradient_colours=None,
+        error_message=SEARCH_ERROR_MESSAGE,
+    )
+
+
 # Index Route
 @app.route("/", methods=["GET", "POST"])
 def index():
@@ -393,179 +1108,15 @@ def index():
     if request.method == "POST":
         # If the FORM is the Initial Selection
         if "selected_MBID" in request.form:
-            # Set variables that will be passed through
-            selected_album_information = []
-            selected_artist = request.form["selected_artist"]
-            selected_album = request.form["selected_album"]
-            selected_date = request.form["selected_date"]
-            selected_country = request.form["selected_country"]
-            selected_track_count = request.form["selected_track_count"]
-            selected_mbid = request.form["selected_MBID"]
-            selected_format = request.form["selected_format"]
-            selected_type = request.form["selected_type"]
-            selected_barcode = request.form.get("selected_barcode") or "794558113229"
-            # Adds the variables to the list of album information
-            selected_album_information.extend(
-                [
-                    selected_artist,
-                    selected_album,
-                    selected_date,
-                    selected_country,
-                    selected_track_count,
-                    selected_mbid,
-                    selected_format,
-                    selected_type,
-                    selected_barcode,
-                ]
-            )
-            # dynamically load the album cover
-            selected_cover_image = get_album_cover(selected_mbid)
-            if selected_cover_image and selected_cover_image.startswith("data:"):
-                gradient_colours = colourExtractor(selected_cover_image)
-            else:
-                gradient_colours = DEFAULT_COLOURS
-
-            track_data = get_tracklist(selected_mbid)
-            if track_data and track_data.get("media"):
-                tracklist, release_length = createTracklist(
-                    track_data["media"][0]["tracks"]
-                )
-            else:
-                tracklist, release_length = {}, 0
-            # return the index.html template but with the selected album on the right of the screen
-            return render_template(
-                "index.html",
-                selected_cover_image=selected_cover_image,
-                selected_artist=selected_artist,
-                selected_album=selected_album,
-                selected_country=selected_country,
-                selected_track_count=selected_track_count,
-                selected_mbid=selected_mbid,
-                tracklist=tracklist,
-                selected_details=selected_album_information,
-                gradient_colours=gradient_colours,
-                error_message=None,
-            )
+            selected_album_information = selected_album_details(request.form)
+            # the visitor has picked, whatever is still queued to warm for them is moot
+            prefetcher.cancel(page_id())
+            # load the album cover, palette and tracklist together
+            context = load_album_context(selected_album_information[5])
+            return selection_page(selected_album_information, context)
         # if the album has been fully selected
         if "selected_details" in request.form:
-            # set variables
-            selected_details = request.form["selected_details"]
-            template_type = request.form.get("templateSelector", "white")
-            wallpaper_device = request.form.get("wallpaperDevice", "desktop")
-
-            details = ast.literal_eval(selected_details)
-            track_data = get_tracklist(details[5])
-            cover_image = get_album_cover(details[5])
-            background_choice = request.form.get("backgroundSelector", "default")
-            custom_background_raw = request.form.get("custom", "").strip()
-            gradient_start_raw = request.form.get("gradient_start", "").strip()
-            gradient_end_raw = request.form.get("gradient_end", "").strip()
-
-            def sanitize_hex_color(value):
-                if not value:
-                    return None
-                value = value.strip()
-                if not value:
-                    return None
-                if not value.startswith("#"):
-                    value = f"#{value}"
-                hex_part = value[1:]
-                if len(hex_part) == 3:
-                    if not all(c in "0123456789abcdefABCDEF" for c in hex_part):
-                        return None
-                    hex_part = "".join(c * 2 for c in hex_part.lower())
-                elif len(hex_part) == 6:
-                    if not all(c in "0123456789abcdefABCDEF" for c in hex_part):
-                        return None
-                    hex_part = hex_part.lower()
-                else:
-                    return None
-                return f"#{hex_part}"
-
-            if template_type not in {"white", "dark"}:
-                template_type = "white"
-
-            if wallpaper_device not in {"desktop", "phone"}:
-                wallpaper_device = "desktop"
-
-            if wallpaper_device == "phone":
-                if template_type == "dark":
-                    default_body_background = DEFAULT_DARK_PHONE_BODY_COLOUR
-                    default_container_background = DEFAULT_DARK_PHONE_CONTAINER_COLOUR
-                else:
-                    default_body_background = DEFAULT_LIGHT_BODY_COLOUR
-                    default_container_background = DEFAULT_LIGHT_CONTAINER_COLOUR
-            else:
-                if template_type == "dark":
-                    default_body_background = DEFAULT_DARK_BODY_COLOUR
-                    default_container_background = DEFAULT_DARK_CONTAINER_COLOUR
-                else:
-                    default_body_background = DEFAULT_LIGHT_BODY_COLOUR
-                    default_container_background = DEFAULT_LIGHT_CONTAINER_COLOUR
-
-            background = "default"
-            body_background = default_body_background
-            container_background = default_container_background
-            barcode_background = None
-
-            if background_choice == "gradient":
-                start_color = sanitize_hex_color(gradient_start_raw) or "#FFFAEC"
-                end_color = sanitize_hex_color(gradient_end_raw) or "#FF11AA"
-                body_background = f"linear-gradient(45deg, {start_color}, {end_color})"
-                container_background = "transparent"
-                background = "gradient"
-                barcode_background = "transparent"
-            elif background_choice == "custom":
-                custom_color = sanitize_hex_color(custom_background_raw)
-                if custom_color:
-                    body_background = custom_color
-                    container_background = custom_color
-                    background = custom_color
-                    barcode_background = hex_to_rgb(custom_color)
-                else:
-                    background = "default"
-                    barcode_background = None
-            # pprint(json_tracklist)
-            if track_data and track_data.get("media"):
-                tracklist, release_length = createTracklist(
-                    track_data["media"][0]["tracks"]
-                )
-            else:
-                tracklist, release_length = {}, 0
-            if cover_image and cover_image.startswith("data:"):
-                colours = colourExtractor(cover_image)
-            else:
-                colours = DEFAULT_COLOURS
-
-            # return the template with the completed variables
-            # print(cover_image)
-            template_prefix = "phone" if wallpaper_device == "phone" else "desktop"
-
-            return render_template(
-                f"{template_prefix}-{template_type}.html",
-                artist=details[0],
-                album=details[1],
-                date=details[2],
-                country=details[3],
-                track_count=details[4],
-                format=details[6],
-                type=details[7],
-                barcode_src=barcode_data_uri(details[8], template_type, barcode_background),
-                cover_image=cover_image,
-                run_time=ms_to_min_sec(release_length),
-                tracklist=tracklist,
-                colours=colours,
-                background=background,
-                body_background=body_background,
-                container_background=container_background,
-                wallpaper_device=wallpaper_device,
-                font_regular_ttf=FONT_REGULAR_TTF,
-                font_regular_woff=FONT_REGULAR_WOFF,
-                font_regular_woff2=FONT_REGULAR_WOFF2,
-                font_bold_ttf=FONT_BOLD_TTF,
-                font_bold_woff=FONT_BOLD_WOFF,
-                font_bold_woff2=FONT_BOLD_WOFF2,
-            )
+            return wallpaper_page_response(request.form)
 
         else:
             # Get details from form
@@ -575,16 +1126,12 @@ def index():
             try:
                 album_list = search_albums(artist, album)
             except SearchAlbumsError:
-                return render_template(
-                    "index.html",
-                    releases=None,
-                    gradient_colours=None,
-                    error_message="Could not reach MusicBrainz. Please try again in a moment.",
-                )
+                return search_error_page()
             parsed_albums = createList(album_list)
-            return render_template("index.html", releases=parsed_albums, gradient_colours=None, error_message=None)
+            schedule_prefetch(release_mbids(parsed_albums))
+            return render_page("index.html", releases=parsed_albums, gradient_colours=None, error_message=None)
     # if no routes are matched, return default template
-    return render_template("index.html", gradient_colours=None, error_message=None)
+    return render_page("index.html", gradient_colours=None, error_message=None)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,264 @@
+import argparse
+import csv
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+
+from api_testing import (
+    MUSICBRAINZ_HOST,
+    SearchAlbumsError,
+    TracklistFetchError,
+    _fetch_cover,
+    _fetch_tracklist,
+    client as upstream_client,
+    search_albums,
+)
+from app import (
+    MBID_PATTERN,
+    parse_releases,
+    wallpaper_background,
+    wallpaper_key,
+    wallpaper_spec,
+    wallpaper_store,
+)
+from cover_store import cover_store
+from palette_cache import palette_cache
+from wallpaper_renderer import WallpaperRenderError, render_wallpaper
+
+
+'''
+BATCH
+--
+Renders wallpapers for a whole list of albums without going through the web pages.
+
+    python Backend/batch.py albums.csv --out wallpapers/ --device phone --template dark
+
+The input is a CSV with a header, or JSON lines ( .jsonl / .ndjson ), where each row has either an "mbid" or an
+"artist" and "album" to search for ( the first search result is used ). Albums are resolved one at a time in this
+process, spaced out to respect the MusicBrainz rate limit, while the rendering itself runs across a process pool.
+
+Every finished row is appended to a checkpoint file, so running the same command again after an interruption picks up
+where it stopped. Rows that failed are tried again. Renders also go into the same on-disk store the web endpoint uses,
+so albums already rendered with the same options are only copied out.
+'''
+
+MUSICBRAINZ_RATE = 1.0
+CHECKPOINT_NAME = ".resleeve-batch.jsonl"
+
+
+class BatchInputError(Exception):
+    """Raised when the input file cannot be read as album rows."""
+
+
+def read_rows(path):
+    path = Path(path)
+    try:
+        with open(path, newline="", encoding="utf-8") as handle:
+            if path.suffix.lower() in {".jsonl", ".ndjson"}:
+                rows = [json.loads(line) for line in handle if line.strip()]
+            else:
+                rows = list(csv.DictReader(handle))
+    except (OSError, ValueError) as exc:
+        raise BatchInputError(f"could not read {path}: {exc}") from exc
+    cleaned = []
+    for number, row in enumerate(rows, start=1):
+        if not isinstance(row, dict):
+            raise BatchInputError(f"row {number} is not an object")
+        row = {str(key).strip().lower(): str(value or "").strip() for key, value in row.items() if key}
+        if not row.get("mbid") and not (row.get("artist") and row.get("album")):
+            raise BatchInputError(f"row {number} needs an mbid, or an artist and an album")
+        cleaned.append(row)
+    return cleaned
+
+
+def row_identity(row):
+    if row.get("mbid"):
+        return f"mbid:{row['mbid'].lower()}"
+    return f"search:{row['artist']}\x1f{row['album']}"
+
+
+def load_checkpoint(path):
+    # keys of every row that finished in an earlier run
+    done = set()
+    try:
+        with open(path, encoding="utf-8") as handle:
+            for line in handle:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # a line cut short by the interruption
+                    continue
+                if entry.get("status") == "done":
+                    done.add(entry["key"])
+    except OSError:
+        pass
+    return done
+
+
+def resolve_mbid(row):
+    if row.get("mbid"):
+        mbid = row["mbid"].lower()
+        if not MBID_PATTERN.match(mbid):
+            raise LookupError(f"not a MusicBrainz ID: {row['mbid']}")
+        return mbid
+    releases = parse_releases(search_albums(row["artist"], row["album"]))
+    if not releases:
+        raise LookupError(f"no release found for {row['artist']} - {row['album']}")
+    return releases[0]["MBID"]
+
+
+def _write_atomic(path, data):
+    fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as tmp:
+            tmp.write(data)
+        os.replace(tmp_name, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_name)
+        except OSError:
+            pass
+        raise
+
+
+def render_to_file(spec, output, store_key):
+    # runs in a pool worker: render, write the file and share the render with the web endpoint
+    image_bytes = render_wallpaper(spec)
+    _write_atomic(Path(output), image_bytes)
+    if not spec["fallbacks"]:
+        # a render around a cover that failed to arrive is not one to hand out again
+        wallpaper_store.put(store_key, image_bytes, "image/png")
+    return len(image_bytes)
+
+
+def _ratio(hits, misses):
+    total = hits + misses
+    return f"{hits}/{total} ({hits / total:.0%})" if total else "0/0"
+
+
+def print_summary(counts, elapsed, rendered_bytes):
+    processed = counts["done"] + counts["failed"]
+    rate = processed / elapsed if elapsed else 0.0
+    cover_memory = _fetch_cover.stats()
+    tracklists = _fetch_tracklist.stats()
+    covers = cover_store.stats()
+    palettes = palette_cache.stats()
+    upstream = upstream_client.stats()
+    waited = upstream["hosts"].get(MUSICBRAINZ_HOST, {}).get("rate_limited_seconds", 0)
+    print(f"Processed {processed} albums in {elapsed:.1f}s ({rate:.2f} albums/sec)")
+    print(f"  done {counts['done']}, failed {counts['failed']}, skipped {counts['skipped']} from the checkpoint")
+    print(f"  rendered {counts['rendered']} ({rendered_bytes / (1024 * 1024):.1f} MB), "
+          f"reused {counts['reused']} from the render store")
+    print(f"  cover cache      {_ratio(cover_memory['hits'] + cover_memory['stale_hits'] + covers['hits'], covers['misses'])}")
+    print(f"  tracklist cache  {_ratio(tracklists['hits'] + tracklists['stale_hits'], tracklists['misses'])}")
+    print(f"  palette cache    {_ratio(palettes['hits'], palettes['misses'])}")
+    print(f"  upstream         {upstream['requests']} requests, {upstream['retries']} retries, "
+          f"{waited:.1f}s waiting on the MusicBrainz rate limit")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Render wallpapers for a list of albums.")
+    parser.add_argument("input", help="CSV or JSON lines file of rows with an mbid, or an artist and album")
+    parser.add_argument("--out", default="wallpapers", help="directory the PNGs are written to")
+    parser.add_argument("--device", choices=["desktop", "phone"], default="desktop")
+    parser.add_argument("--template", choices=["white", "dark"], default="white")
+    parser.add_argument("--background", default="default", help="default, gradient or a hex colour")
+    parser.add_argument("--gradient-start", default="")
+    parser.add_argument("--gradient-end", default="")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="render processes")
+    parser.add_argument("--rate", type=float, default=MUSICBRAINZ_RATE, help="MusicBrainz requests per second")
+    parser.add_argument("--checkpoint", help=f"progress file, defaults to {CHECKPOINT_NAME} in the output directory")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        rows = read_rows(args.input)
+    except BatchInputError as exc:
+        print(f"error: {exc}", file=sys.stderr)
+        return 2
+
+    out_dir = Path(args.out)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    checkpoint = Path(args.checkpoint) if args.checkpoint else out_dir / CHECKPOINT_NAME
+    done = load_checkpoint(checkpoint)
+
+    choice, custom = args.background, ""
+    if choice not in {"default", "gradient"}:
+        choice, custom = "custom", args.background
+    backgrounds = wallpaper_background(
+        args.device, args.template, choice, custom, args.gradient_start, args.gradient_end
+    )
+    options = f"{args.device}-{args.template}-{'-'.join(colour.lstrip('#') for colour in backgrounds['fill'])}"
+    upstream_client.set_rate_limit(MUSICBRAINZ_HOST, args.rate)
+
+    counts = {"done": 0, "failed": 0, "skipped": 0, "rendered": 0, "reused": 0}
+    rendered_bytes = 0
+    started = time.perf_counter()
+    workers = max(1, args.workers)
+
+    with open(checkpoint, "a", encoding="utf-8") as log, ProcessPoolExecutor(max_workers=workers) as pool:
+
+        def record(key, status, **fields):
+            counts[status] += 1
+            log.write(json.dumps({"key": key, "status": status, **fields}) + "\n")
+            log.flush()
+
+        pending = {}
+
+        def collect(futures):
+            nonlocal rendered_bytes
+            for future in futures:
+                key, mbid, output = pending.pop(future)
+                try:
+                    rendered_bytes += future.result()
+                except (WallpaperRenderError, OSError) as exc:
+                    record(key, "failed", mbid=mbid, error=str(exc))
+                    print(f"failed  {mbid}: {exc}", file=sys.stderr)
+                else:
+                    counts["rendered"] += 1
+                    record(key, "done", mbid=mbid, output=str(output))
+                    print(f"done    {output}")
+
+        for row in rows:
+            key = f"{row_identity(row)}|{options}"
+            if key in done:
+                counts["skipped"] += 1
+                continue
+            try:
+                mbid = resolve_mbid(row)
+                output = out_dir / f"{mbid}-{options}.png"
+                store_key = wallpaper_key(mbid, args.device, args.template, backgrounds)
+                stored = wallpaper_store.get(store_key)
+                if stored is not None:
+                    _write_atomic(output, stored[0])
+                    counts["reused"] += 1
+                    record(key, "done", mbid=mbid, output=str(output))
+                    print(f"done    {output} (stored)")
+                    continue
+                spec = wallpaper_spec(mbid, args.device, args.template, backgrounds)
+                if spec is None:
+                    raise LookupError(f"MusicBrainz has no release {mbid}")
+            except (LookupError, SearchAlbumsError, TracklistFetchError, OSError, ValueError) as exc:
+                record(key, "failed", row=row, error=str(exc) or type(exc).__name__)
+                print(f"failed  {row}: {exc}", file=sys.stderr)
+                continue
+
+            pending[pool.submit(render_to_file, spec, output, store_key)] = (key, mbid, output)
+            # keep a couple of jobs queued per worker while the next album resolves, without holding every cover
+            if len(pending) >= workers * 2:
+                finished, _running = wait(pending, return_when=FIRST_COMPLETED)
+                collect(finished)
+        collect(list(pending))
+
+    print_summary(counts, time.perf_counter() - started, rendered_bytes)
+    return 1 if counts["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,102 @@
+import base64
+import io
+import sys
+import timeit
+from pathlib import Path
+
+import numpy as np
+from barcode import EAN13, UPCA
+from barcode.writer import ImageWriter
+from PIL import Image
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from app import barcode_data_uri  # noqa: E402
+
+
+'''
+BARCODE BENCHMARK
+--
+Compares barcode_data_uri against the python-barcode ImageWriter renderer it replaced. Every combination of code,
+template and background is decoded and checked pixel for pixel first ( the fast path writes an indexed PNG, so both
+are compared in the reference image's RGB / RGBA mode ), then both are timed, the fast path with and without its
+cache.
+
+Run with: python Backend/benchmarks/bench_barcode.py
+'''
+
+CODES = ["794558113229", "5012345678900", "036000291452", "4006381333931"]
+TEMPLATES = ["white", "dark"]
+BACKGROUNDS = [None, "transparent", (18, 52, 86), (255, 255, 255)]
+
+
+def reference_barcode_data_uri(code, type, background):
+    # the ImageWriter implementation barcode_data_uri used before the NumPy rasteriser
+    fmt = UPCA if len(code) == 12 else EAN13
+    transparent_requested = background == "transparent"
+    writer = ImageWriter(mode="RGBA" if transparent_requested else "RGB")
+    opts = {
+        "write_text": False,
+        "quiet_zone": 0.0,
+        "module_width": 0.26,
+        "module_height": 7.0,
+        "dpi": 300,
+    }
+    if type == "white":
+        default_background = (255, 250, 236)
+    else:
+        default_background = (0, 1, 10)
+        opts["foreground"] = (255, 255, 255)
+
+    if transparent_requested:
+        opts["background"] = (0, 0, 0, 0)
+    elif background is not None:
+        opts["background"] = background
+    else:
+        opts["background"] = default_background
+
+    buf = io.BytesIO()
+    fmt(code, writer=writer).write(buf, opts)
+    b64 = base64.b64encode(buf.getvalue()).decode("ascii")
+    return f"data:image/png;base64,{b64}"
+
+
+def _pixels(data_uri, mode):
+    img = Image.open(io.BytesIO(base64.b64decode(data_uri.split(",", 1)[1])))
+    return np.asarray(img.convert(mode))
+
+
+def check_identical():
+    for code in CODES:
+        for template in TEMPLATES:
+            for background in BACKGROUNDS:
+                mode = "RGBA" if background == "transparent" else "RGB"
+                expected = _pixels(reference_barcode_data_uri(code, template, background), mode)
+                actual = _pixels(barcode_data_uri(code, template, background), mode)
+                if expected.shape != actual.shape or not np.array_equal(actual, expected):
+                    raise SystemExit(f"pixel mismatch for {code} / {template} / {background}")
+    return len(CODES) * len(TEMPLATES) * len(BACKGROUNDS)
+
+
+def uncached(code, template, background):
+    barcode_data_uri.cache_clear()
+    return barcode_data_uri(code, template, background)
+
+
+def main(number=200):
+    checked = check_identical()
+    print(f"pixel identical across {checked} combinations")
+    args = ("794558113229", "white", None)
+    timings = {}
+    timings["imagewriter"] = timeit.timeit(lambda: reference_barcode_data_uri(*args), number=number)
+    timings["numpy"] = timeit.timeit(lambda: uncached(*args), number=number)
+    barcode_data_uri(*args)
+    timings["numpy + cache"] = timeit.timeit(lambda: barcode_data_uri(*args), number=number)
+    baseline = timings["imagewriter"]
+    for name, total in timings.items():
+        per_call = total / number * 1e6
+        print(f"{name:<14} {per_call:10.1f} us/call  {baseline / total:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
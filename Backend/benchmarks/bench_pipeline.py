@@ -0,0 +1,337 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from urllib.parse import urlsplit
+
+# keep the run away from the real caches and any configured local index, before the app modules read them
+os.environ["RESLEEVE_CACHE_DIR"] = tempfile.mkdtemp(prefix="resleeve-bench-")
+os.environ.pop("RESLEEVE_LOCAL_INDEX", None)
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import api_testing  # noqa: E402
+from app import (  # noqa: E402
+    app,
+    barcode_data_uri,
+    colourExtractor,
+    createList,
+    createTracklist,
+    export_font_css,
+    font_urls,
+    wallpaper_background,
+    wallpaper_spec,
+)
+from cover_store import cover_store  # noqa: E402
+from covers import Cover  # noqa: E402
+from flask import render_template  # noqa: E402
+from http_client import UpstreamError  # noqa: E402
+from palette_cache import palette_cache  # noqa: E402
+from recorded import FIXTURE_DIR, cover_images, load_json, load_lookups, release_covers  # noqa: E402
+from releases import project_release  # noqa: E402
+from wallpaper_renderer import render_wallpaper  # noqa: E402
+
+
+'''
+PIPELINE BENCHMARK
+--
+Times each stage between a search and a finished wallpaper, offline: createList, colourExtractor, barcode_data_uri,
+createTracklist, the desktop and phone page templates and the server side PNG renders.
+
+Upstream calls are answered from the recorded MusicBrainz responses in fixtures/ ( see recorded.py ), and covers
+from static/fallen.jpg re-encoded at several sizes.
+
+Every stage runs once to warm up, then for a number of rounds with its setup ( clearing caches ) kept out of the
+timing. The median is compared against a stored baseline, along with the peak traced memory of one further call
+( tracemalloc sees Python and NumPy allocations, not Pillow's ). A stage slower or larger than the baseline by more
+than the threshold fails the run. Baselines only mean something on the machine that saved them.
+
+    python Backend/benchmarks/bench_pipeline.py --save-baseline    # record this machine's baseline
+    python Backend/benchmarks/bench_pipeline.py                    # compare, exit 1 on a regression
+    python Backend/benchmarks/bench_pipeline.py --record "Radiohead" "OK Computer"    # refresh the fixtures
+'''
+
+BASELINE_PATH = Path(__file__).resolve().parent / "baseline.json"
+ROUNDS = 7
+THRESHOLD = 0.25
+# differences below this are timer noise on the fastest stages, whatever the ratio
+MIN_REGRESSION_SECONDS = 0.0002
+RECORD_LOOKUPS = 3
+
+
+class _Recorded:
+    """A recorded upstream response, shaped like the parts of requests.Response the fetchers read."""
+
+    def __init__(self, body=None, content=b"", content_type="application/json"):
+        self._body = body
+        self.content = content
+        self.headers = {"content-type": content_type}
+        self.status_code = 200
+
+    def json(self):
+        return self._body
+
+
+class ReplayClient:
+    """Answers the fetchers' upstream requests from the fixtures."""
+
+    def __init__(self, covers):
+        self.search = load_json("search-release.json")
+        self.lookups = load_lookups()
+        self.covers = covers
+        self.requests = 0
+
+    def get(self, url, policy, params=None):
+        self.requests += 1
+        parts = urlsplit(url)
+        path = parts.path.rstrip("/").split("/")
+        if f"{parts.scheme}://{parts.netloc}" == api_testing.COVER_ART_URL:
+            cover = self.covers.get(path[-2])
+            if cover is None:
+                raise UpstreamError(404)
+            return _Recorded(content=cover, content_type="image/jpeg")
+        if path[-1] == "release":
+            return _Recorded(self.search)
+        if path[-2] == "release" and path[-1] in self.lookups:
+            return _Recorded(self.lookups[path[-1]])
+        raise UpstreamError(404)
+
+    def stats(self):
+        return {"requests": self.requests, "retries": 0, "hosts": {}}
+
+
+def _no_args():
+    return ()
+
+
+def _cold_covers(search):
+    # a search as the first one for these releases: nothing in memory or in the on-disk cover store
+    def setup():
+        api_testing._fetch_cover.cache_clear()
+        shutil.rmtree(cover_store.root, ignore_errors=True)
+        return (search,)
+
+    return setup
+
+
+def _cold_barcodes():
+    barcode_data_uri.cache_clear()
+    return ()
+
+
+def page_context(spec, device, template_type, backgrounds):
+    # the variables the index route hands the wallpaper page templates
+    context = {
+        "artist": spec["artist"],
+        "album": spec["album"],
+        "date": spec["date"],
+        "country": spec["country"],
+        "track_count": spec["track_count"],
+        "format": spec["format"],
+        "type": spec["type"],
+        "barcode_src": barcode_data_uri("724385522925", template_type, backgrounds["barcode_background"]),
+        "cover_image": Cover(spec["cover"]).data_uri(),
+        "run_time": spec["run_time"],
+        "tracklist": spec["tracklist"],
+        "colours": spec["colours"],
+        "background": backgrounds["background"],
+        "body_background": backgrounds["body_background"],
+        "container_background": backgrounds["container_background"],
+        "wallpaper_device": device,
+        "font_urls": None,
+        "export_font_css": None,
+    }
+    if device == "phone":
+        context["font_urls"] = font_urls()
+        context["export_font_css"] = export_font_css(
+            [spec["artist"], spec["album"], *(track["title"] for track in spec["tracklist"].values())]
+        )
+    return context
+
+
+def build_stages(replay, images):
+    # name -> ( setup returning the call's arguments, the call )
+    stages = {}
+    stages["create_list"] = (_cold_covers(replay.search), createList)
+    for size, data in images.items():
+        stages[f"colour_extractor_{size}px"] = (lambda data=data: (Cover(data),), colourExtractor)
+
+    barcodes = [("724385522925", "white", None), ("5099749429325", "dark", "transparent")]
+
+    def all_barcodes():
+        return [barcode_data_uri(*args) for args in barcodes]
+
+    stages["barcode_data_uri"] = (_cold_barcodes, all_barcodes)
+
+    for mbid, lookup in sorted(replay.lookups.items()):
+        tracks = project_release(lookup).tracks
+        stages[f"create_tracklist_{len(tracks)}"] = (lambda tracks=tracks: (tracks,), createTracklist)
+
+    mbid = sorted(replay.lookups)[0]
+    for device in ("desktop", "phone"):
+        for template_type in ("white", "dark"):
+            backgrounds = wallpaper_background(device, template_type, "default", "", "", "")
+            spec = wallpaper_spec(mbid, device, template_type, backgrounds)
+            context = page_context(spec, device, template_type, backgrounds)
+            template_name = f"{device}-{template_type}.html"
+            stages[f"template_{device}_{template_type}"] = (
+                _no_args,
+                lambda template_name=template_name, context=context: render_template(template_name, **context),
+            )
+        stages[f"wallpaper_{device}"] = (lambda spec=spec: (spec,), render_wallpaper)
+    return stages
+
+
+def _settled(setup):
+    # palettes createList starts warming in the background would otherwise land in the next timing
+    palette_cache.drain()
+    return setup()
+
+
+def measure(setup, call, rounds):
+    call(*_settled(setup))
+    timings = []
+    for _round in range(rounds):
+        args = _settled(setup)
+        started = time.perf_counter()
+        call(*args)
+        timings.append(time.perf_counter() - started)
+    args = _settled(setup)
+    tracemalloc.start()
+    try:
+        call(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {"median": statistics.median(timings), "min": min(timings), "peak": peak}
+
+
+def compare(result, baseline, threshold):
+    # the reasons a stage counts as regressed, empty when it has not
+    if baseline is None:
+        return []
+    reasons = []
+    slower = result["median"] - baseline["median"]
+    if slower > baseline["median"] * threshold and slower > MIN_REGRESSION_SECONDS:
+        reasons.append(f"median {slower / baseline['median']:+.0%}")
+    if result["peak"] > baseline["peak"] * (1 + threshold):
+        reasons.append(f"peak {(result['peak'] - baseline['peak']) / max(baseline['peak'], 1):+.0%}")
+    return reasons
+
+
+def _ms(seconds):
+    return f"{seconds * 1000:9.2f} ms"
+
+
+def run(args):
+    images = cover_images()
+    replay = ReplayClient(release_covers(images))
+    api_testing.client = replay
+
+    baseline_path = Path(args.baseline)
+    baseline = {}
+    if baseline_path.is_file() and not args.save_baseline:
+        baseline = json.loads(baseline_path.read_text())["stages"]
+
+    results = {}
+    regressions = []
+    print(f"{'stage':<28} {'median':>12} {'min':>12} {'peak':>12}   vs baseline")
+    with app.test_request_context():
+        for name, (setup, call) in build_stages(replay, images).items():
+            if args.only and args.only not in name:
+                continue
+            result = results[name] = measure(setup, call, args.rounds)
+            base = baseline.get(name)
+            reasons = compare(result, base, args.threshold)
+            if reasons:
+                regressions.append(name)
+            if base is None:
+                note = "-"
+            else:
+                note = f"{(result['median'] - base['median']) / base['median']:+.0%}"
+                if reasons:
+                    note += f"  REGRESSED ({', '.join(reasons)})"
+            print(
+                f"{name:<28} {_ms(result['median']):>12} {_ms(result['min']):>12} "
+                f"{result['peak'] / 1024:9.0f} KiB   {note}"
+            )
+
+    if args.save_baseline:
+        baseline_path.write_text(
+            json.dumps(
+                {"machine": platform.platform(), "python": platform.python_version(), "stages": results},
+                indent=1,
+            )
+            + "\n"
+        )
+        print(f"baseline saved to {baseline_path}")
+        return 0
+    if not baseline:
+        print(f"no baseline at {baseline_path}, run with --save-baseline to record one")
+    if regressions:
+        print(f"{len(regressions)} stage(s) regressed by more than {args.threshold:.0%}: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+def record(artist, album):
+    # refreshes the fixtures from the live APIs, the only part of the suite that needs a network
+    search = api_testing._search_albums_remote(artist, album)
+    (FIXTURE_DIR / "search-release.json").write_text(json.dumps(search, indent=1) + "\n")
+    artists = api_testing.client.get(
+        f"{api_testing.MUSICBRAINZ_URL}/ws/2/artist",
+        api_testing.SUGGEST_POLICY,
+        params={"query": f'artist:"{artist}"', "fmt": "json", "limit": api_testing.SUGGEST_LIMIT},
+    ).json()
+    (FIXTURE_DIR / "search-artist.json").write_text(json.dumps(artists, indent=1) + "\n")
+    releases = search.get("releases", [])
+    for old in FIXTURE_DIR.glob("release-*.json"):
+        old.unlink()
+    for release in releases[:RECORD_LOOKUPS]:
+        lookup = api_testing._lookup_release(release["id"])
+        (FIXTURE_DIR / f"release-{release['id']}.json").write_text(json.dumps(lookup, indent=1) + "\n")
+    has_front = {}
+    for release in releases:
+        try:
+            listing = api_testing.client.get(
+                f"{api_testing.COVER_ART_URL}/release/{release['id']}", api_testing.COVER_POLICY
+            ).json()
+        except UpstreamError:
+            has_front[release["id"]] = False
+        else:
+            has_front[release["id"]] = any(image.get("front") for image in listing.get("images", []))
+    (FIXTURE_DIR / "covers.json").write_text(json.dumps(has_front, indent=1) + "\n")
+    print(f"recorded {len(releases)} releases and {min(len(releases), RECORD_LOOKUPS)} lookups to {FIXTURE_DIR}")
+    return 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark of the wallpaper pipeline stages.")
+    parser.add_argument("--rounds", type=int, default=ROUNDS, help="timed calls per stage")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD, help="allowed slowdown, 0.25 is 25%%")
+    parser.add_argument("--baseline", default=str(BASELINE_PATH))
+    parser.add_argument("--save-baseline", action="store_true", help="store this run as the baseline")
+    parser.add_argument("--only", help="run only the stages whose name contains this")
+    parser.add_argument("--record", nargs=2, metavar=("ARTIST", "ALBUM"), help="re-record the fixtures live")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        if args.record:
+            return record(*args.record)
+        return run(args)
+    finally:
+        shutil.rmtree(os.environ["RESLEEVE_CACHE_DIR"], ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,189 @@
+import argparse
+import copy
+import json
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+from recorded import cover_images, load_json, load_lookups, release_covers
+
+
+'''
+FAKE UPSTREAM
+--
+A local stand-in for MusicBrainz and the Cover Art Archive, answering from the recorded responses in fixtures/ so the
+whole search, select and render flow can be load tested without touching the real services.
+
+    python Backend/benchmarks/fake_upstream.py --port 8089 --latency 120 --jitter 40 --error-rate 0.02 --rate-limit 5
+
+    RESLEEVE_MUSICBRAINZ_URL=http://127.0.0.1:8089 RESLEEVE_COVER_ART_URL=http://127.0.0.1:8089 gunicorn app:app
+
+It serves:
+- /ws/2/release?query=...    the recorded release search, whatever the query
+- /ws/2/release/<mbid>       the recorded lookup, or for other searched releases the first recorded lookup
+                             re-labelled as that release
+- /ws/2/artist?query=...     the recorded artist search
+- /release/<mbid>/front      a cover image, or 404 for releases recorded without front art
+- /_stats                    requests served so far, by path kind and status
+
+Every response is held back by --latency ( plus up to --jitter either way ), --error-rate of them fail with a 502,
+and past --rate-limit requests a second MusicBrainz paths answer 503 the way musicbrainz.org does when its rate limit
+is exceeded. Cover requests are not rate limited, as on the real archive.
+'''
+
+DEFAULT_PORT = 8089
+
+
+class TokenBucket:
+    """Allows a steady rate of requests with bursts up to one second's worth."""
+
+    def __init__(self, per_second):
+        self.per_second = per_second
+        self.tokens = per_second
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.per_second, self.tokens + (now - self.updated) * self.per_second)
+            self.updated = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class FakeUpstream:
+    """The recorded responses and the latency, failure and rate limit behaviour applied to them."""
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, rate_limit=None, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = TokenBucket(rate_limit) if rate_limit else None
+        self.random = random.Random(seed)
+        self.release_search = load_json("search-release.json")
+        self.artist_search = load_json("search-artist.json")
+        self.lookups = load_lookups()
+        self.searched = {release["id"]: release for release in self.release_search.get("releases", [])}
+        self.covers = release_covers(cover_images())
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def count(self, kind, status):
+        with self._lock:
+            key = f"{kind} {status}"
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def lookup(self, mbid):
+        if mbid in self.lookups:
+            return self.lookups[mbid]
+        release = self.searched.get(mbid)
+        if release is None or not self.lookups:
+            return None
+        lookup = copy.deepcopy(next(iter(self.lookups.values())))
+        for field in ("id", "title", "date", "country", "barcode", "artist-credit", "release-group"):
+            if field in release:
+                lookup[field] = release[field]
+        return lookup
+
+    def respond(self, path):
+        # ( kind, status, content type, body ) for a request path
+        parts = [part for part in urlsplit(path).path.split("/") if part]
+        if parts == ["_stats"]:
+            with self._lock:
+                return "stats", 200, "application/json", json.dumps(self.counts).encode()
+
+        musicbrainz = parts[:2] == ["ws", "2"]
+        kind = "cover" if parts[:1] == ["release"] else "/".join(parts[:3]) if musicbrainz else "other"
+        if musicbrainz and len(parts) == 4 and parts[2] == "release":
+            kind = "ws/2/release/<mbid>"
+
+        delay = self.latency + self.random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        if musicbrainz and self.rate_limit is not None and not self.rate_limit.take():
+            return kind, 503, "text/plain", b"Your requests are exceeding the allowable rate limit."
+        if self.error_rate and self.random.random() < self.error_rate:
+            return kind, 502, "text/plain", b"Bad Gateway"
+
+        body = None
+        if kind == "ws/2/release":
+            body = self.release_search
+        elif kind == "ws/2/artist":
+            body = self.artist_search
+        elif kind == "ws/2/release/<mbid>":
+            body = self.lookup(parts[3])
+        elif kind == "cover" and len(parts) == 3 and parts[2] == "front":
+            cover = self.covers.get(parts[1])
+            if cover is not None:
+                return kind, 200, "image/jpeg", cover
+        if body is None:
+            return kind, 404, "application/json", b'{"error": "Not Found"}'
+        return kind, 200, "application/json", json.dumps(body).encode()
+
+
+def make_handler(upstream):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            kind, status, content_type, body = upstream.respond(self.path)
+            upstream.count(kind, status)
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(port=DEFAULT_PORT, host="127.0.0.1", **behaviour):
+    server = ThreadingHTTPServer((host, port), make_handler(FakeUpstream(**behaviour)))
+    server.daemon_threads = True
+    return server
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Serve recorded MusicBrainz and Cover Art Archive responses.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--latency", type=float, default=0, help="milliseconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0, help="milliseconds the latency varies by either way")
+    parser.add_argument("--error-rate", type=float, default=0, help="share of responses that fail with a 502")
+    parser.add_argument("--rate-limit", type=float, help="MusicBrainz requests a second before answering 503")
+    parser.add_argument("--seed", type=int)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    server = serve(
+        args.port,
+        args.host,
+        latency=args.latency / 1000,
+        jitter=args.jitter / 1000,
+        error_rate=args.error_rate,
+        rate_limit=args.rate_limit,
+        seed=args.seed,
+    )
+    print(f"fake upstream on http://{args.host}:{server.server_port}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
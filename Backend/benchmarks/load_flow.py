@@ -0,0 +1,262 @@
+import argparse
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from html.parser import HTMLParser
+from pathlib import Path
+
+import requests
+
+
+'''
+LOAD FLOW
+--
+Drives the three requests a visitor makes from the index page, over and over from concurrent virtual users:
+
+1. search   the artist and album form, answered with the release tiles
+2. select   one of those tiles, answered with the tracklist, palette and the options form
+3. render   the options form ( a GET to /wallpaper ), answered with the finished wallpaper page
+
+Each step's latency is recorded, and the run ends with p50 / p95 / p99 and throughput per step.
+
+By default it starts everything itself: fake_upstream.py with the given latency, error rate and rate limit, then
+gunicorn with the given workers and threads pointed at it, so runs with different worker configurations compare
+like for like ( gunicorn has to be installed, and gevent for --worker-class gevent ).
+
+    python Backend/benchmarks/load_flow.py --workers 4 --threads 2 --users 16 --iterations 20 --latency 150
+    python Backend/benchmarks/load_flow.py --workers 1 --worker-class gevent --users 16 --iterations 20 --latency 150
+
+Or point it at an app already running ( against fake_upstream.py, not the real services ):
+
+    python Backend/benchmarks/load_flow.py --target http://127.0.0.1:5001 --upstream http://127.0.0.1:8089
+'''
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+STEPS = ["search", "select", "render"]
+READY_TIMEOUT = 30
+REQUEST_TIMEOUT = 60
+
+
+class FlowError(Exception):
+    """Raised when a step's response cannot be carried on from."""
+
+
+class _Forms(HTMLParser):
+    """Collects the hidden inputs of every form on a page, with each form's class."""
+
+    def __init__(self):
+        super().__init__()
+        self.forms = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == "form":
+            self.forms.append((attrs.get("class") or "", {}))
+        elif tag == "input" and attrs.get("type") == "hidden" and self.forms and attrs.get("name"):
+            self.forms[-1][1][attrs["name"]] = attrs.get("value") or ""
+
+
+def hidden_forms(html, form_class):
+    parser = _Forms()
+    parser.feed(html)
+    return [fields for classes, fields in parser.forms if form_class in classes.split()]
+
+
+def percentile(values, share):
+    # nearest rank
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, round(share * len(ordered)) - 1))]
+
+
+class VirtualUser(threading.Thread):
+    """One visitor going through search, select and render for a number of iterations."""
+
+    def __init__(self, target, iterations, artist, album, results, seed):
+        super().__init__(daemon=True)
+        self.target = target
+        self.iterations = iterations
+        self.artist = artist
+        self.album = album
+        self.results = results
+        self.random = random.Random(seed)
+
+    def step(self, session, name, data, method="POST", path="/"):
+        started = time.perf_counter()
+        try:
+            fields = {"data": data} if method == "POST" else {"params": data}
+            response = session.request(method, self.target + path, timeout=REQUEST_TIMEOUT, **fields)
+        except requests.RequestException as exc:
+            self.results.append((name, time.perf_counter() - started, False))
+            raise FlowError(f"{name}: {exc}") from exc
+        elapsed = time.perf_counter() - started
+        ok = response.status_code == 200
+        self.results.append((name, elapsed, ok))
+        if not ok:
+            raise FlowError(f"{name}: HTTP {response.status_code}")
+        return response.text
+
+    def flow(self, session):
+        page = self.step(session, "search", {"artist": self.artist, "album": self.album})
+        releases = [fields for fields in hidden_forms(page, "release-form") if fields.get("selected_MBID")]
+        if not releases:
+            raise FlowError("search: no releases")
+        page = self.step(session, "select", self.random.choice(releases))
+        options = hidden_forms(page, "options-form")
+        if not options or not options[0].get("selected_details"):
+            raise FlowError("select: no options form")
+        # the options form is a GET to /wallpaper
+        self.step(
+            session,
+            "render",
+            {
+                **options[0],
+                "wallpaperDevice": self.random.choice(["desktop", "phone"]),
+                "templateSelector": self.random.choice(["white", "dark"]),
+                "backgroundSelector": "default",
+            },
+            method="GET",
+            path="/wallpaper",
+        )
+
+    def run(self):
+        with requests.Session() as session:
+            for _iteration in range(self.iterations):
+                try:
+                    self.flow(session)
+                except FlowError:
+                    # recorded against the step already, start the next flow
+                    continue
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_ready(url, process):
+    deadline = time.monotonic() + READY_TIMEOUT
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise SystemExit(f"{url} exited with {process.returncode} before it was ready")
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise SystemExit(f"{url} was not ready after {READY_TIMEOUT}s")
+
+
+def start_stack(args):
+    # fake upstream first, then gunicorn pointed at it
+    upstream_url = f"http://127.0.0.1:{free_port()}"
+    upstream_cmd = [
+        sys.executable, str(Path(__file__).resolve().parent / "fake_upstream.py"),
+        "--port", upstream_url.rsplit(":", 1)[1],
+        "--latency", str(args.latency), "--jitter", str(args.jitter), "--error-rate", str(args.error_rate),
+    ]
+    if args.rate_limit:
+        upstream_cmd += ["--rate-limit", str(args.rate_limit)]
+    upstream = subprocess.Popen(upstream_cmd, stdout=subprocess.DEVNULL)
+    wait_ready(f"{upstream_url}/_stats", upstream)
+
+    target = f"http://127.0.0.1:{free_port()}"
+    env = {
+        **os.environ,
+        "PYTHONPATH": os.pathsep.join([str(BACKEND_DIR.parent), str(BACKEND_DIR)]),
+        "RESLEEVE_MUSICBRAINZ_URL": upstream_url,
+        "RESLEEVE_COVER_ART_URL": upstream_url,
+        "RESLEEVE_CACHE_DIR": tempfile.mkdtemp(prefix="resleeve-load-"),
+    }
+    env.pop("RESLEEVE_LOCAL_INDEX", None)
+    app_cmd = [
+        sys.executable, "-m", "gunicorn", "app:app",
+        "--bind", target.split("//", 1)[1],
+        "--config", str(BACKEND_DIR / "gunicorn.conf.py"),
+        "--worker-class", args.worker_class,
+        "--workers", str(args.workers),
+        "--threads", str(args.threads),
+        "--timeout", str(REQUEST_TIMEOUT * 2),
+    ]
+    app_server = subprocess.Popen(app_cmd, cwd=BACKEND_DIR, env=env, stderr=subprocess.DEVNULL)
+    wait_ready(target, app_server)
+    return target, upstream_url, [app_server, upstream]
+
+
+def report(results, elapsed, users, iterations):
+    print(f"{users} users x {iterations} flows in {elapsed:.1f}s")
+    print(f"{'step':<8} {'ok':>6} {'failed':>7} {'p50':>9} {'p95':>9} {'p99':>9} {'req/s':>8}")
+    for step in STEPS:
+        timings = [seconds for name, seconds, ok in results if name == step and ok]
+        failed = sum(1 for name, _seconds, ok in results if name == step and not ok)
+        if timings:
+            p50, p95, p99 = (f"{percentile(timings, share) * 1000:7.0f}ms" for share in (0.5, 0.95, 0.99))
+        else:
+            p50 = p95 = p99 = f"{'-':>9}"
+        print(f"{step:<8} {len(timings):>6} {failed:>7} {p50:>9} {p95:>9} {p99:>9} {len(timings) / elapsed:8.2f}")
+    flows = sum(1 for name, _seconds, ok in results if name == "render" and ok)
+    print(f"complete flows: {flows} ({flows / elapsed:.2f}/s)")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the search, select and render flow.")
+    parser.add_argument("--target", help="root URL of a running app, otherwise one is started")
+    parser.add_argument("--upstream", help="URL of the fake upstream the running app uses, for its counts")
+    parser.add_argument("--users", type=int, default=8, help="concurrent virtual users")
+    parser.add_argument("--iterations", type=int, default=10, help="flows per user")
+    parser.add_argument("--artist", default="Radiohead")
+    parser.add_argument("--album", default="OK Computer")
+    parser.add_argument("--seed", type=int, default=0)
+    stack = parser.add_argument_group("started stack")
+    stack.add_argument("--workers", type=int, default=2, help="gunicorn worker processes")
+    stack.add_argument("--threads", type=int, default=1, help="gunicorn threads per worker")
+    stack.add_argument("--worker-class", default="sync", choices=["sync", "gthread", "gevent"])
+    stack.add_argument("--latency", type=float, default=100, help="fake upstream latency in milliseconds")
+    stack.add_argument("--jitter", type=float, default=30, help="fake upstream jitter in milliseconds")
+    stack.add_argument("--error-rate", type=float, default=0, help="share of upstream responses that fail")
+    stack.add_argument("--rate-limit", type=float, help="MusicBrainz requests a second before the fake answers 503")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    processes = []
+    try:
+        if args.target:
+            target, upstream_url = args.target.rstrip("/"), args.upstream
+        else:
+            target, upstream_url, processes = start_stack(args)
+            print(
+                f"gunicorn --worker-class {args.worker_class} --workers {args.workers} --threads {args.threads}, "
+                f"upstream latency {args.latency:.0f}ms"
+            )
+
+        results = []
+        users = [
+            VirtualUser(target, args.iterations, args.artist, args.album, results, args.seed + number)
+            for number in range(args.users)
+        ]
+        started = time.perf_counter()
+        for user in users:
+            user.start()
+        for user in users:
+            user.join()
+        report(results, time.perf_counter() - started, args.users, args.iterations)
+
+        if upstream_url:
+            counts = requests.get(f"{upstream_url}/_stats", timeout=5).json()
+            print("upstream: " + ", ".join(f"{key} x{count}" for key, count in sorted(counts.items())))
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
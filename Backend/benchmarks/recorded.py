@@ -0,0 +1,53 @@
+import io
+import json
+from pathlib import Path
+
+from PIL import Image
+
+
+'''
+RECORDED
+--
+Loads the recorded upstream responses in fixtures/ for the offline benchmarks and the fake upstream server:
+
+- search-release.json and search-artist.json, a MusicBrainz release and artist search
+- release-<mbid>.json, lookups of a few of those releases ( one with two media, one with tracks missing lengths )
+- covers.json, which of the searched releases had front cover art
+
+Covers themselves are not stored: static/fallen.jpg is re-encoded at several sizes and handed out in turn, so
+decoding and downscaling costs vary the way real covers do.
+'''
+
+FIXTURE_DIR = Path(__file__).resolve().parent / "fixtures"
+COVER_SOURCE = Path(__file__).resolve().parent.parent.parent / "static" / "fallen.jpg"
+COVER_SIZES = [250, 500, 680, 1200, 3000]
+
+
+def load_json(name, fixture_dir=FIXTURE_DIR):
+    return json.loads((fixture_dir / name).read_text())
+
+
+def load_lookups(fixture_dir=FIXTURE_DIR):
+    return {
+        path.stem[len("release-"):]: json.loads(path.read_text()) for path in sorted(fixture_dir.glob("release-*.json"))
+    }
+
+
+def cover_images():
+    source = Image.open(COVER_SOURCE).convert("RGB")
+    images = {}
+    for size in COVER_SIZES:
+        buffer = io.BytesIO()
+        source.resize((size, size), Image.Resampling.LANCZOS).save(buffer, "JPEG", quality=90)
+        images[size] = buffer.getvalue()
+    return images
+
+
+def release_covers(images, fixture_dir=FIXTURE_DIR):
+    # MBID -> cover bytes, for the releases that had front art
+    has_front = load_json("covers.json", fixture_dir)
+    return {
+        mbid: images[COVER_SIZES[index % len(COVER_SIZES)]]
+        for index, (mbid, front) in enumerate(has_front.items())
+        if front
+    }
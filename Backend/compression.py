@@ -0,0 +1,215 @@
+import gzip
+import mimetypes
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from flask import request, send_from_directory
+
+from metrics import registry
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, without it everything is offered gzipped
+    brotli = None
+
+
+'''
+COMPRESSION
+--
+Pages go out with the cover, barcode and sometimes the fonts inlined, so they are large and mostly text. Responses
+are compressed on the way out when the client accepts it, brotli first if the module is installed, then gzip.
+
+Only complete 200 responses of text-like types over a size threshold are touched. Streamed responses ( the NDJSON
+search ), files sent straight from disk, images and anything already encoded ( the page cache stores gzip ) pass
+through as they are.
+
+Static files are not compressed per request. Each one gets .gz ( and .br ) siblings, written ahead of time by
+precompress() ( at build, python Backend/compression.py static, and again at startup for anything missing or stale ),
+and send_precompressed() picks the sibling the client accepts. Formats that are compressed already ( the JPEG, the
+PNG, WOFF and WOFF2 ) gain next to nothing, so they get no siblings and are always sent as they are.
+'''
+
+COMPRESS_MIN_BYTES = int(os.environ.get("RESLEEVE_COMPRESS_MIN_BYTES", 1024))
+GZIP_LEVEL = int(os.environ.get("RESLEEVE_GZIP_LEVEL", 6))
+BROTLI_QUALITY = int(os.environ.get("RESLEEVE_BROTLI_QUALITY", 5))
+# static files are compressed once, so they get the slowest, smallest settings
+STATIC_GZIP_LEVEL = 9
+STATIC_BROTLI_QUALITY = 11
+# a sibling has to save at least this share of the file to be worth serving
+STATIC_MIN_SAVING = 0.05
+COMPRESSIBLE_TYPES = {
+    "text/html",
+    "text/css",
+    "text/plain",
+    "text/javascript",
+    "application/javascript",
+    "application/json",
+    "application/x-ndjson",
+    "image/svg+xml",
+    "font/ttf",
+}
+SIBLING_SUFFIXES = {"br": ".br", "gzip": ".gz"}
+# formats that are compressed already, not worth trying again at every startup
+PRECOMPRESSED_SUFFIXES = {".jpg", ".jpeg", ".png", ".gif", ".webp", ".woff", ".woff2", ".gz", ".br", ".zip"}
+
+compression_seconds = registry.histogram(
+    "resleeve_compression_seconds", "CPU time spent compressing responses.", ["encoding"]
+)
+compression_saved = registry.counter(
+    "resleeve_compression_saved_bytes_total", "Bytes not sent thanks to compression.", ["encoding", "source"]
+)
+compression_responses = registry.counter(
+    "resleeve_compressed_responses_total", "Responses sent compressed.", ["encoding", "source"]
+)
+
+# path of every static file with siblings -> { encoding: bytes saved }
+_siblings = {}
+
+
+def _encode(data, encoding, level):
+    if encoding == "br":
+        return brotli.compress(data, quality=level)
+    return gzip.compress(data, level)
+
+
+def _encodings():
+    return ["br", "gzip"] if brotli is not None else ["gzip"]
+
+
+def accepted_encoding(offered):
+    # the first encoding in our order of preference the client accepts
+    for encoding in offered:
+        if encoding in request.accept_encodings:
+            return encoding
+    return None
+
+
+def compress_response(response):
+    if (
+        response.status_code != 200
+        or response.direct_passthrough
+        or response.is_streamed
+        or response.content_encoding
+        or response.mimetype not in COMPRESSIBLE_TYPES
+        or "no-transform" in response.cache_control
+    ):
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = accepted_encoding(_encodings())
+    if encoding is None:
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_BYTES:
+        return response
+
+    started = time.thread_time()
+    compressed = _encode(data, encoding, BROTLI_QUALITY if encoding == "br" else GZIP_LEVEL)
+    compression_seconds.observe(time.thread_time() - started, encoding)
+    if len(compressed) >= len(data):
+        return response
+
+    response.set_data(compressed)
+    response.content_encoding = encoding
+    etag, weak = response.get_etag()
+    if etag:
+        # a different representation, so a different validator
+        response.set_etag(f"{etag}-{encoding}", weak)
+    compression_saved.inc(encoding, "dynamic", amount=len(data) - len(compressed))
+    compression_responses.inc(encoding, "dynamic")
+    return response
+
+
+def _write_atomic(path, data):
+    fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as tmp:
+            tmp.write(data)
+        os.replace(tmp_name, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_name)
+        except OSError:
+            pass
+        raise
+
+
+def precompress(root):
+    # writes missing or stale siblings under root and notes which exist, returns how many were written
+    written = 0
+    for path in sorted(Path(root).rglob("*")):
+        if not path.is_file() or path.name.startswith(".") or path.suffix.lower() in PRECOMPRESSED_SUFFIXES:
+            continue
+        source_stat = path.stat()
+        data = None
+        for encoding in _encodings():
+            sibling = path.with_name(path.name + SIBLING_SUFFIXES[encoding])
+            try:
+                sibling_stat = sibling.stat()
+            except FileNotFoundError:
+                sibling_stat = None
+            if sibling_stat is None or sibling_stat.st_mtime < source_stat.st_mtime:
+                if data is None:
+                    data = path.read_bytes()
+                level = STATIC_BROTLI_QUALITY if encoding == "br" else STATIC_GZIP_LEVEL
+                compressed = _encode(data, encoding, level)
+                if len(compressed) > len(data) * (1 - STATIC_MIN_SAVING):
+                    if sibling_stat is not None:
+                        sibling.unlink()
+                    continue
+                try:
+                    _write_atomic(sibling, compressed)
+                except OSError:
+                    # a read-only checkout, serve the file as it is
+                    continue
+                written += 1
+                sibling_size = len(compressed)
+            else:
+                sibling_size = sibling_stat.st_size
+            _siblings.setdefault(str(path.resolve()), {})[encoding] = source_stat.st_size - sibling_size
+    return written
+
+
+def send_precompressed(directory, filename, **kwargs):
+    # send_from_directory, but from a precompressed sibling when the client accepts one
+    path = str((Path(directory) / filename).resolve())
+    saved = _siblings.get(path)
+    encoding = accepted_encoding([encoding for encoding in _encodings() if encoding in (saved or {})])
+    if encoding is None:
+        response = send_from_directory(directory, filename, **kwargs)
+    else:
+        # typed as the original file, not as a .gz / .br
+        if not kwargs.get("mimetype"):
+            kwargs["mimetype"] = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        response = send_from_directory(directory, filename + SIBLING_SUFFIXES[encoding], **kwargs)
+        response.content_encoding = encoding
+        if response.status_code == 200:
+            compression_saved.inc(encoding, "static", amount=saved[encoding])
+            compression_responses.inc(encoding, "static")
+    if saved:
+        response.vary.add("Accept-Encoding")
+    return response
+
+
+def init_compression(app):
+    try:
+        precompress(app.static_folder)
+    except OSError:
+        pass
+
+    @app.after_request
+    def _compress(response):
+        return compress_response(response)
+
+    # static files are served from their siblings too
+    def static(filename):
+        return send_precompressed(app.static_folder, filename, max_age=app.get_send_file_max_age(filename))
+
+    app.view_functions["static"] = static
+
+
+if __name__ == "__main__":
+    for folder in sys.argv[1:] or ["static"]:
+        print(f"{folder}: {precompress(folder)} precompressed files written")
@@ -0,0 +1,66 @@
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+
+'''
+CONTEXT STORE
+--
+When a release is picked, the page it comes back to already has everything the wallpaper needs: the release
+details, the parsed tracklist and the palette. Rather than posting all of that back as a stringified list and
+fetching it again, the assembled context is kept here under a short random token, and the render only has to apply
+the template and background choices on top.
+
+Tokens are opaque, expire after a TTL and the oldest entries are dropped past a fixed count. A token can miss ( it
+expired, or the render landed on another worker ), so the form still carries the details as JSON to rebuild from.
+'''
+
+CONTEXT_TTL = int(os.environ.get("RESLEEVE_CONTEXT_TTL", 30 * 60))
+CONTEXT_MAX_ENTRIES = int(os.environ.get("RESLEEVE_CONTEXT_ENTRIES", 2048))
+TOKEN_BYTES = 12
+
+
+class ContextStore:
+    """TTL bounded store of assembled album contexts, addressed by random tokens."""
+
+    def __init__(self, ttl=CONTEXT_TTL, max_entries=CONTEXT_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def put(self, context):
+        token = secrets.token_urlsafe(TOKEN_BYTES)
+        now = time.monotonic()
+        with self._lock:
+            self._entries[token] = (now + self.ttl, context)
+            # entries go in oldest first and share one TTL, so expired ones are always at the front
+            while self._entries:
+                oldest_token, (expires, _context) = next(iter(self._entries.items()))
+                if expires >= now and len(self._entries) <= self.max_entries:
+                    break
+                del self._entries[oldest_token]
+        return token
+
+    def get(self, token):
+        if not token:
+            return None
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None or entry[0] < time.monotonic():
+                self._entries.pop(token, None)
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[1]
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+
+album_contexts = ContextStore()
@@ -0,0 +1,131 @@
+import fcntl
+import hashlib
+import os
+import tempfile
+import threading
+from pathlib import Path
+
+
+'''
+COVER STORE
+--
+Covers are kept on local disk so every gunicorn worker ( and every restart ) shares the same copy instead of
+going back to coverartarchive.org. Entries are addressed by a hash of their key ( the release MBID ), so user
+supplied MBIDs can never escape the store directory.
+
+Each entry is a single file: the content type on the first line, followed by the raw image bytes. Writes go to a
+temporary file that is renamed into place, so readers in other workers only ever see complete entries.
+
+Least recently used entries are evicted once the store grows past its byte budget. Reads bump the file's
+modification time, and the sweep that removes the oldest files runs under an exclusive lock file so only one
+worker evicts at a time.
+'''
+
+CACHE_DIR = Path(os.environ.get("RESLEEVE_CACHE_DIR", Path(tempfile.gettempdir(), "resleeve")))
+COVER_STORE_DIR = CACHE_DIR / "covers"
+COVER_STORE_MAX_BYTES = int(os.environ.get("RESLEEVE_COVER_STORE_BYTES", 512 * 1024 * 1024))
+# fraction of the budget that may be written by a worker before it sweeps the store again
+SWEEP_FRACTION = 0.05
+
+
+class CoverStore:
+    """Shared on-disk store of raw cover image bytes and their content type."""
+
+    def __init__(self, root, max_bytes=COVER_STORE_MAX_BYTES):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self._written_since_sweep = 0
+        self._swept = False
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key):
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return self.root / digest[:2] / digest
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as entry:
+                content_type = entry.readline().decode("ascii").strip()
+                data = entry.read()
+            # mark the entry as recently used for eviction
+            os.utime(path)
+        except (OSError, UnicodeDecodeError):
+            content_type, data = None, None
+        with self._lock:
+            if not content_type or not data:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return data, content_type
+
+    def put(self, key, data, content_type):
+        path = self._path(key)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+            try:
+                with os.fdopen(fd, "wb") as tmp:
+                    tmp.write(content_type.encode("ascii", "replace") + b"\n")
+                    tmp.write(data)
+                os.replace(tmp_name, path)
+            except BaseException:
+                try:
+                    os.unlink(tmp_name)
+                except OSError:
+                    pass
+                raise
+        except OSError:
+            # the store is only an optimisation, never fail a request because of it
+            return
+
+        with self._lock:
+            self._written_since_sweep += len(data)
+            due = not self._swept or self._written_since_sweep >= self.max_bytes * SWEEP_FRACTION
+            if due:
+                self._written_since_sweep = 0
+                self._swept = True
+        if due:
+            self.sweep()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+    def sweep(self):
+        # removes the least recently used entries until the store fits the byte budget
+        try:
+            self.root.mkdir(parents=True, exist_ok=True)
+            with open(self.root / ".lock", "w") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                entries = []
+                total = 0
+                for bucket in os.scandir(self.root):
+                    if not bucket.is_dir():
+                        continue
+                    for entry in os.scandir(bucket.path):
+                        if entry.name.startswith(".tmp-"):
+                            continue
+                        try:
+                            stat = entry.stat()
+                        except OSError:
+                            continue
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+                        total += stat.st_size
+                if total <= self.max_bytes:
+                    return
+                entries.sort()
+                for _mtime, size, entry_path in entries:
+                    try:
+                        os.unlink(entry_path)
+                    except OSError:
+                        continue
+                    total -= size
+                    if total <= self.max_bytes:
+                        break
+        except OSError:
+            return
+
+
+cover_store = CoverStore(COVER_STORE_DIR)
@@ -0,0 +1,27 @@
+import base64
+import io
+
+from PIL import Image
+
+
+class Cover:
+    """Raw cover bytes, decoded into downscaled images for palette and thumbnail work on demand."""
+
+    __slots__ = ("data", "content_type")
+
+    def __init__(self, data, content_type="image/jpeg"):
+        self.data = data
+        self.content_type = content_type
+
+    def image(self, max_side):
+        # RGB and no larger than max_side on its longest edge; decoded on every call and never kept, since covers
+        # sit in the fetch cache and what is made from the image ( palettes, variants ) is cached on its own
+        img = Image.open(io.BytesIO(self.data)).convert("RGB")
+        if max(img.size) > max_side:
+            img.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+        return img
+
+    def data_uri(self):
+        # only built at the template boundary, where a self-contained page needs the image inline
+        b64_image = base64.b64encode(self.data).decode("ascii")
+        return f"data:{self.content_type};base64,{b64_image}"
@@ -0,0 +1,205 @@
+import base64
+import hashlib
+import io
+import logging
+import os
+import string
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from pathlib import Path
+
+from cover_store import CACHE_DIR, CoverStore
+from singleflight import singleflight
+
+try:
+    from fontTools import subset as font_subset
+    from fontTools.ttLib import TTFont
+except ImportError:  # subsetting is optional, without it exports embed the full fonts
+    font_subset = None
+    TTFont = None
+else:
+    # fontTools warns about every table it does not know how to subset
+    logging.getLogger("fontTools.subset").setLevel(logging.ERROR)
+
+
+'''
+FONTS
+--
+The wallpaper fonts are served as static files from versioned URLs ( /fonts/<content hash>/<file> ) so browsers
+cache them for good instead of receiving them base64 encoded in every page.
+
+The canvas export is the one place that still needs the fonts inline: the wallpaper is drawn through an SVG image,
+which cannot load anything external. For that, export_font_css() subsets the fonts down to the glyphs the album
+actually uses ( printable ASCII for the static labels, plus whatever the artist, title and track names contain )
+and caches the result by a hash of that glyph set.
+
+Subsetting is pure Python and takes a few hundred milliseconds per face, most of it decompiling the layout tables. It
+runs in its own process ( SUBSET_WORKERS ) so it never holds a request thread or the GIL, each of those processes
+reads the font files once, and finished CSS goes into a store on disk that every gunicorn worker shares, so a glyph
+set is subset once rather than once per worker. A parsed TTFont is not kept to copy from: deep copying one costs
+more than parsing the bytes again.
+'''
+
+FONT_DIR = Path(__file__).resolve().parent.parent / "static" / "fonts"
+FONT_FILES = {
+    "regular_ttf": "DejaVuSans.ttf",
+    "regular_woff": "DejaVuSans.woff",
+    "regular_woff2": "DejaVuSans.woff2",
+    "bold_ttf": "DejaVuSans-Bold.ttf",
+    "bold_woff": "DejaVuSans-Bold.woff",
+    "bold_woff2": "DejaVuSans-Bold.woff2",
+}
+FONT_MIMETYPES = {
+    ".ttf": "font/ttf",
+    ".woff": "font/woff",
+    ".woff2": "font/woff2",
+}
+FONT_MAX_AGE = 60 * 60 * 24 * 365
+# the family name and weights the phone templates declare
+EXPORT_FONT_FACES = [
+    ("DejaVuSans.ttf", "400"),
+    ("DejaVuSans-Bold.ttf", "600 700"),
+]
+BASE_GLYPHS = string.printable
+SUBSET_CACHE_SIZE = 64
+SUBSET_WORKERS = 1
+SUBSET_TIMEOUT = 30
+SUBSET_STORE_MAX_BYTES = int(os.environ.get("RESLEEVE_SUBSET_STORE_BYTES", 64 * 1024 * 1024))
+
+subset_store = CoverStore(CACHE_DIR / "font_subsets", SUBSET_STORE_MAX_BYTES)
+_subset_pool = None
+_subset_pool_lock = threading.Lock()
+
+# pages for the same album asked for together share one subsetting run
+subset_flight = singleflight("font_subset")
+
+
+@lru_cache(maxsize=None)
+def font_version(filename):
+    try:
+        return hashlib.sha256(FONT_DIR.joinpath(filename).read_bytes()).hexdigest()[:12]
+    except OSError:
+        return None
+
+
+def font_paths():
+    # (key, filename, version) for every font file that exists
+    return [
+        (key, filename, font_version(filename))
+        for key, filename in FONT_FILES.items()
+        if font_version(filename) is not None
+    ]
+
+
+def _glyph_set(texts):
+    chars = set(BASE_GLYPHS)
+    for text in texts:
+        if text:
+            chars.update(str(text))
+    return "".join(sorted(chars))
+
+
+@lru_cache(maxsize=None)
+def _font_bytes(filename):
+    # read once per subsetting process, every subset parses its own TTFont from them
+    return FONT_DIR.joinpath(filename).read_bytes()
+
+
+def _subset_woff(filename, glyphs):
+    font = TTFont(io.BytesIO(_font_bytes(filename)))
+    options = font_subset.Options()
+    options.flavor = "woff"
+    options.layout_features = ["*"]
+    options.notdef_outline = True
+    subsetter = font_subset.Subsetter(options)
+    subsetter.populate(text=glyphs)
+    subsetter.subset(font)
+    buf = io.BytesIO()
+    font.flavor = "woff"
+    font.save(buf)
+    return buf.getvalue()
+
+
+def subset_pool(broken=None):
+    # a pool that lost its worker is replaced, like the render pool
+    global _subset_pool
+    with _subset_pool_lock:
+        if _subset_pool is None or _subset_pool is broken:
+            _subset_pool = ProcessPoolExecutor(max_workers=SUBSET_WORKERS)
+        return _subset_pool
+
+
+def _subset_elsewhere(filename, glyphs):
+    pool = subset_pool()
+    try:
+        return pool.submit(_subset_woff, filename, glyphs).result(timeout=SUBSET_TIMEOUT)
+    except BrokenProcessPool:
+        subset_pool(broken=pool)
+        raise
+
+
+def _store_key(key):
+    # the font versions are part of the key, so updated fonts never pick up old subsets
+    return "|".join([key, *(str(font_version(filename)) for filename, _weight in EXPORT_FONT_FACES)])
+
+
+_export_css = OrderedDict()
+_export_lock = threading.Lock()
+
+
+def export_font_css(texts):
+    # @font-face rules with the fonts inlined, subset to the glyphs in texts when fontTools is installed
+    glyphs = _glyph_set(texts) if font_subset is not None else None
+    key = hashlib.sha1(glyphs.encode("utf-8")).hexdigest() if glyphs else "full"
+    with _export_lock:
+        css = _export_css.get(key)
+        if css is not None:
+            _export_css.move_to_end(key)
+            return css
+
+    stored = subset_store.get(_store_key(key)) if glyphs is not None else None
+    if stored is not None:
+        css = stored[0].decode("utf-8")
+    else:
+        css, complete = _build_export_css(glyphs)
+        if not complete:
+            # a face fell back to the full font, try subsetting again next time
+            return css
+        if glyphs is not None:
+            subset_store.put(_store_key(key), css.encode("utf-8"), "text/css")
+    with _export_lock:
+        _export_css[key] = css
+        while len(_export_css) > SUBSET_CACHE_SIZE:
+            _export_css.popitem(last=False)
+    return css
+
+
+# the CSS for one glyph set ( None for the full fonts ), and whether every face was subset as asked
+@subset_flight
+def _build_export_css(glyphs):
+    rules = []
+    complete = True
+    for filename, weight in EXPORT_FONT_FACES:
+        data = None
+        if glyphs is not None:
+            try:
+                data = _subset_elsewhere(filename, glyphs)
+                mimetype, font_format = "font/woff", "woff"
+            except Exception:
+                complete = False
+        if data is None:
+            try:
+                data = FONT_DIR.joinpath(filename).read_bytes()
+            except OSError:
+                continue
+            mimetype, font_format = "font/ttf", "truetype"
+        b64 = base64.b64encode(data).decode("ascii")
+        rules.append(
+            "@font-face { font-family: 'ResleeveSans'; "
+            f"src: url(\"data:{mimetype};base64,{b64}\") format(\"{font_format}\"); "
+            f"font-weight: {weight}; font-style: normal; }}"
+        )
+    return "\n".join(rules), complete
@@ -0,0 +1,26 @@
+import os
+
+
+'''
+GUNICORN
+--
+Worker settings, read with gunicorn --config Backend/gunicorn.conf.py app:app ( anything given on the command line
+still wins ).
+
+A request spends most of its time waiting on MusicBrainz and the Cover Art Archive. With the default sync worker each
+of those waits holds a whole worker. RESLEEVE_WORKER_CLASS=gevent serves the same sync views from gevent instead: the
+standard library is monkey patched before the app is imported, every request is a greenlet, and one waiting on a
+socket yields to the others, so a single worker holds up to RESLEEVE_WORKER_CONNECTIONS slow requests at once. The
+thread pools the views already use ( covers, the album context legs, palettes, the prefetcher ) become greenlets too.
+
+Upstream requests stay bounded per host by HttpClient ( RESLEEVE_UPSTREAM_CONCURRENCY ), so however many requests
+are waiting, every upstream call goes over a pooled keep-alive connection.
+
+The CPU heavy steps are kept off the hub so the other greenlets keep being served while they run: palettes and
+barcodes go to real OS threads ( see offload.py ), export font subsets and wallpaper PNGs to their own processes.
+
+    RESLEEVE_WORKER_CLASS=gevent gunicorn --config Backend/gunicorn.conf.py --bind 0.0.0.0:5001 app:app
+'''
+
+worker_class = os.environ.get("RESLEEVE_WORKER_CLASS", "sync")
+worker_connections = int(os.environ.get("RESLEEVE_WORKER_CONNECTIONS", 200))
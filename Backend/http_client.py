@@ -0,0 +1,237 @@
+import threading
+import time
+from collections import namedtuple
+from urllib.parse import urlsplit
+
+import requests
+from requests import RequestException
+from requests.adapters import HTTPAdapter
+
+from metrics import upstream_responses, upstream_seconds
+
+
+'''
+HTTP CLIENT
+--
+Every upstream call ( MusicBrainz and the Cover Art Archive ) goes through one HttpClient. It keeps a pooled,
+keep-alive requests.Session per host, so repeated lookups reuse the same TCP+TLS connection instead of paying a
+new handshake each time, and it owns the retry / backoff / timeout loop that used to be copied into every fetcher.
+No more than pool_maxsize requests to one host are out at once, the rest wait for a slot, so every request has a
+pooled connection to go over however many threads ( or greenlets ) are asking.
+
+Retries follow the same rules the fetchers always had:
+- 200 is returned straight away
+- any other 4xx is final ( retrying a bad query or a missing release will not help )
+- 5xx responses and network errors are retried with a linear backoff
+
+A host can also be given a rate limit ( MusicBrainz asks for no more than one request a second per client ). Every
+request to it, retries included, then waits for its turn before going out.
+
+A host can instead ( or as well ) be given a request budget, a token bucket that every request to it spends from
+without waiting. It never holds a request back, it only tells background work ( the prefetcher ) whether there is
+room to spare, so speculative requests fit into the gaps interactive traffic leaves. A 503 or 429 from the host
+empties the bucket.
+'''
+
+REDIRECT_POOLS = 8
+# answers a host gives when it wants fewer requests
+SLOW_DOWN_STATUSES = {429, 503}
+
+# attempts, seconds of backoff per attempt, request timeout in seconds
+RetryPolicy = namedtuple("RetryPolicy", ["attempts", "backoff", "timeout"])
+
+
+class UpstreamError(Exception):
+    """Raised when an upstream request does not produce a 200 response."""
+
+    def __init__(self, status=None):
+        super().__init__(status)
+        self.status = status
+
+
+class RateLimit:
+    """Spaces requests at least 1 / per_second seconds apart."""
+
+    def __init__(self, per_second):
+        self.interval = 1.0 / per_second
+        self._next = 0.0
+        self._lock = threading.Lock()
+        self.waited = 0.0
+
+    def wait(self):
+        # reserves the next free slot, then sleeps until it comes round
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+            self.waited += slot - now
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class RequestBudget:
+    """Token bucket that requests always spend from, and background work only borrows spare tokens of."""
+
+    def __init__(self, per_second, burst=None):
+        self.per_second = per_second
+        self.burst = burst or max(1.0, per_second)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.spent = 0
+
+    def _refill(self):
+        # caller holds the lock
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.per_second)
+        self._updated = now
+
+    def spend(self):
+        # a request going out anyway, the bucket can go into debt
+        with self._lock:
+            self._refill()
+            self._tokens -= 1
+            self.spent += 1
+
+    def spare(self, reserve=0):
+        # True when a request could go out and still leave reserve tokens for interactive traffic
+        with self._lock:
+            self._refill()
+            return self._tokens >= reserve + 1
+
+    def empty(self):
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, 0)
+
+    def stats(self):
+        with self._lock:
+            self._refill()
+            return {"budget_tokens": round(self._tokens, 2), "budget_spent": self.spent}
+
+
+class HttpClient:
+    """Per-host pooled sessions with a shared retry policy."""
+
+    def __init__(self, headers=None, pool_maxsize=10):
+        self.headers = dict(headers or {})
+        self.pool_maxsize = pool_maxsize
+        self._sessions = {}
+        self._slots = {}
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._retries = 0
+        self._rate_limits = {}
+        self._budgets = {}
+
+    def set_rate_limit(self, host, per_second):
+        # None removes the limit
+        if per_second:
+            self._rate_limits[host] = RateLimit(per_second)
+        else:
+            self._rate_limits.pop(host, None)
+
+    def set_budget(self, host, per_second, burst=None):
+        # None removes the budget
+        if per_second:
+            self._budgets[host] = RequestBudget(per_second, burst)
+        else:
+            self._budgets.pop(host, None)
+
+    def has_spare(self, host, reserve=0):
+        # whether a speculative request to host fits in its budget, hosts without one always have room
+        budget = self._budgets.get(host)
+        return budget is None or budget.spare(reserve)
+
+    def _session(self, host):
+        session = self._sessions.get(host)
+        if session is not None:
+            return session
+        with self._lock:
+            session = self._sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                session.headers.update(self.headers)
+                # pools are sized so every concurrent worker can hold a connection, and a few are kept per
+                # session because cover requests redirect on to archive.org mirrors
+                adapter = HTTPAdapter(pool_connections=REDIRECT_POOLS, pool_maxsize=self.pool_maxsize)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self._slots[host] = threading.BoundedSemaphore(self.pool_maxsize)
+                self._sessions[host] = session
+        return session
+
+    def get(self, url, policy, params=None):
+        host = urlsplit(url).netloc
+        started = time.perf_counter()
+        status = "error"
+        try:
+            response = self._get(host, url, policy, params)
+        except UpstreamError as exc:
+            status = exc.status or "error"
+            raise
+        else:
+            status = response.status_code
+            return response
+        finally:
+            upstream_seconds.observe(time.perf_counter() - started, host)
+            upstream_responses.inc(host, status)
+
+    def _get(self, host, url, policy, params):
+        session = self._session(host)
+        slots = self._slots[host]
+        rate_limit = self._rate_limits.get(host)
+        budget = self._budgets.get(host)
+        status = None
+        for attempt in range(policy.attempts):
+            if attempt:
+                with self._lock:
+                    self._retries += 1
+            if rate_limit is not None:
+                rate_limit.wait()
+            if budget is not None:
+                budget.spend()
+            try:
+                with self._lock:
+                    self._requests += 1
+                with slots:
+                    response = session.get(url, params=params, timeout=policy.timeout)
+            except RequestException as exc:
+                if attempt == policy.attempts - 1:
+                    raise UpstreamError from exc
+            else:
+                status = response.status_code
+                if status == 200:
+                    return response
+                if budget is not None and status in SLOW_DOWN_STATUSES:
+                    budget.empty()
+                if 400 <= status < 500:
+                    raise UpstreamError(status)
+            if attempt < policy.attempts - 1:
+                time.sleep(policy.backoff * (attempt + 1))
+        raise UpstreamError(status)
+
+    def stats(self):
+        # connection reuse straight from the urllib3 pools behind each session
+        hosts = {}
+        for host, session in list(self._sessions.items()):
+            connections = 0
+            pooled_requests = 0
+            adapter = session.get_adapter(f"https://{host}")
+            pools = adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                connections += pool.num_connections
+                pooled_requests += pool.num_requests
+            hosts[host] = {
+                "requests": pooled_requests,
+                "connections": connections,
+                "reused": max(0, pooled_requests - connections),
+            }
+        for host, rate_limit in self._rate_limits.items():
+            hosts.setdefault(host, {})["rate_limited_seconds"] = round(rate_limit.waited, 3)
+        for host, budget in self._budgets.items():
+            hosts.setdefault(host, {}).update(budget.stats())
+        return {"requests": self._requests, "retries": self._retries, "hosts": hosts}
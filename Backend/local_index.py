@@ -0,0 +1,315 @@
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from pathlib import Path
+
+
+'''
+LOCAL INDEX
+--
+An optional offline copy of the MusicBrainz catalogue, so search and the autocomplete can be answered from a local
+SQLite FTS5 index in a millisecond or two instead of a round trip to musicbrainz.org for every keystroke.
+
+It is built from the MusicBrainz JSON dumps ( one release or artist object per line ), or any subset of them:
+
+    python Backend/local_index.py --db musicbrainz.sqlite3 import release.jsonl artist.jsonl
+    python Backend/local_index.py --db musicbrainz.sqlite3 query artist "radioh"
+
+Imports are upserts keyed by MBID, so newer dumps or partial extracts can be layered onto an existing index. Only the
+fields the search results use are kept ( no tracklists, those still come from the web service ).
+
+Point RESLEEVE_LOCAL_INDEX at the database to enable it. Anything the index has no match for still goes to the
+network, so a subset is enough to take the common queries off MusicBrainz. Backend/fixtures/musicbrainz-sample.jsonl
+is a small made up dump in the same format to try it with.
+'''
+
+LOCAL_INDEX_PATH = os.environ.get("RESLEEVE_LOCAL_INDEX")
+SEARCH_LIMIT = 25
+IMPORT_BATCH = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS releases (
+    rowid INTEGER PRIMARY KEY,
+    mbid TEXT NOT NULL UNIQUE,
+    title TEXT NOT NULL,
+    artist TEXT NOT NULL,
+    date TEXT,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS artists (
+    rowid INTEGER PRIMARY KEY,
+    mbid TEXT NOT NULL UNIQUE,
+    name TEXT NOT NULL,
+    sort_name TEXT
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS releases_fts USING fts5(
+    title, artist, content='releases', content_rowid='rowid',
+    tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS artists_fts USING fts5(
+    name, sort_name, content='artists', content_rowid='rowid',
+    tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+);
+CREATE TRIGGER IF NOT EXISTS releases_ai AFTER INSERT ON releases BEGIN
+    INSERT INTO releases_fts(rowid, title, artist) VALUES (new.rowid, new.title, new.artist);
+END;
+CREATE TRIGGER IF NOT EXISTS releases_ad AFTER DELETE ON releases BEGIN
+    INSERT INTO releases_fts(releases_fts, rowid, title, artist) VALUES ('delete', old.rowid, old.title, old.artist);
+END;
+CREATE TRIGGER IF NOT EXISTS releases_au AFTER UPDATE ON releases BEGIN
+    INSERT INTO releases_fts(releases_fts, rowid, title, artist) VALUES ('delete', old.rowid, old.title, old.artist);
+    INSERT INTO releases_fts(rowid, title, artist) VALUES (new.rowid, new.title, new.artist);
+END;
+CREATE TRIGGER IF NOT EXISTS artists_ai AFTER INSERT ON artists BEGIN
+    INSERT INTO artists_fts(rowid, name, sort_name) VALUES (new.rowid, new.name, new.sort_name);
+END;
+CREATE TRIGGER IF NOT EXISTS artists_ad AFTER DELETE ON artists BEGIN
+    INSERT INTO artists_fts(artists_fts, rowid, name, sort_name) VALUES ('delete', old.rowid, old.name, old.sort_name);
+END;
+CREATE TRIGGER IF NOT EXISTS artists_au AFTER UPDATE ON artists BEGIN
+    INSERT INTO artists_fts(artists_fts, rowid, name, sort_name) VALUES ('delete', old.rowid, old.name, old.sort_name);
+    INSERT INTO artists_fts(rowid, name, sort_name) VALUES (new.rowid, new.name, new.sort_name);
+END;
+"""
+
+
+class LocalIndexError(Exception):
+    """Raised when a dump cannot be imported into the local index."""
+
+
+def _credit_name(credits):
+    # "Artist A & Artist B", the way MusicBrainz displays a multi artist credit
+    return "".join(f"{credit.get('name', '')}{credit.get('joinphrase', '')}" for credit in credits or [])
+
+
+def _compact_release(release):
+    # the parts of a release the search results and parse_release() read, in the search API's shape
+    media = [
+        {"format": medium.get("format"), "track-count": medium.get("track-count", len(medium.get("tracks") or []))}
+        for medium in release.get("media") or []
+    ]
+    compact = {
+        "id": release["id"],
+        "title": release.get("title") or "",
+        "artist-credit": [
+            {"name": credit.get("name", ""), "joinphrase": credit.get("joinphrase", "")}
+            for credit in release.get("artist-credit") or []
+        ],
+        "country": release.get("country"),
+        "date": release.get("date"),
+        "barcode": release.get("barcode"),
+        "track-count": release.get("track-count", sum(medium["track-count"] or 0 for medium in media)),
+        "media": media,
+        "release-group": {"primary-type": (release.get("release-group") or {}).get("primary-type")},
+    }
+    events = []
+    for event in release.get("release-events") or []:
+        area = event.get("area") or {}
+        events.append({"date": event.get("date"), "area": {"iso-3166-1-codes": area.get("iso-3166-1-codes", [])}})
+    if events:
+        compact["release-events"] = events
+    return compact
+
+
+def _fts_query(text, prefix=False, column=None):
+    # every word has to match; words are quoted so user input can never be read as FTS syntax
+    words = [word.replace('"', '""') for word in text.split()]
+    if not words:
+        return None
+    terms = [f'"{word}"*' if prefix and index == len(words) - 1 else f'"{word}"' for index, word in enumerate(words)]
+    query = " ".join(terms)
+    return f"{column} : ({query})" if column else query
+
+
+class LocalIndex:
+    """SQLite FTS5 index of MusicBrainz releases and artists."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._local = threading.local()
+        self.hits = 0
+        self.misses = 0
+
+    def _connection(self):
+        # one read only connection per thread
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+            self._local.connection = connection
+        return connection
+
+    def _count(self, found):
+        if found:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return found
+
+    def search_releases(self, artist, album, limit=SEARCH_LIMIT):
+        # the same shape as the search API response, None when nothing matches
+        artist_query = _fts_query(artist, column="artist")
+        album_query = _fts_query(album, column="title")
+        if not artist_query or not album_query:
+            return None
+        rows = self._connection().execute(
+            "SELECT r.data FROM releases_fts JOIN releases r ON r.rowid = releases_fts.rowid "
+            "WHERE releases_fts MATCH ? ORDER BY bm25(releases_fts), r.date LIMIT ?",
+            (f"{album_query} AND {artist_query}", limit),
+        ).fetchall()
+        if not self._count(rows):
+            return None
+        return {"releases": [json.loads(data) for (data,) in rows]}
+
+    def artist_suggestions(self, query, limit):
+        match = _fts_query(query, prefix=True)
+        if not match:
+            return []
+        rows = self._connection().execute(
+            "SELECT a.name FROM artists_fts JOIN artists a ON a.rowid = artists_fts.rowid "
+            "WHERE artists_fts MATCH ? ORDER BY bm25(artists_fts) LIMIT ?",
+            (match, limit * 2),
+        ).fetchall()
+        if not rows:
+            # an index built from release dumps alone still knows the credited artists
+            rows = self._connection().execute(
+                "SELECT r.artist FROM releases_fts JOIN releases r ON r.rowid = releases_fts.rowid "
+                "WHERE releases_fts MATCH ? ORDER BY bm25(releases_fts) LIMIT ?",
+                (_fts_query(query, prefix=True, column="artist"), limit * 4),
+            ).fetchall()
+        return self._count([name for (name,) in rows])
+
+    def album_suggestions(self, artist, query, limit):
+        artist_query = _fts_query(artist, column="artist")
+        album_query = _fts_query(query, prefix=True, column="title")
+        if not artist_query or not album_query:
+            return []
+        rows = self._connection().execute(
+            "SELECT r.title FROM releases_fts JOIN releases r ON r.rowid = releases_fts.rowid "
+            "WHERE releases_fts MATCH ? ORDER BY bm25(releases_fts) LIMIT ?",
+            (f"{album_query} AND {artist_query}", limit * 4),
+        ).fetchall()
+        return self._count([title for (title,) in rows])
+
+    def stats(self):
+        return {"path": str(self.path), "hits": self.hits, "misses": self.misses}
+
+
+def open_index(path=LOCAL_INDEX_PATH):
+    # None unless the index has been configured and built
+    if not path or not Path(path).is_file():
+        return None
+    return LocalIndex(path)
+
+
+def _upsert_release(db, release):
+    compact = _compact_release(release)
+    db.execute(
+        "INSERT INTO releases (mbid, title, artist, date, data) VALUES (?, ?, ?, ?, ?) "
+        "ON CONFLICT(mbid) DO UPDATE SET title = excluded.title, artist = excluded.artist, "
+        "date = excluded.date, data = excluded.data",
+        (
+            compact["id"],
+            compact["title"],
+            _credit_name(compact["artist-credit"]),
+            compact.get("date"),
+            json.dumps(compact, separators=(",", ":")),
+        ),
+    )
+
+
+def _upsert_artist(db, artist):
+    db.execute(
+        "INSERT INTO artists (mbid, name, sort_name) VALUES (?, ?, ?) "
+        "ON CONFLICT(mbid) DO UPDATE SET name = excluded.name, sort_name = excluded.sort_name",
+        (artist["id"], artist.get("name") or "", artist.get("sort-name")),
+    )
+
+
+def import_dump(db_path, dump_path):
+    # loads one JSON lines dump of releases or artists ( told apart per line ), returns ( releases, artists )
+    counts = [0, 0]
+    db = sqlite3.connect(db_path)
+    try:
+        db.executescript(SCHEMA)
+        with open(dump_path, encoding="utf-8") as dump:
+            for number, line in enumerate(dump, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    entity = json.loads(line)
+                except ValueError as exc:
+                    raise LocalIndexError(f"{dump_path}:{number} is not valid JSON") from exc
+                if "id" not in entity:
+                    raise LocalIndexError(f"{dump_path}:{number} has no id")
+                if "artist-credit" in entity or "media" in entity or "release-group" in entity:
+                    _upsert_release(db, entity)
+                    counts[0] += 1
+                else:
+                    _upsert_artist(db, entity)
+                    counts[1] += 1
+                if sum(counts) % IMPORT_BATCH == 0:
+                    db.commit()
+        db.execute(
+            "INSERT INTO meta (key, value) VALUES ('imported', ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),),
+        )
+        db.commit()
+    except OSError as exc:
+        raise LocalIndexError(f"could not read {dump_path}: {exc}") from exc
+    finally:
+        db.close()
+    return tuple(counts)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build or query the local MusicBrainz index.")
+    parser.add_argument("--db", default=LOCAL_INDEX_PATH, required=LOCAL_INDEX_PATH is None)
+    commands = parser.add_subparsers(dest="command", required=True)
+    import_command = commands.add_parser("import", help="load JSON lines release / artist dumps")
+    import_command.add_argument("dumps", nargs="+")
+    query_command = commands.add_parser("query", help="try a lookup against the index")
+    query_command.add_argument("kind", choices=["artist", "album", "search"])
+    query_command.add_argument("terms", nargs="+", help="artist query, or artist then album")
+    args = parser.parse_args(argv)
+
+    if args.command == "import":
+        for dump in args.dumps:
+            try:
+                releases, artists = import_dump(args.db, dump)
+            except LocalIndexError as exc:
+                print(f"error: {exc}", file=sys.stderr)
+                return 1
+            print(f"{dump}: {releases} releases, {artists} artists")
+        return 0
+
+    index = open_index(args.db)
+    if index is None:
+        print(f"error: no index at {args.db}", file=sys.stderr)
+        return 1
+    started = time.perf_counter()
+    if args.kind == "artist":
+        result = index.artist_suggestions(" ".join(args.terms), SEARCH_LIMIT)
+    elif len(args.terms) < 2:
+        parser.error("album and search need an artist and an album")
+    elif args.kind == "album":
+        result = index.album_suggestions(args.terms[0], " ".join(args.terms[1:]), SEARCH_LIMIT)
+    else:
+        found = index.search_releases(args.terms[0], " ".join(args.terms[1:]))
+        result = [f"{release['title']} ({release['id']})" for release in (found or {}).get("releases", [])]
+    elapsed = (time.perf_counter() - started) * 1000
+    for item in result:
+        print(item)
+    print(f"{len(result)} results in {elapsed:.2f} ms")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,185 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+
+'''
+METRICS
+--
+An in-process registry of counters and latency histograms, written out in the Prometheus text format on /metrics.
+
+Recording is a lock and a couple of additions, and nothing is formatted until a scrape asks for it. Numbers other
+modules already keep ( cache hits and misses ) are not counted twice: collectors registered here read them from the
+existing stats() methods only at scrape time.
+
+Every gunicorn worker keeps its own registry, so a scrape sees the worker that answered it. Counters are cumulative
+per worker, which Prometheus' rate() handles as it would a restart.
+'''
+
+# seconds, from a warm cache hit up to a slow upstream call
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _label_text(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+def _by_labels(item):
+    # label values can mix types ( a status of 404 or "error" ), order them as the text they are written as
+    return tuple(str(value) for value in item[0])
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """A monotonically increasing count, per set of label values."""
+
+    kind = "counter"
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for label_values, value in sorted(values.items(), key=_by_labels):
+            yield self.name, _label_text(self.labels, label_values), value
+
+
+class Histogram:
+    """Cumulative bucket counts, sum and count of observed values, per set of label values."""
+
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                # one slot per bucket plus +Inf, then the sum
+                series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    @contextmanager
+    def time(self, *label_values):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *label_values)
+
+    def timed(self, *label_values):
+        # decorator form of time()
+        def decorator(fn):
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.time(*label_values):
+                    return fn(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def samples(self):
+        with self._lock:
+            series = {label_values: list(values) for label_values, values in self._series.items()}
+        for label_values, values in sorted(series.items(), key=_by_labels):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), values):
+                cumulative += count
+                labels = _label_text(self.labels + ("le",), label_values + (_number(bound),))
+                yield f"{self.name}_bucket", labels, cumulative
+            labels = _label_text(self.labels, label_values)
+            yield f"{self.name}_sum", labels, values[-1]
+            yield f"{self.name}_count", labels, cumulative
+
+
+class Collected:
+    """Values read from a callback at scrape time, as {label values: value}."""
+
+    def __init__(self, name, help_text, kind, labels, collect):
+        self.name = name
+        self.help = help_text
+        self.kind = kind
+        self.labels = tuple(labels)
+        self.collect = collect
+
+    def samples(self):
+        for label_values, value in sorted(self.collect().items(), key=_by_labels):
+            yield self.name, _label_text(self.labels, label_values), value
+
+
+class Registry:
+    """Named metrics, rendered together in the Prometheus text exposition format."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _add(self, metric):
+        with self._lock:
+            existing = self._metrics.setdefault(metric.name, metric)
+        return existing
+
+    def counter(self, name, help_text, labels=()):
+        return self._add(Counter(name, help_text, labels))
+
+    def histogram(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, help_text, labels, buckets))
+
+    def collect(self, name, help_text, kind, labels, collect):
+        return self._add(Collected(name, help_text, kind, labels, collect))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+stage_seconds = registry.histogram(
+    "resleeve_stage_seconds", "Time spent in each stage of building a page or wallpaper.", ["stage"]
+)
+upstream_seconds = registry.histogram(
+    "resleeve_upstream_seconds", "Time taken by each upstream request, retries included.", ["host"]
+)
+upstream_responses = registry.counter(
+    "resleeve_upstream_responses_total", "Upstream requests by host and final HTTP status ( error without one ).",
+    ["host", "status"],
+)
@@ -0,0 +1,43 @@
+from functools import wraps
+
+try:
+    from gevent import get_hub
+    from gevent.monkey import is_module_patched
+except ImportError:  # gevent is only needed for the gevent worker ( see gunicorn.conf.py )
+    get_hub = None
+    is_module_patched = None
+
+
+'''
+OFFLOAD
+--
+Under the gevent worker every request, and every thread the app starts, is a greenlet on one OS thread. A greenlet
+only gives way to the others when it waits on I/O, so a palette quantisation or a barcode encode running in one holds
+up every other request in that worker for as long as it takes.
+
+Functions wrapped with @offloaded run on gevent's pool of real OS threads instead, while the calling greenlet waits
+on the result like it would on a socket. The GIL is still shared, but it is handed back and forth every few
+milliseconds ( and released by Pillow and numpy for their heavy loops ), so the other greenlets keep being served.
+
+Outside gevent the request threads are real threads already and the function just runs where it is called.
+'''
+
+
+def cooperative():
+    # True when threading has been swapped for greenlets, that is under the gevent worker
+    return is_module_patched is not None and is_module_patched("threading")
+
+
+def offload(fn, *args, **kwargs):
+    if cooperative():
+        return get_hub().threadpool.apply(fn, args, kwargs)
+    return fn(*args, **kwargs)
+
+
+def offloaded(fn):
+    # decorator form of offload()
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        return offload(fn, *args, **kwargs)
+
+    return wrapper
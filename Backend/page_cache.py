@@ -0,0 +1,88 @@
+import gzip
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+
+'''
+PAGE CACHE
+--
+A finished wallpaper page depends only on the release details, the device, the template and the background colours,
+yet building one means the tracklist, palette, barcode, font subsets and a large template with the cover inlined.
+Whole pages are kept here under a key built from those normalised inputs, so a repeat render of a popular album is
+a lookup.
+
+Entries are stored gzipped ( the page is mostly markup and base64, and gzip is what nearly every browser accepts
+anyway ) together with an ETag of the uncompressed page, so a browser revalidating can be answered with a 304.
+Entries expire after a TTL, and the least recently used ones are dropped once the cache goes over its byte budget.
+'''
+
+PAGE_CACHE_MAX_BYTES = int(os.environ.get("RESLEEVE_PAGE_CACHE_BYTES", 32 * 1024 * 1024))
+PAGE_CACHE_TTL = int(os.environ.get("RESLEEVE_PAGE_CACHE_TTL", 60 * 60))
+PAGE_COMPRESS_LEVEL = 6
+
+CachedPage = namedtuple("CachedPage", ["gzipped", "etag"])
+
+
+def page_key(*parts):
+    # parts are plain data ( strings, numbers, lists ), so their repr is stable
+    return hashlib.sha1(repr(parts).encode("utf-8")).hexdigest()
+
+
+class PageCache:
+    """Byte and TTL bounded LRU cache of gzipped pages with their ETags."""
+
+    def __init__(self, max_bytes=PAGE_CACHE_MAX_BYTES, ttl=PAGE_CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self._entries[key]
+                self._bytes -= len(entry[1].gzipped)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, html):
+        body = html.encode("utf-8")
+        page = CachedPage(gzip.compress(body, PAGE_COMPRESS_LEVEL), hashlib.sha1(body).hexdigest())
+        if len(page.gzipped) > self.max_bytes:
+            return page
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old[1].gzipped)
+            self._entries[key] = (time.monotonic() + self.ttl, page)
+            self._bytes += len(page.gzipped)
+            while self._bytes > self.max_bytes:
+                _key, (_expires, evicted) = self._entries.popitem(last=False)
+                self._bytes -= len(evicted.gzipped)
+        return page
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+            }
+
+
+page_cache = PageCache()
@@ -0,0 +1,132 @@
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+
+
+'''
+PALETTE CACHE
+--
+Album palettes are keyed by ( MBID, k_out, k_quant ) so picking an album and rendering its wallpaper never pays for
+quantisation twice. Entries expire after a TTL, and the least recently used ones are dropped once the cache goes
+over its byte budget.
+
+warm() starts the computation in the background as soon as a cover arrives; a later get_or_compute() for the same
+key waits on that in-flight work instead of starting its own.
+'''
+
+PALETTE_CACHE_MAX_BYTES = int(os.environ.get("RESLEEVE_PALETTE_CACHE_BYTES", 4 * 1024 * 1024))
+PALETTE_CACHE_TTL = int(os.environ.get("RESLEEVE_PALETTE_CACHE_TTL", 24 * 60 * 60))
+PALETTE_WORKERS = 2
+
+
+def _palette_size(key, palette):
+    return sys.getsizeof(key) + sys.getsizeof(palette) + sum(sys.getsizeof(colour) for colour in palette)
+
+
+class PaletteCache:
+    """Byte and TTL bounded LRU cache of computed palettes."""
+
+    def __init__(self, max_bytes=PALETTE_CACHE_MAX_BYTES, ttl=PALETTE_CACHE_TTL, workers=PALETTE_WORKERS):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="palette")
+        self.hits = 0
+        self.misses = 0
+        self.warmed = 0
+
+    def _lookup(self, key):
+        # caller holds the lock
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires, palette, size = entry
+        if expires < time.monotonic():
+            del self._entries[key]
+            self._bytes -= size
+            return None
+        self._entries.move_to_end(key)
+        return palette
+
+    def _store(self, key, palette):
+        # caller holds the lock
+        size = _palette_size(key, palette)
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= old[2]
+        self._entries[key] = (time.monotonic() + self.ttl, palette, size)
+        self._bytes += size
+        while self._bytes > self.max_bytes and self._entries:
+            _key, (_expires, _palette, old_size) = self._entries.popitem(last=False)
+            self._bytes -= old_size
+
+    def _run(self, key, compute):
+        try:
+            palette = compute()
+            with self._lock:
+                self._store(key, palette)
+            return palette
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+
+    def get(self, key):
+        with self._lock:
+            palette = self._lookup(key)
+            if palette is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return palette
+
+    def get_or_compute(self, key, compute):
+        with self._lock:
+            palette = self._lookup(key)
+            if palette is not None:
+                self.hits += 1
+                return palette
+            pending = self._pending.get(key)
+            if pending is not None:
+                # already being computed in the background, share that result
+                self.hits += 1
+            else:
+                self.misses += 1
+        if pending is not None:
+            return pending.result()
+        palette = compute()
+        with self._lock:
+            self._store(key, palette)
+        return palette
+
+    def warm(self, key, compute):
+        # starts computing a palette in the background unless it is cached or already running
+        with self._lock:
+            if key in self._pending or self._lookup(key) is not None:
+                return
+            self.warmed += 1
+            self._pending[key] = self._executor.submit(self._run, key, compute)
+
+    def drain(self):
+        # waits for every palette started in the background so far
+        with self._lock:
+            pending = list(self._pending.values())
+        wait(pending)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "warmed": self.warmed,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+            }
+
+
+palette_cache = PaletteCache()
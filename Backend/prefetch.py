@@ -0,0 +1,147 @@
+import os
+import threading
+import time
+from collections import deque
+
+from http_client import RequestBudget
+
+
+'''
+PREFETCH
+--
+Once search results are on screen the visitor nearly always picks one of the first few, and that click then waits on
+a cold tracklist lookup and a palette. The prefetcher warms both for the top PREFETCH_TOP_N results in the background,
+so the click finds them cached.
+
+The work is speculative, so it keeps out of the way of everything else:
+- one worker thread takes jobs off a queue, each only after PREFETCH_DELAY so the search's own requests go first
+- a visitor's queued jobs are dropped when they search again or pick a release
+- the process has a budget of PREFETCH_PER_MINUTE jobs, anything over it is dropped
+- a job that would need a MusicBrainz request only makes it when the shared request budget has room to spare
+  ( see RequestBudget in http_client.py ), otherwise it goes to the back of the queue to try again a little later,
+  until PREFETCH_MAX_AGE has passed and the visitor has most likely clicked anyway
+'''
+
+PREFETCH_TOP_N = int(os.environ.get("RESLEEVE_PREFETCH_TOP_N", 3))
+PREFETCH_PER_MINUTE = int(os.environ.get("RESLEEVE_PREFETCH_PER_MINUTE", 60))
+PREFETCH_DELAY = 0.5
+PREFETCH_RETRY = 1.0
+PREFETCH_MAX_AGE = 20
+PREFETCH_QUEUE_MAX = 64
+
+
+class Prefetcher:
+    """Low priority queue of speculative jobs, grouped by the visitor they were queued for."""
+
+    def __init__(
+        self,
+        per_minute=PREFETCH_PER_MINUTE,
+        delay=PREFETCH_DELAY,
+        retry=PREFETCH_RETRY,
+        max_age=PREFETCH_MAX_AGE,
+        max_queued=PREFETCH_QUEUE_MAX,
+    ):
+        self.delay = delay
+        self.retry = retry
+        self.max_age = max_age
+        self.max_queued = max_queued
+        self._budget = RequestBudget(per_minute / 60, burst=per_minute) if per_minute else None
+        # ( owner, job, time it may start, time it gives up )
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self.queued = 0
+        self.run = 0
+        self.cancelled = 0
+        self.over_budget = 0
+        self.deferred = 0
+        self.expired = 0
+        self.failed = 0
+
+    def schedule(self, owner, jobs):
+        # jobs are callables, returning False when they declined to do the work
+        if self._budget is None:
+            return
+        now = time.monotonic()
+        ready_at, give_up_at = now + self.delay, now + self.max_age
+        with self._cond:
+            self._drop(owner)
+            for job in jobs:
+                if len(self._queue) >= self.max_queued:
+                    # the oldest are the least likely to still matter
+                    self._queue.popleft()
+                    self.cancelled += 1
+                self._queue.append((owner, job, ready_at, give_up_at))
+                self.queued += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._work, name="prefetch", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def cancel(self, owner):
+        with self._cond:
+            self._drop(owner)
+
+    def _drop(self, owner):
+        # caller holds the lock
+        kept = deque(item for item in self._queue if item[0] != owner)
+        self.cancelled += len(self._queue) - len(kept)
+        self._queue = kept
+
+    def _next(self):
+        with self._cond:
+            while True:
+                if not self._queue:
+                    self._cond.wait()
+                    continue
+                # deferred jobs sit at the back, so the soonest ready one is not always first
+                item = min(self._queue, key=lambda queued: queued[2])
+                wait_for = item[2] - time.monotonic()
+                if wait_for > 0:
+                    self._cond.wait(wait_for)
+                    continue
+                self._queue.remove(item)
+                return item
+
+    def _work(self):
+        while True:
+            item = self._next()
+            owner, job, _ready_at, give_up_at = item
+            if not self._budget.spare():
+                with self._cond:
+                    self.over_budget += 1
+                continue
+            try:
+                done = job()
+            except Exception:
+                self._budget.spend()
+                with self._cond:
+                    self.failed += 1
+                continue
+            with self._cond:
+                if done is not False:
+                    # only work that was done counts against the budget, not a deferral
+                    self._budget.spend()
+                    self.run += 1
+                elif time.monotonic() + self.retry >= give_up_at:
+                    self.expired += 1
+                else:
+                    # no room upstream yet, try again once the budget has refilled a little
+                    self.deferred += 1
+                    self._queue.append((owner, job, time.monotonic() + self.retry, give_up_at))
+
+    def stats(self):
+        with self._cond:
+            return {
+                "queued": self.queued,
+                "waiting": len(self._queue),
+                "run": self.run,
+                "cancelled": self.cancelled,
+                "over_budget": self.over_budget,
+                "deferred": self.deferred,
+                "expired": self.expired,
+                "failed": self.failed,
+            }
+
+
+prefetcher = Prefetcher()
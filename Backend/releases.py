@@ -0,0 +1,135 @@
+'''
+RELEASES
+--
+A release lookup ( release?inc=artist-credits+recordings+release-groups ) carries ids, a recording object, a video
+flag and both a track and a recording title and length for every track on every medium, and box sets run to hundreds
+of tracks. The pages read a handful of fields, so the tracklist cache keeps a compact projection instead of
+the JSON: a slotted Release with the details parse_release() pulls out, and a tuple of slotted Tracks.
+
+Releases with several media are handled explicitly. The wallpaper has room for one tracklist, so only the first
+medium that has tracks is kept ( a leading DVD or data medium without a listing is skipped ), while the track count
+still covers every medium.
+'''
+
+
+class Track:
+    """One track of a release: its position, title and recording length in ms ( None when unknown )."""
+
+    __slots__ = ("position", "title", "length")
+
+    def __init__(self, position, title, length):
+        self.position = position
+        self.title = title
+        self.length = length
+
+
+class Release:
+    """The parts of a release lookup the pages use, with the tracks of the medium they show."""
+
+    __slots__ = (
+        "mbid",
+        "title",
+        "artist",
+        "date",
+        "country",
+        "barcode",
+        "format",
+        "release_type",
+        "track_count",
+        "tracks",
+    )
+
+    def __init__(self, details, tracks):
+        self.mbid = details["MBID"]
+        self.title = details["Title"]
+        self.artist = details["Artist"]
+        self.date = details["Date"]
+        self.country = details["Country"]
+        self.barcode = details["Barcode"]
+        self.format = details["Format"]
+        self.release_type = details["Release Type"]
+        self.track_count = details["Track Count"]
+        self.tracks = tracks
+
+    def details(self):
+        # the same dictionary parse_release() builds from the JSON
+        return {
+            "Artist": self.artist,
+            "Title": self.title,
+            "Country": self.country,
+            "Track Count": self.track_count,
+            "MBID": self.mbid,
+            "Format": self.format,
+            "Release Type": self.release_type,
+            "Date": self.date,
+            "Barcode": self.barcode,
+        }
+
+
+# pulls the fields the picker and the wallpapers show out of a MusicBrainz release ( search result or lookup )
+def parse_release(release):
+    # Set the variables based on the information in the JSON
+    artist = release["artist-credit"][0]["name"]
+    # Country can be found in two places
+    country = release.get("country")
+    # If not found above, then look for it in the other place
+    if not country and "release-events" in release:
+        for event in release["release-events"]:
+            # Check release events
+            if "area" in event and "iso-3166-1-codes" in event["area"]:
+                country = event["area"]["iso-3166-1-codes"][0]
+                break
+    # Get other variables
+    mbid = release["id"]
+    # search results carry a total, a release lookup only has it per medium
+    track_count = release.get("track-count")
+    if track_count is None:
+        track_count = sum(
+            medium.get("track-count", len(medium.get("tracks", []))) for medium in release.get("media", [])
+        )
+    title = release["title"]
+    # Some entries don't have these variables - make sure they do not raise a ValueError if they do not exist
+    try:
+        barcode = release["barcode"]
+    except Exception:
+        barcode = "794558113229"
+    try:
+        format = release["media"][0]["format"]
+    except Exception:
+        format = None
+    release_type = (release.get("release-group") or {}).get("primary-type")
+    # The date variable can be found in two different places - so check both
+    date = release.get("date")
+    if date is None:
+        date = release.get("release-events", [{}])[0].get("date")
+
+    # Create the dictionary of all of the album data
+    return {
+        "Artist": artist,
+        "Title": title,
+        "Country": country,
+        "Track Count": track_count,
+        "MBID": mbid,
+        "Format": format,
+        "Release Type": release_type,
+        "Date": date,
+        "Barcode": barcode,
+    }
+
+
+def _shown_medium(media):
+    # the first medium with a listing, the one the wallpaper shows
+    for medium in media:
+        if medium.get("tracks"):
+            return medium
+    return None
+
+
+# projects a release lookup down to a Release
+def project_release(body):
+    medium = _shown_medium(body.get("media") or [])
+    tracks = tuple(
+        Track(int(track["position"]), track["title"], (track.get("recording") or {}).get("length"))
+        for track in (medium["tracks"] if medium is not None else [])
+    )
+    return Release(parse_release(body), tracks)
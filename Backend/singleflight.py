@@ -0,0 +1,119 @@
+import fcntl
+import os
+import threading
+import zlib
+from contextlib import contextmanager
+from functools import wraps
+
+from cover_store import CACHE_DIR
+
+
+'''
+SINGLE FLIGHT
+--
+The caches in front of the upstream fetchers only help once a call has finished. When many people pick the same
+album at the same moment ( a release day ), every thread misses the cache together and each one would send its own
+request to MusicBrainz or the Cover Art Archive.
+
+A SingleFlight lets the first caller for a key make the call while every other caller with the same key waits for it
+and shares its result ( or its exception ). That is enough inside one worker process.
+
+Across gunicorn workers the leader can also take an exclusive lock file first. This only pays off for fetchers that
+check a cache every worker shares before going upstream ( the on-disk cover store ): the worker that waited on the
+lock then finds the entry there instead of fetching it again. Lock files are striped by a hash of the key so their
+number stays fixed, at the cost of the odd unrelated key waiting on the same stripe.
+'''
+
+SINGLEFLIGHT_LOCK_DIR = CACHE_DIR / "locks"
+# cross worker locking is opt in, set RESLEEVE_SINGLEFLIGHT_LOCKS=1 when running more than one worker
+SINGLEFLIGHT_LOCKS = os.environ.get("RESLEEVE_SINGLEFLIGHT_LOCKS", "0") == "1"
+LOCK_STRIPES = 64
+
+
+class _Call:
+    """One in-flight call and the outcome its waiters will share."""
+
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Collapses concurrent calls for the same key into a single call."""
+
+    def __init__(self, name, lock_dir=None):
+        self.name = name
+        self.lock_dir = lock_dir
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.shared = 0
+
+    @contextmanager
+    def _worker_lock(self, key):
+        if self.lock_dir is None:
+            yield
+            return
+        stripe = zlib.crc32(repr(key).encode("utf-8")) % LOCK_STRIPES
+        try:
+            os.makedirs(self.lock_dir, exist_ok=True)
+            handle = open(os.path.join(self.lock_dir, f"{self.name}-{stripe}.lock"), "a+b")
+        except OSError:
+            # no lock file, still deduplicated within this worker
+            yield
+            return
+        with handle:
+            fcntl.flock(handle, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(handle, fcntl.LOCK_UN)
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.calls += 1
+            else:
+                self.shared += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            with self._worker_lock(key):
+                call.result = fn(*args, **kwargs)
+        except BaseException as exc:
+            call.error = exc
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def __call__(self, fn):
+        # decorator form, keyed on the function and its arguments so one flight can cover several fetchers
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            key = (fn.__name__, args, tuple(sorted(kwargs.items())))
+            return self.do(key, fn, *args, **kwargs)
+
+        return wrapper
+
+    def stats(self):
+        with self._lock:
+            return {"calls": self.calls, "shared": self.shared, "in_flight": len(self._calls)}
+
+
+def singleflight(name, across_workers=False):
+    lock_dir = SINGLEFLIGHT_LOCK_DIR if across_workers and SINGLEFLIGHT_LOCKS else None
+    return SingleFlight(name, lock_dir=lock_dir)
@@ -0,0 +1,164 @@
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+'''
+SUGGESTIONS
+--
+Autocomplete queries arrive one keystroke at a time: "radio", "radioh", "radiohe". Caching each exact string still
+costs an upstream call per keystroke, so suggestions are cached by prefix instead.
+
+Upstream is asked for names with a word starting with each word of the query ( "radio he" becomes radio* AND he* ),
+the same rule matches() applies locally. Every fetched result set is stored under its normalised query, along with
+whether it was complete ( MusicBrainz matched no more than it returned ). A longer query is then answered by walking
+back through its prefixes, and if one of them holds a complete set, filtering that set locally: any name the longer
+query could match has to be in it already. An empty set is never reused this way, in case upstream split a name into
+words differently.
+
+Typing fast from one page also sends queries that are stale before they are answered. The page sends an id with its
+requests, and a cache miss from it only goes upstream once the page's previous request is back: it then often finds
+the answer cached under its prefix. If the page sends a newer query while one is waiting, the waiting one steps aside
+without going upstream. A request from a page with nothing in flight goes straight up.
+'''
+
+SUGGEST_CACHE_SIZE = 4096
+# the shortest cached prefix a longer query may be filtered from
+MIN_PREFIX = 2
+# the longest a cache miss waits for the same page's previous request before going upstream anyway
+BURST_MAX_WAIT = 2.0
+BURST_CLIENTS = 4096
+
+
+def normalise(text):
+    # casefolded, accents stripped and whitespace collapsed, so "Björk " and "bjork" share an entry
+    decomposed = unicodedata.normalize("NFKD", text or "")
+    stripped = "".join(char for char in decomposed if not unicodedata.combining(char))
+    return " ".join(stripped.casefold().split())
+
+
+def words(text):
+    return re.findall(r"\w+", normalise(text))
+
+
+def matches(name, query):
+    # every word of the query starts some word of the name
+    name_words = words(name)
+    return all(any(word.startswith(part) for word in name_words) for part in words(query))
+
+
+class SuggestionCache:
+    """LRU cache of suggestion sets that also answers longer queries from complete shorter ones."""
+
+    def __init__(self, max_entries=SUGGEST_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.prefix_hits = 0
+        self.misses = 0
+
+    def lookup(self, scope, query):
+        query = normalise(query)
+        with self._lock:
+            entry = self._entries.get((scope, query))
+            if entry is not None:
+                self._entries.move_to_end((scope, query))
+                self.hits += 1
+                return list(entry[0])
+            for end in range(len(query) - 1, MIN_PREFIX - 1, -1):
+                entry = self._entries.get((scope, query[:end]))
+                if entry is None:
+                    continue
+                names, complete = entry
+                if not complete or not names:
+                    # a truncated set may be missing what the longer query wants, ask upstream
+                    break
+                self._entries.move_to_end((scope, query[:end]))
+                self.prefix_hits += 1
+                return [name for name in names if matches(name, query)]
+            self.misses += 1
+            return None
+
+    def store(self, scope, query, names, complete):
+        key = (scope, normalise(query))
+        with self._lock:
+            self._entries[key] = (tuple(names), complete)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "prefix_hits": self.prefix_hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+            }
+
+
+class BurstCoalescer:
+    """Sends a client's requests upstream one at a time, skipping those a newer one overtook while they waited."""
+
+    def __init__(self, max_wait=BURST_MAX_WAIT, max_clients=BURST_CLIENTS):
+        self.max_wait = max_wait
+        self.max_clients = max_clients
+        # client -> [ newest ticket, requests from it still upstream ]
+        self._clients = OrderedDict()
+        self._cond = threading.Condition()
+        self._tickets = 0
+        self.waited = 0
+        self.superseded = 0
+
+    def _join(self, client):
+        # caller holds the lock
+        self._tickets += 1
+        state = self._clients.setdefault(client, [0, 0])
+        state[0] = self._tickets
+        self._clients.move_to_end(client)
+        while len(self._clients) > self.max_clients:
+            self._clients.popitem(last=False)
+        return self._tickets, state
+
+    @contextmanager
+    def hold(self, client):
+        # yields None when a newer request from this client made this one moot, otherwise whether it had to wait
+        started = time.monotonic()
+        with self._cond:
+            ticket, state = self._join(client)
+            # an older request still waiting can step aside now
+            self._cond.notify_all()
+            waited = bool(state[1])
+            if waited:
+                self.waited += 1
+            while state[1] and state[0] == ticket:
+                remaining = started + self.max_wait - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            current = state[0] == ticket
+            if current:
+                state[1] += 1
+            else:
+                self.superseded += 1
+        if not current:
+            yield None
+            return
+        try:
+            yield waited
+        finally:
+            with self._cond:
+                state[1] -= 1
+                self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {"waited": self.waited, "superseded": self.superseded, "clients": len(self._clients)}
+
+
+suggestion_cache = SuggestionCache()
+keystroke_bursts = BurstCoalescer()
@@ -0,0 +1,53 @@
+import io
+
+from cover_store import cover_store
+
+
+# longest side in pixels for each served variant, None serves the original bytes untouched
+COVER_SIZES = {
+    "thumb": 300,
+    "medium": 640,
+    "full": None,
+}
+COVER_FORMATS = {
+    "jpeg": ("JPEG", "image/jpeg"),
+    "webp": ("WEBP", "image/webp"),
+}
+VARIANT_QUALITY = 82
+
+
+def _variant_key(mbid, size, fmt):
+    return f"{mbid}/{size}.{fmt}"
+
+
+def render_variant(cover, max_side, fmt):
+    pil_format, _content_type = COVER_FORMATS[fmt]
+    buf = io.BytesIO()
+    cover.image(max_side).save(buf, pil_format, quality=VARIANT_QUALITY, optimize=True)
+    return buf.getvalue()
+
+
+def get_cover_variant(mbid, size, fmt, load_cover):
+    # returns (bytes, content type) for a sized cover, generating and storing it on first use
+    max_side = COVER_SIZES[size]
+    if max_side is None:
+        cover = load_cover(mbid)
+        if cover is None:
+            return None
+        return cover.data, cover.content_type
+
+    key = _variant_key(mbid, size, fmt)
+    stored = cover_store.get(key)
+    if stored is not None:
+        return stored
+
+    cover = load_cover(mbid)
+    if cover is None:
+        return None
+    try:
+        variant = render_variant(cover, max_side, fmt)
+    except (OSError, ValueError):
+        return None
+    content_type = COVER_FORMATS[fmt][1]
+    cover_store.put(key, variant, content_type)
+    return variant, content_type
@@ -0,0 +1,175 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+
+
+'''
+TTL CACHE
+--
+A replacement for lru_cache in front of the upstream fetchers, which has two gaps there: it never caches a failure,
+so a release without cover art is asked for again on every search, and it never lets a success go, so a tracklist
+fixed on MusicBrainz is never seen until the worker restarts.
+
+Values are kept for a TTL. Once it passes they are still served for a stale window while a background thread fetches
+a fresh copy ( a failed refresh keeps the stale value ). Exceptions of the types a fetcher names are cached too, each
+type for its own, shorter TTL, and raised again from the cache. Anything else raised is passed straight through.
+
+Every cached fetcher registers under a name, and fetch_cache_stats() reports the hits, misses and refreshes of each.
+'''
+
+REFRESH_WORKERS = 2
+
+_refresh_executor = ThreadPoolExecutor(max_workers=REFRESH_WORKERS, thread_name_prefix="cache-refresh")
+_registry = {}
+
+
+class _Entry:
+    """A cached value or exception and the times it goes stale and expires."""
+
+    __slots__ = ("value", "error", "fresh_until", "stale_until")
+
+    def __init__(self, value, error, fresh_until, stale_until):
+        self.value = value
+        self.error = error
+        self.fresh_until = fresh_until
+        self.stale_until = stale_until
+
+
+class TTLCache:
+    """Bounded cache of one fetcher's results and failures, each kept for its own TTL."""
+
+    def __init__(self, fn, name, maxsize, ttl, stale_ttl=0, negative=None):
+        self.fn = fn
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        # exception type -> seconds it is cached for, the first matching type wins
+        self.negative = dict(negative or {})
+        self._entries = OrderedDict()
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.refresh_failures = 0
+
+    def _negative_ttl(self, error):
+        for error_type, ttl in self.negative.items():
+            if isinstance(error, error_type):
+                return ttl
+        return 0
+
+    def _store(self, key, value=None, error=None):
+        now = time.monotonic()
+        if error is not None:
+            expires = now + self._negative_ttl(error)
+            entry = _Entry(None, error.with_traceback(None), expires, expires)
+        else:
+            entry = _Entry(value, None, now + self.ttl, now + self.ttl + self.stale_ttl)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def _refresh(self, key, args, kwargs):
+        try:
+            value = self.fn(*args, **kwargs)
+        except Exception:
+            # keep serving the stale value until its window closes
+            with self._lock:
+                self.refresh_failures += 1
+        else:
+            self._store(key, value)
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def __call__(self, *args, **kwargs):
+        key = (args, tuple(sorted(kwargs.items())))
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.stale_until <= now:
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                if entry.error is not None:
+                    self.negative_hits += 1
+                elif entry.fresh_until > now:
+                    self.hits += 1
+                else:
+                    self.stale_hits += 1
+                    if key not in self._refreshing:
+                        self._refreshing.add(key)
+                        self.refreshes += 1
+                        _refresh_executor.submit(self._refresh, key, args, kwargs)
+            else:
+                self.misses += 1
+
+        if entry is not None:
+            if entry.error is not None:
+                # a copy, so tracebacks do not pile up on the cached instance
+                raise copy.copy(entry.error)
+            return entry.value
+
+        try:
+            value = self.fn(*args, **kwargs)
+        except Exception as exc:
+            if self._negative_ttl(exc) > 0:
+                self._store(key, error=exc)
+            raise
+        self._store(key, value)
+        return value
+
+    def contains(self, *args, **kwargs):
+        # whether a call would be answered from the cache ( a stale value or a cached failure included ), no stats
+        key = (args, tuple(sorted(kwargs.items())))
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and entry.stale_until > time.monotonic()
+
+    def cache_clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "stale_hits": self.stale_hits,
+                "negative_hits": self.negative_hits,
+                "misses": self.misses,
+                "refreshes": self.refreshes,
+                "refresh_failures": self.refresh_failures,
+                "entries": len(self._entries),
+            }
+
+
+def ttl_cache(maxsize, ttl, stale_ttl=0, negative=None, name=None):
+    # decorator form, the wrapper keeps cache_clear() and stats() like lru_cache keeps cache_clear(), and cached()
+    def decorator(fn):
+        cache = TTLCache(fn, name or fn.__name__, maxsize, ttl, stale_ttl, negative)
+        _registry[cache.name] = cache
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            return cache(*args, **kwargs)
+
+        wrapper.cache_clear = cache.cache_clear
+        wrapper.cached = cache.contains
+        wrapper.stats = cache.stats
+        return wrapper
+
+    return decorator
+
+
+def fetch_cache_stats():
+    return {name: cache.stats() for name, cache in _registry.items()}
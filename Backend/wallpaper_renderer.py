@@ -0,0 +1,460 @@
+import io
+from functools import lru_cache
+
+import numpy as np
+from PIL import Image, ImageColor, ImageDraw, ImageFont, ImageOps
+
+from fonts import FONT_DIR
+
+
+'''
+WALLPAPER RENDERER
+--
+Draws the finished wallpaper PNG on the server with Pillow, following the same geometry as the desktop-*.html and
+phone-*.html templates ( and what their downloadWallpaper() exports in the browser ):
+
+- desktop: the 2060x1440 layout, scaled by 1.5 and centred on a 3840x2160 canvas
+- phone: the 1290x2796 layout at 1:1
+
+Both layouts are drawn with the DejaVu fonts from static/fonts, which the phone templates use as well. The desktop
+templates ask the browser for Helvetica, so desktop text is metrically close rather than identical.
+
+render_wallpaper() only takes plain data ( bytes, strings, dicts ) so it can run in a worker process.
+'''
+
+# bumped whenever the drawing changes, so previously cached renders are not served again
+RENDERER_VERSION = 1
+REGULAR_FONT = "DejaVuSans.ttf"
+BOLD_FONT = "DejaVuSans-Bold.ttf"
+PNG_COMPRESS_LEVEL = 3
+
+DESKTOP_CANVAS = (3840, 2160)
+DESKTOP_LAYOUT = (2060, 1440)
+PHONE_CANVAS = (1290, 2796)
+
+# text colours per template, rgba where the templates use an opacity
+DESKTOP_COLOURS = {
+    "white": {
+        "artist": "#000000",
+        "album": "#000000",
+        "number": "#000000",
+        "title": "#000000",
+        "duration": "#3c3c3c",
+        "track": "#dddddd",
+        "progress": "#303030",
+        "line": "#000000",
+        "label": "#000000",
+        "value": "#000000",
+    },
+    "dark": {
+        "artist": "#9F9F9F",
+        "album": "#DBDBDB",
+        "number": "#DBDBDB",
+        "title": "#DBDBDB",
+        "duration": "#9F9F9F",
+        "track": "#1f2330",
+        "progress": "#9F9F9F",
+        "line": "#ffffff",
+        "label": "#DBDBDB",
+        "value": "#9F9F9F",
+    },
+}
+PHONE_COLOURS = {
+    "white": {
+        "artist": (18, 20, 37, 153),
+        "album": "#121425",
+        "number": "#121425",
+        "title": "#121425",
+        "duration": (18, 20, 37, 153),
+        "track": (18, 20, 37, 31),
+        "progress": (18, 20, 37, 153),
+        "line": (18, 20, 37, 230),
+        "label": "#121425",
+        "value": (18, 20, 37, 153),
+    },
+    "dark": {
+        "artist": "#9F9F9F",
+        "album": "#DBDBDB",
+        "number": "#DBDBDB",
+        "title": "#DBDBDB",
+        "duration": "#9F9F9F",
+        "track": "#1f2330",
+        "progress": "#9F9F9F",
+        "line": (255, 255, 255, 242),
+        "label": "#DBDBDB",
+        "value": "#9F9F9F",
+    },
+}
+# what the templates show before a tracklist has loaded
+PLACEHOLDER_TRACKS = 12
+
+
+class WallpaperRenderError(Exception):
+    """Raised when the wallpaper cannot be drawn from the given data."""
+
+
+@lru_cache(maxsize=128)
+def _font(size, bold=False):
+    return ImageFont.truetype(str(FONT_DIR / (BOLD_FONT if bold else REGULAR_FONT)), max(1, int(round(size))))
+
+
+def _rgba(colour):
+    if isinstance(colour, str):
+        return ImageColor.getcolor(colour, "RGBA")
+    if len(colour) == 3:
+        return (*colour, 255)
+    return tuple(colour)
+
+
+def _fill_background(size, fill):
+    # one colour, or a 45 degree gradient running from the bottom left to the top right like the canvas export
+    if len(fill) == 1:
+        return Image.new("RGB", size, _rgba(fill[0])[:3])
+    width, height = size
+    start = np.array(_rgba(fill[0])[:3], dtype=np.float32)
+    end = np.array(_rgba(fill[1])[:3], dtype=np.float32)
+    xs = np.arange(width, dtype=np.float32)[None, :]
+    ys = np.arange(height, dtype=np.float32)[:, None]
+    # projection of every pixel onto the ( 0, h ) -> ( w, 0 ) line, 0 at the start and 1 at the end
+    t = (xs * width + (height - ys) * height) / float(width * width + height * height)
+    pixels = start + np.clip(t, 0, 1)[..., None] * (end - start)
+    return Image.fromarray(np.rint(pixels).astype(np.uint8), "RGB")
+
+
+class _Surface:
+    """The canvas being drawn, addressed in the template's CSS pixels."""
+
+    def __init__(self, image, scale=1.0, origin=(0, 0)):
+        self.image = image
+        self.scale = scale
+        self.origin = origin
+
+    def px(self, value):
+        return int(round(value * self.scale))
+
+    def box(self, x, y, width, height):
+        left = self.origin[0] + self.px(x)
+        top = self.origin[1] + self.px(y)
+        return left, top, left + max(0, self.px(width)), top + max(0, self.px(height))
+
+    def font(self, size, bold=False):
+        return _font(size * self.scale, bold)
+
+    def measure(self, text, size, bold=False):
+        return self.font(size, bold).getlength(text) / self.scale
+
+    def _paint(self, colour, mask, offset):
+        # pasting through a mask blends translucent colours onto whatever is underneath
+        r, g, b, a = _rgba(colour)
+        if a < 255:
+            mask = mask.point(lambda value: value * a // 255)
+        self.image.paste((r, g, b), offset, mask)
+
+    def rect(self, x, y, width, height, colour, radius=0):
+        left, top, right, bottom = self.box(x, y, width, height)
+        if right <= left or bottom <= top:
+            return
+        mask = Image.new("L", (right - left, bottom - top), 0)
+        ImageDraw.Draw(mask).rounded_rectangle(
+            (0, 0, right - left - 1, bottom - top - 1), radius=self.px(radius), fill=255
+        )
+        self._paint(colour, mask, (left, top))
+
+    def text(self, x, y, text, size, colour, bold=False, line_height=None, max_width=None):
+        # y is the top of the CSS line box, the glyphs sit on its baseline like the browser would place them
+        text = str(text)
+        if not text:
+            return
+        font = self.font(size, bold)
+        ascent, descent = font.getmetrics()
+        box_height = self.px(size * line_height) if line_height else ascent + descent
+        baseline = self.origin[1] + self.px(y) + (box_height - ascent - descent) // 2 + ascent
+        left = self.origin[0] + self.px(x)
+        width = int(font.getlength(text)) + font.size
+        if max_width is not None:
+            width = min(width, self.px(max_width))
+        mask = Image.new("L", (max(1, width), ascent + descent), 0)
+        ImageDraw.Draw(mask).text((0, ascent), text, font=font, fill=255, anchor="ls")
+        self._paint(colour, mask, (left, baseline - ascent))
+
+    def picture(self, image, x, y, width, height, radius=0):
+        left, top, right, bottom = self.box(x, y, width, height)
+        size = (right - left, bottom - top)
+        if size[0] <= 0 or size[1] <= 0:
+            return
+        if image.size != size:
+            image = ImageOps.fit(image, size, Image.Resampling.LANCZOS)
+        mask = image.getchannel("A") if image.mode == "RGBA" else None
+        if radius:
+            rounded = Image.new("L", size, 0)
+            ImageDraw.Draw(rounded).rounded_rectangle(
+                (0, 0, size[0] - 1, size[1] - 1), radius=self.px(radius), fill=255
+            )
+            mask = rounded if mask is None else Image.fromarray(np.minimum(np.asarray(mask), np.asarray(rounded)))
+        self.image.paste(image.convert("RGB"), (left, top), mask)
+
+
+def _line_height(size):
+    # the font's own ascent + descent, what CSS uses for "line-height: normal"
+    ascent, descent = _font(size * 8).getmetrics()
+    return (ascent + descent) / 8
+
+
+def _fit_size(surface, text, max_size, min_size, width):
+    # largest whole font size that keeps the text on one line within width, like fitAlbumTitleToCover()
+    lo, hi, best = min_size, max_size, min_size
+    while lo <= hi:
+        mid = (lo + hi) // 2
+        if surface.measure(text, mid, bold=True) <= width:
+            best = mid
+            lo = mid + 1
+        else:
+            hi = mid - 1
+    return best
+
+
+def _wrap(surface, text, size, bold, first_width, width):
+    # greedy word wrap, a word longer than the line is broken wherever it runs out of room
+    lines, current, limit = [], "", first_width
+    for word in str(text).split():
+        candidate = f"{current} {word}" if current else word
+        if surface.measure(candidate, size, bold) <= limit:
+            current = candidate
+            continue
+        if current:
+            lines.append(current)
+            limit = width
+        current = word
+        while surface.measure(current, size, bold) > limit and len(current) > 1:
+            cut = len(current) - 1
+            while cut > 1 and surface.measure(current[:cut], size, bold) > limit:
+                cut -= 1
+            lines.append(current[:cut])
+            limit = width
+            current = current[cut:]
+    if current:
+        lines.append(current)
+    return lines or [""]
+
+
+def _load_cover(data):
+    if not data:
+        return None
+    try:
+        return Image.open(io.BytesIO(data)).convert("RGB")
+    except (OSError, ValueError):
+        return None
+
+
+def _load_barcode(data):
+    if not data:
+        return None
+    try:
+        return Image.open(io.BytesIO(data)).convert("RGBA")
+    except (OSError, ValueError):
+        return None
+
+
+def _album_info(spec, with_type=True):
+    info = [
+        ("Release Date", spec["date"]),
+        ("Run Time", spec["run_time"]),
+        ("Track Count", spec["track_count"]),
+        ("Country", spec["country"]),
+        ("Format", spec["format"]),
+    ]
+    if with_type:
+        info.append(("Type", spec["type"]))
+    return info
+
+
+def _render_desktop(spec):
+    palette = DESKTOP_COLOURS[spec["template"]]
+    image = _fill_background(DESKTOP_CANVAS, spec["fill"])
+    scale = min(DESKTOP_CANVAS[0] / DESKTOP_LAYOUT[0], DESKTOP_CANVAS[1] / DESKTOP_LAYOUT[1])
+    origin = (
+        int(round((DESKTOP_CANVAS[0] - DESKTOP_LAYOUT[0] * scale) / 2)),
+        int(round((DESKTOP_CANVAS[1] - DESKTOP_LAYOUT[1] * scale) / 2)),
+    )
+    surface = _Surface(image, scale, origin)
+    if spec["container"]:
+        surface.rect(0, 0, *DESKTOP_LAYOUT, spec["container"])
+
+    cover = _load_cover(spec["cover"])
+    if cover is not None:
+        surface.picture(cover, 63, 57, 680, 680)
+
+    surface.text(61, 767, spec["artist"], 30, palette["artist"])
+    title_size = _fit_size(surface, str(spec["album"]), 96, 12, 680)
+    surface.text(56, 811, spec["album"], title_size, palette["album"], bold=True, max_width=680)
+
+    for index, colour in enumerate(spec["colours"][:5]):
+        surface.rect(472 + index * 58, 762, 39, 39, colour)
+    surface.rect(63, 941, DESKTOP_LAYOUT[0] * 0.94, 5, palette["line"])
+
+    # up to 20 tracks split over two columns, sized so a full column fills the cover's height
+    tracks = list(spec["tracklist"].items())[:20]
+    if tracks:
+        half = (len(tracks) + 1) // 2
+        track_height = round(700 / half)
+        font_scale = track_height / 117
+        title_size = round(35 * font_scale)
+        duration_size = round(24 * font_scale)
+        number_size = round(35 * font_scale)
+        gap = round(29 * font_scale)
+        bar_height = round(10 * font_scale)
+        for column, left in enumerate((858, 1491)):
+            for row, (position, track) in enumerate(tracks[column * half : (column + 1) * half]):
+                top = 57 + row * (track_height + gap)
+                number = f"{position}."
+                number_top = round(track_height * 0.3) - _line_height(number_size) / 2
+                number_left = left + (48 - surface.measure(number, number_size, bold=True)) / 2
+                surface.text(number_left, top + number_top, number, number_size, palette["number"], bold=True)
+                title = _wrap(surface, track["title"], title_size, True, 440, 440)[0]
+                surface.text(
+                    left + 60,
+                    top + round(track_height * 0.13),
+                    title,
+                    title_size,
+                    palette["title"],
+                    bold=True,
+                    line_height=1.1,
+                    max_width=440,
+                )
+                surface.text(
+                    left + 63, top + round(track_height * 0.63), track["length"], duration_size, palette["duration"]
+                )
+                bar_top = top + round(track_height * 0.92)
+                surface.rect(left + 62, bar_top, 508 - 62, bar_height, palette["track"], radius=5)
+                progress = min(508 * track["pct"] / 100, 508 - 62)
+                surface.rect(left + 62, bar_top, progress, bar_height, palette["progress"], radius=5)
+
+    left = 404
+    for label, value in _album_info(spec):
+        surface.text(left, 979, label, 24, palette["label"], bold=True)
+        surface.text(left, 979 + _line_height(24) + 8, value, 24, palette["value"])
+        left += max(surface.measure(label, 24, True), surface.measure(str(value), 24)) + 166
+
+    barcode = _load_barcode(spec["barcode"])
+    if barcode is not None:
+        surface.picture(barcode, 65, 960, barcode.width, barcode.height)
+    return image
+
+
+def _render_phone(spec):
+    palette = PHONE_COLOURS[spec["template"]]
+    image = _fill_background(PHONE_CANVAS, spec["fill"])
+    surface = _Surface(image)
+    if spec["container"]:
+        surface.rect(0, 0, *PHONE_CANVAS, spec["container"])
+
+    padding, content_width = 56, 1078
+    left = padding + (PHONE_CANVAS[0] - 2 * padding - content_width) / 2
+    top = padding
+
+    cover = _load_cover(spec["cover"])
+    if cover is not None:
+        surface.picture(cover, left, top, content_width, content_width, radius=48)
+    top += content_width
+
+    top += 28
+    surface.text(left, top, spec["artist"], 34, palette["artist"], max_width=content_width)
+    top += _line_height(34)
+
+    top += 8
+    title_size = _fit_size(surface, str(spec["album"]), 96, 18, content_width)
+    surface.text(left, top, spec["album"], title_size, palette["album"], bold=True, line_height=1.02,
+                 max_width=content_width)
+    top += title_size * 1.02
+
+    top += 16
+    for index, colour in enumerate(spec["colours"][:5]):
+        surface.rect(left + index * 58, top, 42, 42, colour)
+    top += 42
+
+    top += 28
+    surface.rect(padding, top, PHONE_CANVAS[0] - 2 * padding, 5, palette["line"])
+    top += 5 + 18
+
+    # three columns filled top to bottom, each track's title wraps under its number
+    column_gap = 28
+    column_width = (content_width - 2 * column_gap) / 3
+    line = max(_line_height(30), 30 * 1.15)
+    meta_line = _line_height(20)
+    space = surface.measure(" ", 16)
+
+    def draw_track(x, y, number, track):
+        number_width = max(40, surface.measure(number, 30, bold=True))
+        surface.text(x, y, number, 30, palette["number"], bold=True)
+        indent = number_width + space
+        lines = _wrap(surface, track["title"], 30, True, column_width - indent, column_width)
+        for index, text in enumerate(lines):
+            surface.text(x + (indent if index == 0 else 0), y + index * line, text, 30, palette["title"], bold=True)
+        meta_top = y + len(lines) * line + 6
+        surface.text(x, meta_top, track["length"], 20, palette["duration"], max_width=column_width)
+        bottom = meta_top + meta_line + 16
+        surface.rect(x, bottom - 10, column_width, 10, palette["track"], radius=5)
+        surface.rect(x, bottom - 10, column_width * track["pct"] / 100, 10, palette["progress"], radius=5)
+        return bottom + 18
+
+    tracks = list(spec["tracklist"].items())
+    if tracks:
+        per_column = (len(tracks) + 2) // 3
+        tracks_bottom = top
+        for column in range(3):
+            x = left + column * (column_width + column_gap)
+            y = top
+            for position, track in tracks[column * per_column : (column + 1) * per_column]:
+                y = draw_track(x, y, f"{position}.", track)
+            tracks_bottom = max(tracks_bottom, y)
+        top = tracks_bottom
+    else:
+        placeholder = {"title": "Track title", "length": "--:--", "pct": 0}
+        for row in range((PLACEHOLDER_TRACKS + 2) // 3):
+            bottom = top
+            for column in range(3):
+                index = row * 3 + column
+                if index >= PLACEHOLDER_TRACKS:
+                    break
+                x = left + column * (column_width + column_gap)
+                bottom = max(bottom, draw_track(x, top, f"{index + 1}.", placeholder))
+            top = bottom
+
+    top += 18
+    surface.rect(padding, top, PHONE_CANVAS[0] - 2 * padding, 5, palette["line"])
+    top += 5 + 20
+
+    info_gap = 22
+    info_width = (content_width - 4 * info_gap) / 5
+    label_line = _line_height(22)
+    info_bottom = top
+    for index, (label, value) in enumerate(_album_info(spec, with_type=False)):
+        x = left + index * (info_width + info_gap)
+        surface.text(x, top, label, 22, palette["label"], bold=True, max_width=info_width)
+        y = top + label_line + 6
+        for text in _wrap(surface, value, 22, False, info_width, info_width):
+            surface.text(x, y, text, 22, palette["value"])
+            y += label_line
+        info_bottom = max(info_bottom, y)
+    top = info_bottom
+
+    barcode = _load_barcode(spec["barcode"])
+    if barcode is not None:
+        top += 18
+        surface.picture(barcode, left, top, barcode.width * 16 / barcode.height, 16)
+    return image
+
+
+def render_wallpaper(spec):
+    # spec: device, template, cover ( bytes ), artist, album, date, country, track_count, format, type, run_time,
+    # tracklist, colours, barcode ( png bytes ), fill ( one or two colours ) and container ( colour or None )
+    try:
+        if spec["device"] == "phone":
+            image = _render_phone(spec)
+        else:
+            image = _render_desktop(spec)
+    except (KeyError, TypeError, ValueError) as exc:
+        raise WallpaperRenderError(str(exc)) from exc
+    buf = io.BytesIO()
+    image.save(buf, "PNG", compress_level=PNG_COMPRESS_LEVEL)
+    return buf.getvalue()